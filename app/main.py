@@ -1,27 +1,136 @@
 # main.py
-from fastapi import FastAPI, File, UploadFile, HTTPException, status
-from typing import Annotated
-import io
-
-from models import Data, ProcessedDocumentData
-from services.ocr_service import process_image_to_structured_data 
-from fastapi import FastAPI, HTTPException, status, Query
-from models import Data
-from services.ocr_service import process_image_to_structured_data
-import httpx  # HTTP client
+import time
+
+_import_started = time.perf_counter()
+
+# Load .env before importing the services: they read their settings at import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
 import asyncio
+import json
+import math
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Literal
+
+import httpx  # HTTP client
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Match
+
+from models import ProcessedDocumentData, BatchProcessRequest, BatchProcessResponse, BatchItemResult, JobSubmitRequest, JobStatusResponse, PreprocessOptions
+from services.ocr_service import process_document_to_structured_data, stream_document_to_structured_data
+from services.gemini_client import GeminiUnavailableError, get_backend_pool, get_concurrency_stats
+from services.result_cache import result_cache
+from services.single_flight import pipeline_flights
+from services.perceptual_index import PERCEPTUAL_DEDUP_MODE, DuplicatePage, perceptual_index
+from services.form_templates import FORM_TEMPLATE_DIR, get_template_registry, template_stats
+from services.document_schemas import PROCESSED_DOCUMENT_ADAPTER
+from services.image_downloader import DownloadError, create_http_client, download_image
+from services.image_preprocessing import (
+    default_preprocess_options, preprocess_stats, shutdown_preprocess_executor, warm_up_preprocess_executor,
+)
+from services.document_pages import DocumentError
+from services.metrics import (
+    DOWNLOAD_SECONDS, HTTP_REQUESTS, HTTP_REQUEST_SECONDS, IMAGE_BYTES, STARTUP_SECONDS,
+    current_endpoint, render_metrics, span, timed,
+)
+from services.job_queue import JOB_QUEUE_PATH, JOB_WORKERS, JobStore, JobWorkerPool, PermanentJobError
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+# Documents processed at once by a single /process_documents call
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '8'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '500'))
+# Open Gemini connections and start the preprocessing processes before accepting traffic
+STARTUP_WARMUP_ENABLED = os.getenv('STARTUP_WARMUP_ENABLED', 'true').lower() == 'true'
+# Time running jobs get to finish on shutdown; in-flight HTTP requests are drained by the server before that
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '25'))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_started = time.perf_counter()
+    # The Gemini clients are built here rather than at import, so a missing
+    # API key fails startup with a clear error instead of the import
+    pool = get_backend_pool()
+    # One pooled client for the whole process so downloads reuse keep-alive connections
+    app.state.http_client = create_http_client()
+    app.state.job_store = JobStore(JOB_QUEUE_PATH)
+    app.state.job_pool = JobWorkerPool(app.state.job_store, _run_job, app.state.http_client, workers=JOB_WORKERS)
+    if PERCEPTUAL_DEDUP_MODE != "off":
+        await run_in_threadpool(perceptual_index.load)
+    if FORM_TEMPLATE_DIR:
+        # Load (and validate) the templates now; preprocessing processes load their own copy on first use
+        await run_in_threadpool(get_template_registry)
+
+    warmup_started = time.perf_counter()
+    app.state.warmup = {}
+    if STARTUP_WARMUP_ENABLED:
+        app.state.warmup, _ = await asyncio.gather(pool.warm_up(), warm_up_preprocess_executor())
+    warmup_seconds = time.perf_counter() - warmup_started
+    app.state.job_pool.start()
+
+    total_seconds = IMPORT_SECONDS + time.perf_counter() - startup_started
+    app.state.startup = {
+        "import_seconds": round(IMPORT_SECONDS, 3),
+        "warmup_seconds": round(warmup_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+    }
+    STARTUP_SECONDS.set(IMPORT_SECONDS, phase="import")
+    STARTUP_SECONDS.set(warmup_seconds, phase="warmup")
+    STARTUP_SECONDS.set(total_seconds, phase="total")
+    print(f"Worker {os.getpid()} ready in {total_seconds:.2f}s (import {IMPORT_SECONDS:.2f}s, warm-up {warmup_seconds:.2f}s)")
+    try:
+        yield
+    finally:
+        await app.state.job_pool.stop(SHUTDOWN_DRAIN_SECONDS)
+        app.state.job_store.close()
+        await app.state.http_client.aclose()
+        shutdown_preprocess_executor()
 
 app = FastAPI(
     title="OCR and Data Structuring Service",
-    description="API for processing document images using Gemini and structuring extracted data."
+    description="API for processing document images using Gemini and structuring extracted data.",
+    lifespan=lifespan
 )
 
+def _route_template(request: Request) -> str:
+    """Path template of the matching route, so metric labels stay low-cardinality."""
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    endpoint = _route_template(request)
+    token = current_endpoint.set(endpoint)
+    start_time = time.perf_counter()
+    status_code = 500
+    try:
+        with span(f"{request.method} {endpoint}", endpoint=endpoint):
+            response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=status_code)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start_time, endpoint=endpoint, method=request.method)
+        current_endpoint.reset(token)
+
+@app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus Metrics")
+async def metrics(request: Request):
+    # Refresh the sampled gauges (queue depth) before rendering
+    await run_in_threadpool(request.app.state.job_pool.stats)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint for monitoring and load balancers."""
-    import os
-    from datetime import datetime
-    
     # Check if required environment variables are present
     api_key_present = bool(os.getenv('GOOGLE_API_KEY'))
     
@@ -33,9 +142,22 @@ async def health_check():
         "environment": {
             "google_api_key_configured": api_key_present
         },
+        "startup": app.state.startup,
+        "warmup": app.state.warmup,
+        "gemini": get_concurrency_stats(),
+        "cache": result_cache.stats(),
+        "coalescing": pipeline_flights.stats(),
+        "near_duplicates": perceptual_index.stats(),
+        "form_templates": template_stats(),
+        "jobs": await run_in_threadpool(app.state.job_pool.stats),
+        "preprocessing": preprocess_stats.snapshot(),
         "endpoints": {
             "docs": "/docs",
-            "process_document": "/process_document"
+            "process_document": "/process_document",
+            "process_document_stream": "/process_document/stream",
+            "process_documents": "/process_documents",
+            "jobs": "/jobs",
+            "metrics": "/metrics"
         }
     }
 
@@ -43,31 +165,78 @@ async def health_check():
 async def read_root():
     return {"message": "OCR Service is running. Go to /docs for API documentation."}
 
-@app.post(
-    "/process_document",
-    response_model=ProcessedDocumentData,  # Use the new response model
-    summary="Process Document Image and Extract Structured Data"
-)
-@app.post("/process_document", summary="Process Document Image from URL")
-async def process_document_image(
-    url: str = Query(..., description="Presigned URL to the image file")
-):
+def preprocess_overrides(
+    preprocess: bool = Query(True, description="Set to false to send the original image to Gemini"),
+    grayscale: bool | None = Query(None, description="Override the default grayscale conversion"),
+    binarize: bool | None = Query(None, description="Override the default black-and-white thresholding"),
+    autocrop: bool | None = Query(None, description="Override the default margin trimming"),
+    target_bytes: int | None = Query(None, gt=0, description="Override the encoded image byte budget"),
+) -> PreprocessOptions:
+    """Per-request preprocessing overrides layered on top of the service defaults."""
+    overrides = {"grayscale": grayscale, "binarize": binarize, "autocrop": autocrop, "target_bytes": target_bytes}
+    options = default_preprocess_options().model_copy(
+        update={key: value for key, value in overrides.items() if value is not None}
+    )
+    if not preprocess:
+        options.enabled = False
+    return options
 
-    """
-    Receives a document image, performs OCR using Gemini, verifies the result,
-    and structures the extracted text into a defined JSON format.
-    """
+async def download_document(http_client: httpx.AsyncClient, url: str) -> bytes:
+    """Downloads one document, translating failures into an HTTPException."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=404, detail=f"Failed to download image from URL. Status code: {response.status_code}")
-        image_bytes = response.content
+        with timed(DOWNLOAD_SECONDS, "download"):
+            image_bytes = await download_image(http_client, url)
+        IMAGE_BYTES.observe(len(image_bytes), endpoint=current_endpoint.get(), stage="downloaded")
+        return image_bytes
+    except DownloadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
     except httpx.RequestError as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"HTTP request failed: {e}"
         )
+
+def pipeline_http_error(error: Exception) -> HTTPException:
+    """Maps an exception raised by the OCR pipeline to the HTTPException reported for it."""
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, DocumentError):
+        return HTTPException(status_code=error.status_code, detail=error.detail)
+    if isinstance(error, ValueError):
+        return HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Failed to structure data from text: {error}"
+        )
+    if isinstance(error, GeminiUnavailableError):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=error.detail,
+            headers={"Retry-After": str(math.ceil(error.retry_after))},
+        )
+    if isinstance(error, asyncio.TimeoutError):
+        return HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Timed out waiting for Gemini to process the document."
+        )
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail=f"An error occurred during processing: {error}"
+    )
+
+async def process_url(
+    http_client: httpx.AsyncClient,
+    url: str,
+    use_cache: bool = True,
+    preprocess_options: PreprocessOptions | None = None,
+    routing: bool | None = None,
+    quality: str | None = None,
+) -> tuple[ProcessedDocumentData, list[DuplicatePage]]:
+    """
+    Downloads one document and runs it through the OCR pipeline, translating
+    every failure into an HTTPException with the matching status code.
+    Returns the result and the pages flagged as probable duplicates.
+    """
+    image_bytes = await download_document(http_client, url)
     # # Read the image file bytes
     # try:
     #     image_bytes = await image.read()
@@ -78,18 +247,235 @@ async def process_document_image(
     #     )
 
     try:
-        structured_data = await process_image_to_structured_data(image_bytes)
+        structured_data, duplicates = await process_document_to_structured_data(
+            image_bytes, use_cache=use_cache, preprocess_options=preprocess_options, routing=routing, quality=quality
+        )
         # Validate and serialize using the new model
         # return ProcessedDocumentData.model_validate(structured_data)
 
-        return structured_data
-    except ValueError as e:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Failed to structure data from text: {e}"
-        )
+        return structured_data, duplicates
+    except Exception as e:
+        raise pipeline_http_error(e)
+
+class ProcessedDocumentResponse(JSONResponse):
+    """
+    JSON body of one ProcessedDocumentData, serialized straight to bytes by
+    pydantic-core. The model was validated when it was parsed, so unlike a
+    response_model route there is no second validation or encoding pass.
+    """
+
+    def render(self, content: ProcessedDocumentData) -> bytes:
+        return PROCESSED_DOCUMENT_ADAPTER.dump_json(content, by_alias=True)
+
+@app.post(
+    "/process_document",
+    response_model=ProcessedDocumentData,  # Documents the body; the route returns ProcessedDocumentResponse directly
+    response_class=ProcessedDocumentResponse,
+    summary="Process Document Image from URL and Extract Structured Data"
+)
+async def process_document_image(
+    request: Request,
+    url: str = Query(..., description="Presigned URL to the image, PDF or multi-page TIFF file"),
+    use_cache: bool = Query(True, description="Set to false to bypass the result cache and force a fresh Gemini call"),
+    routing: bool | None = Query(None, description="Classify the form type first and extract with a slimmer schema (defaults to DOCUMENT_ROUTING_ENABLED)"),
+    quality: Literal["fast", "verified"] | None = Query(None, description="\"verified\" cross-checks key fields against a concurrent raw-text OCR and re-extracts on disagreement (defaults to OCR_QUALITY_MODE)"),
+    preprocess_options: PreprocessOptions = Depends(preprocess_overrides)
+):
+
+    """
+    Receives a document image, performs OCR using Gemini, verifies the result,
+    and structures the extracted text into a defined JSON format.
+    With PERCEPTUAL_DEDUP_MODE=flag, a page that looks like a rescan of an
+    already processed one is reported in the X-Probable-Duplicate-Of
+    (result cache key) and X-Probable-Duplicate-Distance headers; for a
+    multi-page document they describe the closest match and
+    X-Probable-Duplicate-Pages lists every flagged page (1-based).
+    """
+    structured_data, duplicates = await process_url(
+        request.app.state.http_client, url,
+        use_cache=use_cache, preprocess_options=preprocess_options, routing=routing, quality=quality,
+    )
+    response = ProcessedDocumentResponse(structured_data)
+    if duplicates:
+        _, cache_key, distance = min(duplicates, key=lambda duplicate: duplicate[2])
+        response.headers["X-Probable-Duplicate-Of"] = cache_key
+        response.headers["X-Probable-Duplicate-Distance"] = str(distance)
+        response.headers["X-Probable-Duplicate-Pages"] = ",".join(str(page) for page, _, _ in duplicates)
+    return response
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/process_document/stream", summary="Process Document from URL, Streaming Fields as Server-Sent Events")
+async def process_document_stream(
+    request: Request,
+    url: str = Query(..., description="Presigned URL to the image, PDF or multi-page TIFF file"),
+    use_cache: bool = Query(True, description="Set to false to bypass the result cache and force a fresh Gemini call"),
+    preprocess_options: PreprocessOptions = Depends(preprocess_overrides)
+):
+    """
+    Streams the extraction as text/event-stream: a ``field`` event
+    (``{"path": [...], "value": ...}``) for every field as soon as Gemini has
+    written it (patient identity first, then the nested sections, in schema
+    order), then a ``result`` event with the validated ProcessedDocumentData.
+    Failures before the first event are returned as normal HTTP errors;
+    later ones as an ``error`` event with ``status_code`` and ``detail``.
+    """
+    document_bytes = await download_document(request.app.state.http_client, url)
+    events = stream_document_to_structured_data(document_bytes, use_cache=use_cache, preprocess_options=preprocess_options)
+    try:
+        # Wait for the first event so early failures still get a real status code
+        first_event = await anext(events)
     except Exception as e:
+        raise pipeline_http_error(e)
+
+    async def event_stream():
+        event, data = first_event
+        try:
+            while True:
+                if event == "result":
+                    data = data.model_dump(mode="json", by_alias=True)
+                yield _sse_event(event, data)
+                event, data = await anext(events)
+        except StopAsyncIteration:
+            pass
+        except Exception as e:
+            error = pipeline_http_error(e)
+            yield _sse_event("error", {"status_code": error.status_code, "detail": error.detail})
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def _process_batch_item(
+    http_client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    index: int,
+    url: str,
+    use_cache: bool,
+    preprocess_options: PreprocessOptions,
+    routing: bool | None,
+    quality: str | None,
+) -> BatchItemResult:
+    async with semaphore:
+        try:
+            data, _ = await process_url(
+                http_client, url, use_cache=use_cache, preprocess_options=preprocess_options, routing=routing, quality=quality
+            )
+            return BatchItemResult(index=index, url=url, status="ok", data=data)
+        except HTTPException as e:
+            return BatchItemResult(index=index, url=url, status="error", status_code=e.status_code, error=str(e.detail))
+
+@app.post(
+    "/process_documents",
+    response_model=BatchProcessResponse,
+    summary="Process a Batch of Document Images from URLs"
+)
+async def process_documents(
+    request: Request,
+    batch: BatchProcessRequest,
+    stream: bool = Query(False, description="Stream one NDJSON line per document as soon as it finishes"),
+    routing: bool | None = Query(None, description="Classify the form type first and extract with a slimmer schema (defaults to DOCUMENT_ROUTING_ENABLED)"),
+    quality: Literal["fast", "verified"] | None = Query(None, description="\"verified\" cross-checks key fields against a concurrent raw-text OCR and re-extracts on disagreement (defaults to OCR_QUALITY_MODE)"),
+    preprocess_options: PreprocessOptions = Depends(preprocess_overrides)
+):
+    """
+    Downloads and processes many documents concurrently (bounded by
+    BATCH_MAX_CONCURRENCY). A failing item is reported in its own result and
+    never aborts the rest of the batch.
+    """
+    if len(batch.urls) > BATCH_MAX_ITEMS:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"An error occurred during processing: {e}"
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch too large: {len(batch.urls)} items (limit {BATCH_MAX_ITEMS})."
+        )
+
+    http_client = request.app.state.http_client
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(_process_batch_item(http_client, semaphore, index, url, batch.use_cache, preprocess_options, routing, quality))
+        for index, url in enumerate(batch.urls)
+    ]
+
+    if not stream:
+        return BatchProcessResponse(results=await asyncio.gather(*tasks))
+
+    async def ndjson_results():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                yield result.model_dump_json(by_alias=True) + "\n"
+        finally:
+            # Client went away mid-stream: stop the work nobody will read
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(ndjson_results(), media_type="application/x-ndjson")
+
+async def _run_job(job: dict) -> str:
+    """Job handler for the worker pool: 4xx outcomes are final, everything else is retried."""
+    current_endpoint.set("/jobs")
+    options = job["options"]
+    preprocess_options = options.get("preprocess_options")
+    try:
+        data, _ = await process_url(
+            app.state.http_client, job["url"], use_cache=job["use_cache"],
+            preprocess_options=PreprocessOptions.model_validate(preprocess_options) if preprocess_options else None,
+            routing=options.get("routing"), quality=options.get("quality"),
         )
+    except HTTPException as e:
+        if e.status_code < 500:
+            raise PermanentJobError(str(e.detail))
+        raise RuntimeError(str(e.detail))
+    return data.model_dump_json(by_alias=True)
+
+def _job_response(job: dict) -> JobStatusResponse:
+    result = PROCESSED_DOCUMENT_ADAPTER.validate_json(job["result"]) if job["result"] else None
+    return JobStatusResponse(
+        id=job["id"],
+        status=job["status"],
+        url=job["url"],
+        attempts=job["attempts"],
+        error=job["error"],
+        created_at=job["created_at"],
+        started_at=job["started_at"],
+        finished_at=job["finished_at"],
+        result=result,
+    )
+
+@app.post(
+    "/jobs",
+    response_model=JobStatusResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Queue a Document for Asynchronous Processing"
+)
+async def submit_job(request: Request, job: JobSubmitRequest):
+    """
+    Persists the job and returns its id immediately. Poll GET /jobs/{id} or
+    pass callback_url to receive the finished job as a webhook. Routing,
+    quality and preprocessing overrides work as on /process_document; they
+    are resolved against the service defaults when the job is submitted.
+    """
+    preprocess_options = preprocess_overrides(
+        preprocess=job.preprocess, grayscale=job.grayscale, binarize=job.binarize,
+        autocrop=job.autocrop, target_bytes=job.target_bytes,
+    )
+    options = {"routing": job.routing, "quality": job.quality, "preprocess_options": preprocess_options.model_dump()}
+    stored = await run_in_threadpool(request.app.state.job_store.enqueue, job.url, job.use_cache, job.callback_url, options)
+    request.app.state.job_pool.notify()
+    return _job_response(stored)
+
+@app.get("/jobs/metrics", summary="Job Queue Depth and Timing Metrics")
+async def job_metrics(request: Request):
+    return await run_in_threadpool(request.app.state.job_pool.stats)
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse, summary="Get Job Status and Result")
+async def get_job(request: Request, job_id: str):
+    job = await run_in_threadpool(request.app.state.job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    return _job_response(job)
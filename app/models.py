@@ -181,3 +181,57 @@ class Data(BaseModel):
         "",
         description="The name or identifier of the technician who collected the sample."
     )
+
+class BatchProcessRequest(BaseModel):
+    """Request body for processing several documents in one call."""
+    urls: List[str] = Field(..., description="Presigned URLs of the document images to process.")
+    use_cache: bool = Field(True, description="Set to false to bypass the result cache for every item.")
+
+class BatchItemResult(BaseModel):
+    """Outcome of one document within a batch; failures are reported per item."""
+    index: int = Field(..., description="Position of the URL in the request.")
+    url: str
+    status: Literal["ok", "error"]
+    data: Optional[ProcessedDocumentData] = None
+    status_code: Optional[int] = Field(None, description="HTTP status the single-document endpoint would have returned on error.")
+    error: Optional[str] = None
+
+class BatchProcessResponse(BaseModel):
+    results: List[BatchItemResult]
+
+class JobSubmitRequest(BaseModel):
+    """Request body for queueing a document for asynchronous processing."""
+    url: str = Field(..., description="Presigned URL to the image file.")
+    use_cache: bool = Field(True, description="Set to false to bypass the result cache.")
+    callback_url: Optional[str] = Field(None, description="Optional webhook that receives the finished job as a JSON POST.")
+    routing: Optional[bool] = Field(None, description="Classify the form type first and extract with a slimmer schema (defaults to DOCUMENT_ROUTING_ENABLED).")
+    quality: Optional[Literal["fast", "verified"]] = Field(None, description="\"verified\" cross-checks key fields against a concurrent raw-text OCR (defaults to OCR_QUALITY_MODE).")
+    preprocess: bool = Field(True, description="Set to false to send the original image to Gemini.")
+    grayscale: Optional[bool] = Field(None, description="Override the default grayscale conversion.")
+    binarize: Optional[bool] = Field(None, description="Override the default black-and-white thresholding.")
+    autocrop: Optional[bool] = Field(None, description="Override the default margin trimming.")
+    target_bytes: Optional[int] = Field(None, gt=0, description="Override the encoded image byte budget.")
+
+class JobStatusResponse(BaseModel):
+    id: str
+    status: Literal["queued", "running", "succeeded", "failed"]
+    url: str
+    attempts: int
+    error: Optional[str] = None
+    created_at: float = Field(..., description="Unix timestamp when the job was submitted.")
+    started_at: Optional[float] = Field(None, description="Unix timestamp of the latest attempt.")
+    finished_at: Optional[float] = None
+    result: Optional[ProcessedDocumentData] = None
+
+class PreprocessOptions(BaseModel):
+    """Image preprocessing settings; service defaults come from PREPROCESS_* environment variables."""
+    enabled: bool = True
+    max_width: int = Field(1600, gt=0, description="Maximum output width in pixels.")
+    max_height: int = Field(2200, gt=0, description="Maximum output height in pixels.")
+    max_pixels: int = Field(1600 * 2200, gt=0, description="Maximum output width x height.")
+    target_bytes: int = Field(500_000, gt=0, description="Byte budget the encoder aims for.")
+    min_quality: int = Field(50, ge=1, le=95)
+    max_quality: int = Field(85, ge=1, le=95)
+    grayscale: bool = True
+    binarize: bool = Field(False, description="Otsu-threshold to black and white (encoded as PNG).")
+    autocrop: bool = Field(True, description="Trim uniform page margins.")
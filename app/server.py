@@ -0,0 +1,74 @@
+# server.py
+"""
+Production entry point: serves main:app with uvicorn, one worker process per
+usable CPU by default.
+
+    python server.py
+
+Each worker is an asyncio process that keeps many Gemini calls and
+downloads in flight at once, so more workers than cores only adds memory
+and splits the rate-limit quotas thinner. Workers build their clients and
+warm them up in the app's lifespan before they accept connections. On
+SIGTERM the listener closes, in-flight requests get up to
+SHUTDOWN_DRAIN_SECONDS to finish, then running jobs get the same again.
+"""
+import os
+import math
+import uvicorn
+
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8000'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'info')
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '25'))
+# Optional per-worker cap on concurrent connections; beyond it uvicorn answers 503 instead of queueing
+SERVER_LIMIT_CONCURRENCY = int(os.getenv('SERVER_LIMIT_CONCURRENCY', '0')) or None
+# Longer than a typical load balancer idle timeout, so the balancer closes idle connections first
+SERVER_KEEP_ALIVE_SECONDS = int(os.getenv('SERVER_KEEP_ALIVE_SECONDS', '75'))
+
+
+def usable_cpus() -> int:
+    """CPUs this process may use, honouring the affinity mask and a cgroup v2 CPU quota (containers)."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def configure_workers() -> int:
+    """
+    Pick the worker count (WEB_CONCURRENCY, else usable CPUs) and publish it
+    through the environment the workers inherit. gemini_client divides the
+    per-key quotas by WEB_CONCURRENCY. Unless PREPROCESS_WORKERS is set, the
+    CPUs are also split between the workers' preprocessing pools.
+    """
+    cpus = usable_cpus()
+    workers = int(os.getenv('WEB_CONCURRENCY', '0')) or cpus
+    os.environ['WEB_CONCURRENCY'] = str(workers)
+    os.environ.setdefault('PREPROCESS_WORKERS', str(max(1, cpus // workers)))
+    return workers
+
+
+def main() -> None:
+    workers = configure_workers()
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=workers,
+        log_level=LOG_LEVEL,
+        limit_concurrency=SERVER_LIMIT_CONCURRENCY,
+        timeout_keep_alive=SERVER_KEEP_ALIVE_SECONDS,
+        timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS,
+    )
+
+
+if __name__ == "__main__":
+    main()
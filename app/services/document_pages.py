@@ -0,0 +1,148 @@
+# app/services/document_pages.py
+import os
+import io
+from collections import Counter
+from typing import Iterator
+from PIL import Image
+from models import ProcessedDocumentData
+
+# Resolution PDF pages are rasterized at before preprocessing
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', '150'))
+DOCUMENT_MAX_PAGES = int(os.getenv('DOCUMENT_MAX_PAGES', '50'))
+# Pages of one document rendered and sent to Gemini at the same time
+PAGE_MAX_CONCURRENCY = int(os.getenv('PAGE_MAX_CONCURRENCY', '4'))
+
+MULTIPAGE_MIME_TYPES = ("application/pdf", "image/tiff")
+# What pymupdf (RuntimeError subclasses) and PIL raise for corrupt or truncated files
+DECODE_ERRORS = (RuntimeError, OSError, ValueError, EOFError, TypeError, Image.DecompressionBombError)
+
+
+class DocumentError(Exception):
+    """Raised when a document cannot be split into pages; carries the HTTP status to report."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_mime_type(data: bytes) -> str | None:
+    """Identify the document format from its magic bytes, ignoring whatever the sender claimed."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"%PDF-"):
+        return "application/pdf"
+    if data.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1", b"ftypmsf1"):
+        return "image/heic"
+    return None
+
+
+def _unreadable(mime_type: str, error: Exception) -> DocumentError:
+    kind = "PDF" if mime_type == "application/pdf" else "TIFF"
+    return DocumentError(422, f"Could not read the {kind} document: {error}")
+
+
+def page_count(data: bytes, mime_type: str) -> int:
+    """Number of pages; raises DocumentError(422) when the file cannot be parsed."""
+    try:
+        if mime_type == "application/pdf":
+            import pymupdf
+            with pymupdf.open(stream=data, filetype="pdf") as doc:
+                return doc.page_count
+        if mime_type == "image/tiff":
+            with Image.open(io.BytesIO(data)) as img:
+                return getattr(img, "n_frames", 1)
+    except DECODE_ERRORS as e:
+        raise _unreadable(mime_type, e) from e
+    return 1
+
+
+def iter_pages(data: bytes, mime_type: str) -> Iterator[tuple[bytes, str]]:
+    """
+    Lazily yield (page_bytes, mime_type) for every page of a PDF or TIFF.
+    Each page is rendered only when the consumer asks for it, so a long
+    document never holds more than one decoded bitmap per pending page.
+    A page that cannot be decoded raises DocumentError(422).
+    """
+    if mime_type == "application/pdf":
+        import pymupdf
+        try:
+            doc = pymupdf.open(stream=data, filetype="pdf")
+        except DECODE_ERRORS as e:
+            raise _unreadable(mime_type, e) from e
+        with doc:
+            for index in range(doc.page_count):
+                try:
+                    page_bytes = doc[index].get_pixmap(dpi=PDF_RENDER_DPI).tobytes("jpeg", jpg_quality=90)
+                except DECODE_ERRORS as e:
+                    raise _unreadable(mime_type, e) from e
+                yield page_bytes, "image/jpeg"
+    elif mime_type == "image/tiff":
+        try:
+            img = Image.open(io.BytesIO(data))
+            frames = getattr(img, "n_frames", 1)
+        except DECODE_ERRORS as e:
+            raise _unreadable(mime_type, e) from e
+        with img:
+            for index in range(frames):
+                try:
+                    img.seek(index)
+                    frame = img.convert("L") if img.mode in ("1", "L", "I;16") else img.convert("RGB")
+                    buffer = io.BytesIO()
+                    # Fax frames are bilevel: PNG keeps them tiny and lossless
+                    frame.save(buffer, format="PNG", optimize=img.mode == "1")
+                except DECODE_ERRORS as e:
+                    raise _unreadable(mime_type, e) from e
+                yield buffer.getvalue(), "image/png"
+    else:
+        yield data, mime_type
+
+
+def _merge_values(values: list):
+    first = values[0]
+    if isinstance(first, bool):
+        return any(values)
+    if isinstance(first, str):
+        return next((value for value in values if value and value.strip()), first)
+    if isinstance(first, dict):
+        return {key: _merge_values([value[key] for value in values]) for key in first}
+    if isinstance(first, list):
+        merged = []
+        by_package = {}
+        for value in values:
+            for item in value:
+                package_name = item.get("package_name") if isinstance(item, dict) else None
+                if package_name is not None:
+                    # Same test option seen on several pages: selected if any page ticked it
+                    if package_name in by_package:
+                        by_package[package_name]["is_selected"] |= item["is_selected"]
+                        continue
+                    item = dict(item)
+                    by_package[package_name] = item
+                if item not in merged:
+                    merged.append(item)
+        return merged
+    return next((value for value in values if value is not None), first)
+
+
+def merge_page_results(pages: list[ProcessedDocumentData]) -> ProcessedDocumentData:
+    """
+    Fold per-page extractions into one document: the first non-empty string
+    wins, checkboxes are selected if any page selected them, lists are
+    concatenated without duplicates, and document_name is a majority vote
+    (ties go to the earliest page).
+    """
+    if len(pages) == 1:
+        return pages[0]
+    dumps = [page.model_dump(by_alias=True) for page in pages]
+    merged = _merge_values(dumps)
+    names = [dump["document_name"] for dump in dumps]
+    votes = Counter(names)
+    merged["document_name"] = max(names, key=votes.__getitem__)
+    return ProcessedDocumentData.model_validate(merged)
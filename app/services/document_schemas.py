@@ -0,0 +1,272 @@
+# app/services/document_schemas.py
+import copy
+import json
+import types
+import typing
+import hashlib
+from functools import lru_cache
+from typing import Literal, get_args, get_origin
+from pydantic import BaseModel, Field, TypeAdapter, create_model
+from models import ProcessedDocumentData
+
+DocumentName = Literal["hereditary_cancer", "gene_mutation", "prenatal_screening"]
+
+# Sections of ProcessedDocumentData that only a given form type ever fills in
+DOCUMENT_SECTIONS: dict[str, tuple[str, ...]] = {
+    "prenatal_screening": ("non_invasive_prenatal_testing", "additional_selection_notes"),
+    "hereditary_cancer": ("hereditary_cancer",),
+    "gene_mutation": ("gene_mutation_testing",),
+}
+ALL_SECTIONS = {section for sections in DOCUMENT_SECTIONS.values() for section in sections}
+# Built once per process: validate_json and dump_json on it run entirely in pydantic-core
+PROCESSED_DOCUMENT_ADAPTER = TypeAdapter(ProcessedDocumentData)
+
+
+class DocumentClassification(BaseModel):
+    """Response schema of the cheap classification call."""
+    document_name: DocumentName = Field(..., description="Which of the three requisition forms this is")
+
+
+def _unwrap_optional(annotation):
+    if get_origin(annotation) in (typing.Union, types.UnionType):
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def empty_value(annotation):
+    """JSON value an unfilled field of this type should have: "", False, [] or a nested empty object."""
+    annotation = _unwrap_optional(annotation)
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return empty_dict(annotation)
+    if annotation is bool:
+        return False
+    if get_origin(annotation) in (list, typing.List):
+        return []
+    return ""
+
+
+def empty_dict(model: type[BaseModel]) -> dict:
+    """Aliased dict for ``model`` with every field set to its empty value."""
+    return {
+        field.alias or name: empty_value(field.annotation)
+        for name, field in model.model_fields.items()
+    }
+
+
+@lru_cache(maxsize=None)
+def slim_model_for(document_name: str) -> type[BaseModel]:
+    """
+    Extraction schema for one form type: the shared patient/order fields
+    plus only that type's sections. document_name itself is dropped since
+    the router already knows it.
+    """
+    fields = {}
+    for name, field in ProcessedDocumentData.model_fields.items():
+        if name == "document_name":
+            continue
+        if name in ALL_SECTIONS and name not in DOCUMENT_SECTIONS[document_name]:
+            continue
+        fields[name] = (field.annotation, field)
+    model_name = "".join(part.title() for part in document_name.split("_")) + "Document"
+    return create_model(model_name, **fields)
+
+
+def _field_by_alias(model: type[BaseModel], key: str):
+    for name, field in model.model_fields.items():
+        if (field.alias or name) == key:
+            return name, field
+    raise KeyError(f"{model.__name__} has no field {key!r}")
+
+
+def resolve_field_path(path: str, model: type[BaseModel] = ProcessedDocumentData):
+    """
+    Annotation of the field at a dotted path of JSON aliases, e.g.
+    ``hereditary_cancer.15_hereditary_cancer_types_more_care.is_selected``.
+    After a list of models the next segment selects an item by its first
+    field (``test_options.NIPT 24.is_selected``). Raises KeyError.
+    """
+    annotation = model
+    segments = path.split(".")
+    index = 0
+    while index < len(segments):
+        annotation = _unwrap_optional(annotation)
+        if get_origin(annotation) in (list, typing.List):
+            annotation = get_args(annotation)[0]
+            index += 1  # the item selector
+            continue
+        if not (isinstance(annotation, type) and issubclass(annotation, BaseModel)):
+            raise KeyError(f"{path!r} goes below a {annotation} field")
+        annotation = _field_by_alias(annotation, segments[index])[1].annotation
+        index += 1
+    return _unwrap_optional(annotation)
+
+
+def path_crosses_list(path: str, model: type[BaseModel] = ProcessedDocumentData) -> bool:
+    """Whether a dotted alias path runs through a list (which model_without cannot drop from)."""
+    annotation = model
+    for segment in path.split(".")[:-1]:
+        annotation = _unwrap_optional(annotation)
+        if get_origin(annotation) in (list, typing.List):
+            return True
+        annotation = _field_by_alias(annotation, segment)[1].annotation
+    return False
+
+
+def get_field_path(data: dict, path: str):
+    """Value at a dotted alias path in dumped (by_alias) data, or None when it is missing."""
+    value = data
+    for segment in path.split("."):
+        if isinstance(value, list):
+            value = next((item for item in value if isinstance(item, dict) and next(iter(item.values()), None) == segment), None)
+        elif isinstance(value, dict):
+            value = value.get(segment)
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+
+def set_field_path(data: dict, path: str, value, model: type[BaseModel] = ProcessedDocumentData) -> None:
+    """Set a dotted alias path in dumped data; a missing list item is appended (its other fields empty)."""
+    *parents, leaf = path.split(".")
+    annotation = model
+    container = data
+    for segment in parents:
+        annotation = _unwrap_optional(annotation)
+        if get_origin(annotation) in (list, typing.List):
+            annotation = get_args(annotation)[0]
+            item = next((item for item in container if next(iter(item.values()), None) == segment), None)
+            if item is None:
+                item = empty_dict(annotation)
+                item[next(iter(item))] = segment
+                container.append(item)
+            container = item
+        else:
+            annotation = _field_by_alias(annotation, segment)[1].annotation
+            container = container.setdefault(segment, empty_value(annotation))
+    container[leaf] = value
+
+
+def _model_leaf(instance: BaseModel, path: str, create: bool) -> tuple[BaseModel, str] | None:
+    """Model holding the leaf of a dotted alias path and the leaf's field name; None when missing unless ``create``."""
+    *parents, leaf = path.split(".")
+    annotation = type(instance)
+    container = instance
+    for segment in parents:
+        annotation = _unwrap_optional(annotation)
+        if get_origin(annotation) in (list, typing.List):
+            annotation = get_args(annotation)[0]
+            key = next(iter(annotation.model_fields))
+            item = next((item for item in container if getattr(item, key) == segment), None)
+            if item is None:
+                if not create:
+                    return None
+                data = empty_dict(annotation)
+                data[next(iter(data))] = segment
+                item = annotation.model_validate(data)
+                container.append(item)
+            container = item
+        else:
+            name, field = _field_by_alias(annotation, segment)
+            annotation = field.annotation
+            child = getattr(container, name)
+            if child is None:
+                if not create:
+                    return None
+                child = empty_value(annotation)
+                model = _unwrap_optional(annotation)
+                if isinstance(model, type) and issubclass(model, BaseModel):
+                    child = model.model_validate(child)
+                setattr(container, name, child)
+            container = child
+    return container, _field_by_alias(_unwrap_optional(annotation), leaf)[0]
+
+
+def get_model_field_path(instance: BaseModel, path: str):
+    """get_field_path on a model instance, without dumping it."""
+    found = _model_leaf(instance, path, create=False)
+    return None if found is None else getattr(*found)
+
+
+def set_model_field_path(instance: BaseModel, path: str, value) -> None:
+    """set_field_path on a model instance, assigned in place instead of dumping and re-validating the model."""
+    container, name = _model_leaf(instance, path, create=True)
+    setattr(container, name, value)
+
+
+@lru_cache(maxsize=256)
+def model_without(model: type[BaseModel], paths: frozenset[str]) -> type[BaseModel]:
+    """
+    Copy of ``model`` without the fields at the given dotted alias paths,
+    so the model is not asked for values that are already known. Nested
+    models are copied as needed and dropped once empty; paths that do not
+    exist or run through a list are left alone.
+    """
+    nested: dict[str, set[str]] = {}
+    for path in paths:
+        head, _, rest = path.partition(".")
+        nested.setdefault(head, set()).add(rest)
+    fields = {}
+    for name, field in model.model_fields.items():
+        rests = nested.get(field.alias or name)
+        if rests is None:
+            fields[name] = (field.annotation, field)
+            continue
+        if "" in rests:
+            continue
+        annotation = _unwrap_optional(field.annotation)
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            reduced = model_without(annotation, frozenset(rests))
+            if reduced.model_fields:
+                fields[name] = (reduced, field)
+        else:
+            fields[name] = (field.annotation, field)
+    # Distinct names, since differently reduced copies of one model can share a schema
+    suffix = hashlib.sha256("\n".join(sorted(paths)).encode()).hexdigest()[:8]
+    return create_model(f"{model.__name__}_{suffix}", **fields)
+
+
+def _deep_update(target: dict, update: dict) -> None:
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _deep_update(target[key], value)
+        else:
+            target[key] = value
+
+
+@lru_cache(maxsize=256)
+def _json_schema(model: type[BaseModel]) -> dict:
+    return model.model_json_schema()
+
+
+def response_json_schema(model: type[BaseModel]) -> dict:
+    """
+    JSON schema of a reduced response model, passed to the SDK instead of
+    the model: Gemini gets the same schema, but response.parsed stays plain
+    JSON, so expand_to_full validates it once into ProcessedDocumentData
+    rather than first into the reduced model.
+    """
+    # The SDK rewrites the schema in place
+    return copy.deepcopy(_json_schema(model))
+
+
+@lru_cache(maxsize=None)
+def _empty_document_json() -> str:
+    # Loading this is ~10x cheaper than walking the model's annotations again
+    return json.dumps(empty_dict(ProcessedDocumentData))
+
+
+def expand_to_full(partial_data: dict, document_name: str | None = None) -> ProcessedDocumentData:
+    """
+    Fill whatever a reduced schema left out (whole sections or single
+    fields) of the model's raw JSON with empty values and validate the
+    full model, in one pass. Raises pydantic's ValidationError.
+    """
+    data = json.loads(_empty_document_json())
+    _deep_update(data, partial_data)
+    if document_name is not None:
+        data["document_name"] = document_name
+    return PROCESSED_DOCUMENT_ADAPTER.validate_python(data)
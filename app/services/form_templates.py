@@ -0,0 +1,559 @@
+# app/services/form_templates.py
+import io
+import os
+import json
+import hashlib
+from functools import lru_cache
+from typing import get_args
+import numpy as np
+from PIL import Image, ImageOps
+from services.document_schemas import DocumentName, resolve_field_path
+from services.image_preprocessing import run_cpu_bound
+from services.metrics import CHECKBOX_READS, FORM_TEMPLATE_MATCHES, FORM_TEMPLATE_SECONDS, IMAGE_BYTES, current_endpoint, timed
+
+# Directory of COCO-format template files (see README); unset disables template matching
+FORM_TEMPLATE_DIR = os.getenv('FORM_TEMPLATE_DIR')
+# Send only the annotated regions of a matched page, packed into one composite image
+FORM_ROI_ENABLED = os.getenv('FORM_ROI_ENABLED', 'true').lower() == 'true'
+# Correlation (0-1) between the aligned page and the blank template needed to count as that form
+FORM_ALIGN_MIN_SCORE = float(os.getenv('FORM_ALIGN_MIN_SCORE', '0.5'))
+# Margin added around every region, as a fraction of the page width, to absorb residual misalignment
+FORM_REGION_PADDING = float(os.getenv('FORM_REGION_PADDING', '0.01'))
+# White space between regions in the composite, in page pixels
+FORM_COMPOSITE_GAP = int(os.getenv('FORM_COMPOSITE_GAP', '24'))
+# What to do with the template's checkbox annotations: "off", "crosscheck" (read them
+# locally and count disagreements with the model) or "override" (the local read wins)
+FORM_CHECKBOX_MODE = os.getenv('FORM_CHECKBOX_MODE', 'crosscheck').lower()
+if FORM_CHECKBOX_MODE not in ("off", "crosscheck", "override"):
+    raise ValueError(f"FORM_CHECKBOX_MODE must be off, crosscheck or override, got {FORM_CHECKBOX_MODE!r}")
+# In override mode, also leave the confidently read checkboxes out of the model's response schema
+FORM_CHECKBOX_DROP_FROM_SCHEMA = os.getenv('FORM_CHECKBOX_DROP_FROM_SCHEMA', 'false').lower() == 'true'
+# Ink fraction inside a box, above the blank template's, from which it counts as ticked
+FORM_CHECKBOX_FILLED = float(os.getenv('FORM_CHECKBOX_FILLED', '0.12'))
+# ... and at or below which it counts as empty; in between the box is left to the model
+FORM_CHECKBOX_EMPTY = float(os.getenv('FORM_CHECKBOX_EMPTY', '0.04'))
+
+REGION_CATEGORY = "region"
+CHECKBOX_CATEGORY = "checkbox"
+# Width of the thumbnails pages are aligned on
+ALIGN_WIDTH = 256
+# Ink is max-pooled from a POOL x larger thumbnail, so thin ruled lines survive the reduction
+POOL = 4
+# Darkness (fraction of the paper brightness) below which a pixel is paper texture or noise
+INK_FLOOR = 0.25
+# Rows/columns with less mean ink than this are margin when locating the printed area
+BBOX_MIN_INK = 0.01
+# Scale range between a page and its template that alignment accepts
+MIN_SCALE, MAX_SCALE = 0.5, 2.0
+# Largest page rotation looked for, in degrees
+MAX_SKEW_DEGREES = 5.0
+COMPOSITE_QUALITY = 92
+# Checkboxes are compared at CHECKBOX_SIZE pixels square, whatever their size on the page
+CHECKBOX_SIZE = 32
+# Template patch: the box plus this border, so its outline and the paper around it are matched
+CHECKBOX_BORDER = 8
+# How far (in box pixels) the box is looked for around its aligned position
+CHECKBOX_SEARCH = 32
+# Interior read for ink: the box without this inset, which keeps the printed outline out
+CHECKBOX_INSET = 7
+# Normalized correlation with the blank box below which the box is taken as not found (covered, cut off)
+CHECKBOX_MIN_MATCH = 0.5
+
+
+class TemplateRegion:
+    """One COCO annotation of a template: a named box in template pixels."""
+    __slots__ = ("name", "category", "bbox", "attributes")
+
+    def __init__(self, name: str, category: str, bbox: tuple[float, float, float, float], attributes: dict):
+        self.name = name
+        self.category = category
+        self.bbox = bbox
+        self.attributes = attributes
+
+
+class FormTemplate:
+    """
+    A blank form of one document type: its reference image (reduced to an
+    ink map for alignment) and the annotated regions, in reading order.
+    """
+    __slots__ = (
+        "document_name", "width", "height", "annotations", "ink", "ink_bbox", "fingerprint",
+        "checkbox_patches", "checkbox_norms", "checkbox_baseline",
+    )
+
+    def __init__(self, document_name: str, reference: Image.Image, annotations: list[TemplateRegion], fingerprint: str):
+        self.document_name = document_name
+        self.width, self.height = reference.size
+        self.annotations = annotations
+        self.ink = _ink_map(reference, _align_size(reference.size))
+        self.ink_bbox = _ink_bbox(self.ink)
+        if self.ink_bbox is None:
+            raise ValueError(f"Template image for {document_name} is blank")
+        self.fingerprint = fingerprint
+        # The blank boxes as matched against pages (zero mean), and the ink already inside them
+        boxes = [checkbox.bbox for checkbox in self.checkboxes]
+        patches = _darkness(_sample_boxes(reference, boxes, (1.0, 0.0, 0.0, 0.0, 1.0, 0.0), CHECKBOX_BORDER))
+        self.checkbox_patches = patches - patches.mean(axis=(1, 2), keepdims=True)
+        self.checkbox_norms = np.sqrt((self.checkbox_patches ** 2).sum(axis=(1, 2)))
+        self.checkbox_baseline = _interior_fill(patches, np.zeros(len(boxes), np.int64), np.zeros(len(boxes), np.int64), CHECKBOX_BORDER)
+
+    @property
+    def regions(self) -> list[TemplateRegion]:
+        return [annotation for annotation in self.annotations if annotation.category == REGION_CATEGORY]
+
+    @property
+    def checkboxes(self) -> list[TemplateRegion]:
+        return [annotation for annotation in self.annotations if annotation.category == CHECKBOX_CATEGORY]
+
+
+class AlignedPage:
+    """
+    A page matched to a template. ``transform`` is the affine map (a, b, c,
+    d, e, f) from template to page pixels: ``x' = a*x + b*y + c``,
+    ``y' = d*x + e*y + f``; ``skew`` is the page's rotation in degrees and
+    ``score`` the correlation of the aligned ink maps.
+    """
+    __slots__ = ("template", "image", "score", "skew", "transform")
+
+    def __init__(self, template: FormTemplate, image: Image.Image, score: float, skew: float, transform: tuple[float, ...]):
+        self.template = template
+        self.image = image
+        self.score = score
+        self.skew = skew
+        self.transform = transform
+
+    def to_page(self, bbox, padding: float = 0.0) -> tuple[int, int, int, int]:
+        """
+        Page box (left, top, right, bottom) enclosing a COCO ``[x, y, w, h]``
+        template box, grown by ``padding`` x page width and clipped to the page.
+        """
+        x, y, w, h = bbox
+        a, b, c, d, e, f = self.transform
+        corners = [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
+        xs = [a * cx + b * cy + c for cx, cy in corners]
+        ys = [d * cx + e * cy + f for cx, cy in corners]
+        margin = padding * self.image.width
+        return (
+            max(0, int(min(xs) - margin)), max(0, int(min(ys) - margin)),
+            min(self.image.width, int(round(max(xs) + margin))), min(self.image.height, int(round(max(ys) + margin))),
+        )
+
+
+class FormMatch:
+    """
+    Result of prepare_form_image, small enough to return from the process
+    pool. ``checkboxes`` maps each checkbox's field path to True (ticked),
+    False (empty) or None (could not be read confidently).
+    """
+    __slots__ = ("document_name", "score", "composite", "mime_type", "checkboxes")
+
+    def __init__(
+        self, document_name: str, score: float, composite: bytes | None = None, mime_type: str | None = None,
+        checkboxes: dict[str, bool | None] | None = None,
+    ):
+        self.document_name = document_name
+        self.score = score
+        self.composite = composite
+        self.mime_type = mime_type
+        self.checkboxes = checkboxes or {}
+
+    def confident_checkboxes(self) -> dict[str, bool]:
+        return {field: value for field, value in self.checkboxes.items() if value is not None}
+
+
+def _align_size(size: tuple[int, int]) -> tuple[int, int]:
+    width, height = size
+    return ALIGN_WIDTH, max(1, round(height * ALIGN_WIDTH / width))
+
+
+def _ink_map(gray: Image.Image, size: tuple[int, int]) -> np.ndarray:
+    """Ink amount (0 = paper, 1 = black) of a page reduced to ``size``, max-pooled and lightly blurred."""
+    width, height = size
+    detail = gray.convert("L").resize((width * POOL, height * POOL), Image.Resampling.BOX)
+    paper = max(int(np.searchsorted(np.cumsum(detail.histogram()), 0.9 * width * height * POOL * POOL)), 1)
+    # Darkest pixel of every POOL x POOL block
+    darkest = np.asarray(detail).reshape(height, POOL, width, POOL).min(axis=(1, 3)).astype(np.float32)
+    ink = np.clip((paper - darkest) / paper, 0.0, 1.0)
+    ink[ink < INK_FLOOR] = 0.0
+    # 3x3 mean, so alignment and scoring tolerate a pixel of error
+    padded = np.pad(ink, 1)
+    return sum(padded[y:y + height, x:x + width] for y in range(3) for x in range(3)) / 9.0
+
+
+def _ink_bbox(ink: np.ndarray) -> tuple[int, int, int, int] | None:
+    """(left, top, right, bottom) of the printed area, ignoring near-empty margin rows and columns."""
+    rows = np.flatnonzero(ink.mean(axis=1) > BBOX_MIN_INK)
+    columns = np.flatnonzero(ink.mean(axis=0) > BBOX_MIN_INK)
+    if len(rows) < 2 or len(columns) < 2:
+        return None
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+
+def _compose(outer: tuple[float, ...], inner: tuple[float, ...]) -> tuple[float, ...]:
+    """Affine map applying ``inner`` first, then ``outer``."""
+    a1, b1, c1, d1, e1, f1 = outer
+    a2, b2, c2, d2, e2, f2 = inner
+    return (
+        a1 * a2 + b1 * d2, a1 * b2 + b1 * e2, a1 * c2 + b1 * f2 + c1,
+        d1 * a2 + e1 * d2, d1 * b2 + e1 * e2, d1 * c2 + e1 * f2 + f1,
+    )
+
+
+def _rotation(degrees: float, center: tuple[float, float]) -> tuple[float, ...]:
+    angle = np.radians(degrees)
+    cos, sin = float(np.cos(angle)), float(np.sin(angle))
+    cx, cy = center
+    return (cos, -sin, cx - cos * cx + sin * cy, sin, cos, cy - sin * cx - cos * cy)
+
+
+def _warp(ink: np.ndarray, size: tuple[int, int], transform: tuple[float, ...]) -> np.ndarray:
+    """Resample ``ink`` into a frame of ``size``, where ``transform`` maps that frame's coordinates to ``ink``'s."""
+    warped = Image.fromarray(ink, mode="F").transform(
+        size, Image.Transform.AFFINE, transform, resample=Image.Resampling.BILINEAR,
+    )
+    return np.asarray(warped, dtype=np.float32)
+
+
+def estimate_skew(ink: np.ndarray) -> float:
+    """
+    Page rotation in degrees (within MAX_SKEW_DEGREES), by projection
+    profile: ruled lines and text rows give the most concentrated row
+    profile when the page is upright. For these small angles the rotation
+    is taken as a shear, so each candidate is one weighted bincount.
+    Searched coarse (0.5 degree) then fine (0.1).
+    """
+    ys, xs = np.nonzero(ink)
+    if not len(ys):
+        return 0.0
+    weights = ink[ys, xs]
+    xs = xs - ink.shape[1] / 2
+
+    def concentration(degrees: float) -> float:
+        rows = ys - xs * np.tan(np.radians(degrees))
+        rows -= rows.min()
+        # Split each pixel's weight between the two nearest rows
+        below = rows.astype(np.int64)
+        fraction = rows - below
+        profile = np.bincount(below, weights * (1 - fraction), len(ink) * 2) + np.bincount(below + 1, weights * fraction, len(ink) * 2)
+        return float(np.dot(profile, profile))
+
+    coarse = max(np.arange(-MAX_SKEW_DEGREES, MAX_SKEW_DEGREES + 0.01, 0.5), key=concentration)
+    return round(float(max(np.arange(coarse - 0.4, coarse + 0.41, 0.1), key=concentration)), 2)
+
+
+def _phase_shift(reference: np.ndarray, moving: np.ndarray) -> tuple[int, int]:
+    """Translation (dx, dy) such that moving shifted by it best matches reference, by phase correlation."""
+    cross = np.fft.rfft2(reference) * np.conj(np.fft.rfft2(moving))
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.irfft2(cross, s=reference.shape)
+    dy, dx = np.unravel_index(int(np.argmax(correlation)), correlation.shape)
+    height, width = reference.shape
+    return (dx - width if dx > width // 2 else dx), (dy - height if dy > height // 2 else dy)
+
+
+def _correlation(a: np.ndarray, b: np.ndarray) -> float:
+    a = a.ravel() - a.mean()
+    b = b.ravel() - b.mean()
+    denominator = float(np.sqrt((a * a).sum() * (b * b).sum()))
+    return float((a * b).sum()) / denominator if denominator else 0.0
+
+
+def align_to_template(image: Image.Image, page_ink: np.ndarray, template: FormTemplate, skew: float = 0.0) -> AlignedPage | None:
+    """
+    Align a page to a template on thumbnails: undo the page's ``skew``, map
+    the printed area's bounding box onto the template's (scale and offset
+    per axis), then remove the residual translation by phase correlation.
+    """
+    size = (page_ink.shape[1], page_ink.shape[0])
+    upright_to_page = _rotation(skew, (size[0] / 2, size[1] / 2))
+    page_bbox = _ink_bbox(_warp(page_ink, size, upright_to_page))
+    if page_bbox is None:
+        return None
+    left, top, right, bottom = template.ink_bbox
+    page_left, page_top, page_right, page_bottom = page_bbox
+    scale_x = (page_right - page_left) / (right - left)
+    scale_y = (page_bottom - page_top) / (bottom - top)
+    if not (MIN_SCALE <= scale_x <= MAX_SCALE and MIN_SCALE <= scale_y <= MAX_SCALE):
+        return None
+    offset_x = page_left - scale_x * left
+    offset_y = page_top - scale_y * top
+
+    template_size = (template.ink.shape[1], template.ink.shape[0])
+    to_page = _compose(upright_to_page, (scale_x, 0.0, offset_x, 0.0, scale_y, offset_y))
+    dx, dy = _phase_shift(template.ink, _warp(page_ink, template_size, to_page))
+    to_page = _compose(upright_to_page, (scale_x, 0.0, offset_x - scale_x * dx, 0.0, scale_y, offset_y - scale_y * dy))
+    score = _correlation(template.ink, _warp(page_ink, template_size, to_page))
+
+    # Full-resolution template pixels -> template thumbnail -> page thumbnail -> page pixels
+    to_thumbnail = (template_size[0] / template.width, 0.0, 0.0, 0.0, template_size[1] / template.height, 0.0)
+    to_full_page = (image.width / size[0], 0.0, 0.0, 0.0, image.height / size[1], 0.0)
+    transform = _compose(to_full_page, _compose(to_page, to_thumbnail))
+    return AlignedPage(template, image, score, skew, transform)
+
+
+def match_template(image: Image.Image, templates: tuple[FormTemplate, ...] | None = None) -> AlignedPage | None:
+    """Best-aligned template for a page image, or None when no template reaches FORM_ALIGN_MIN_SCORE."""
+    templates = get_template_registry() if templates is None else templates
+    if not templates:
+        return None
+    page_ink = _ink_map(image, _align_size(image.size))
+    skew = estimate_skew(page_ink)
+    best = None
+    for template in templates:
+        aligned = align_to_template(image, page_ink, template, skew)
+        if aligned is not None and (best is None or aligned.score > best.score):
+            best = aligned
+    if best is None or best.score < FORM_ALIGN_MIN_SCORE:
+        return None
+    return best
+
+
+def compose_regions(aligned: AlignedPage, padding: float = FORM_REGION_PADDING, gap: int = FORM_COMPOSITE_GAP) -> Image.Image | None:
+    """
+    Crop the template's regions from the page and pack them, in template
+    order, into rows no wider than the widest region (next-fit shelf
+    packing). Crops keep the page's resolution, so text stays as legible
+    as on the full page while the blank parts of the form are left out.
+    """
+    crops = []
+    for region in aligned.template.regions:
+        box = aligned.to_page(region.bbox, padding)
+        if box[2] > box[0] and box[3] > box[1]:
+            crops.append(aligned.image.crop(box))
+    if not crops:
+        return None
+
+    width = max(crop.width for crop in crops)
+    placements = []
+    x = y = row_height = 0
+    for crop in crops:
+        if x and x + crop.width > width:
+            x, y, row_height = 0, y + row_height + gap, 0
+        placements.append((crop, x, y))
+        x += crop.width + gap
+        row_height = max(row_height, crop.height)
+    composite = Image.new(aligned.image.mode, (width, y + row_height), "white")
+    for crop, x, y in placements:
+        composite.paste(crop, (x, y))
+    return composite
+
+
+def _area(aligned: AlignedPage, width: float, height: float) -> float:
+    """Page area of the bounding box of a ``width`` x ``height`` template box (unclipped)."""
+    a, b, c, d, e, f = aligned.transform
+    return (abs(a) * width + abs(b) * height) * (abs(d) * width + abs(e) * height)
+
+
+def _sample_boxes(image: Image.Image, boxes: list, transform: tuple[float, ...], border: int) -> np.ndarray:
+    """
+    Grayscale window around each template box ``[x, y, w, h]``, resampled
+    from the page through ``transform`` (template to page pixels) so the box
+    is CHECKBOX_SIZE square with ``border`` box pixels around it. Shape
+    (boxes, side, side).
+    """
+    gray = image if image.mode == "L" else image.convert("L")
+    side = CHECKBOX_SIZE + 2 * border
+    windows = np.empty((len(boxes), side, side), np.float32)
+    for index, (x, y, w, h) in enumerate(boxes):
+        scale_x, scale_y = w / CHECKBOX_SIZE, h / CHECKBOX_SIZE
+        window_to_template = (scale_x, 0.0, x - border * scale_x, 0.0, scale_y, y - border * scale_y)
+        windows[index] = np.asarray(gray.transform(
+            (side, side), Image.Transform.AFFINE, _compose(transform, window_to_template),
+            resample=Image.Resampling.BILINEAR, fillcolor=255,
+        ))
+    return windows
+
+
+def _darkness(windows: np.ndarray) -> np.ndarray:
+    """Ink (0-1) of each window relative to its own paper level, so uneven lighting across the page cancels out."""
+    paper = np.maximum(np.percentile(windows, 90, axis=(1, 2), keepdims=True), 1.0)
+    ink = np.clip((paper - windows) / paper, 0.0, 1.0)
+    ink[ink < INK_FLOOR] = 0.0
+    return ink
+
+
+def _interior_fill(ink: np.ndarray, dy: np.ndarray, dx: np.ndarray, border: int) -> np.ndarray:
+    """Fraction of inked pixels inside each box, the box of window ``i`` starting at (border + dy[i], border + dx[i])."""
+    side = CHECKBOX_SIZE - 2 * CHECKBOX_INSET
+    steps = np.arange(side)
+    rows = (border + CHECKBOX_INSET + dy)[:, None] + steps
+    columns = (border + CHECKBOX_INSET + dx)[:, None] + steps
+    interior = ink[np.arange(len(ink))[:, None, None], rows[:, :, None], columns[:, None, :]]
+    return (interior > 0).mean(axis=(1, 2))
+
+
+def read_checkboxes(aligned: AlignedPage) -> dict[str, bool | None]:
+    """
+    Read the template's checkboxes on an aligned page. All boxes are done
+    at once: each box's neighbourhood is resampled to a common scale, the
+    blank box is located in it by FFT cross-correlation (absorbing what
+    the page-level alignment left over), and the ink inside the located
+    box, less what the blank template has there, decides ticked or empty.
+    A box that is off the page or whose outline is not found is None.
+    """
+    template = aligned.template
+    checkboxes = template.checkboxes
+    if not checkboxes:
+        return {}
+    windows = _darkness(_sample_boxes(aligned.image, [checkbox.bbox for checkbox in checkboxes], aligned.transform, CHECKBOX_SEARCH))
+    count, side = len(windows), windows.shape[1]
+    patch_side = template.checkbox_patches.shape[1]
+    patches = np.zeros_like(windows)
+    patches[:, :patch_side, :patch_side] = template.checkbox_patches
+    ones = np.zeros((side, side), np.float32)
+    ones[:patch_side, :patch_side] = 1.0
+    spectra = np.fft.rfft2(windows)
+    correlation = np.fft.irfft2(spectra * np.conj(np.fft.rfft2(patches)), s=(side, side))
+    # Sums of the window and its square under every patch position, to normalize the correlation
+    ones_spectrum = np.conj(np.fft.rfft2(ones))
+    sums = np.fft.irfft2(spectra * ones_spectrum, s=(side, side))
+    squares = np.fft.irfft2(np.fft.rfft2(windows * windows) * ones_spectrum, s=(side, side))
+    # Only offsets where the patch lies entirely inside the window
+    reach = side - patch_side + 1
+    best = correlation[:, :reach, :reach].reshape(count, -1).argmax(axis=1)
+    dy, dx = np.divmod(best, reach)
+    rows = np.arange(count)
+    spread = np.maximum(squares[rows, dy, dx] - sums[rows, dy, dx] ** 2 / patch_side ** 2, 1e-9)
+    match = correlation[rows, dy, dx] / (np.sqrt(spread) * np.maximum(template.checkbox_norms, 1e-9))
+    fill = _interior_fill(windows, dy, dx, CHECKBOX_BORDER) - template.checkbox_baseline
+
+    results = {}
+    for checkbox, found, amount in zip(checkboxes, match, fill):
+        left, top, right, bottom = aligned.to_page(checkbox.bbox)
+        x, y, w, h = checkbox.bbox
+        on_page = (right - left) * (bottom - top) >= 0.9 * _area(aligned, w, h)
+        if not on_page or found < CHECKBOX_MIN_MATCH:
+            value = None
+        else:
+            value = True if amount >= FORM_CHECKBOX_FILLED else False if amount <= FORM_CHECKBOX_EMPTY else None
+        results[checkbox.attributes["field"]] = value
+    return results
+
+
+def prepare_form_image(image_bytes: bytes, roi: bool = FORM_ROI_ENABLED, checkboxes: bool = FORM_CHECKBOX_MODE != "off") -> FormMatch | None:
+    """
+    Match a page against the registered templates. With ``roi``, the
+    matched page is reduced to the composite of its regions (JPEG); with
+    ``checkboxes``, the template's checkboxes are read from it. Returns
+    None when no template matches or the page cannot be decoded, in which
+    case the caller sends the full page. Runs in the preprocessing pool.
+    """
+    if not get_template_registry():
+        return None
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("L" if image.mode in ("1", "L", "LA", "I;16") else "RGB")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Warning: Form template matching skipped: {e}")
+        return None
+
+    aligned = match_template(image)
+    if aligned is None:
+        return None
+    match = FormMatch(aligned.template.document_name, aligned.score)
+    if checkboxes:
+        match.checkboxes = read_checkboxes(aligned)
+    composite = compose_regions(aligned) if roi else None
+    if composite is not None:
+        buffer = io.BytesIO()
+        composite.save(buffer, format="JPEG", quality=COMPOSITE_QUALITY)
+        match.composite, match.mime_type = buffer.getvalue(), "image/jpeg"
+    return match
+
+
+async def match_form_template(image_bytes: bytes) -> FormMatch | None:
+    """Run prepare_form_image off the event loop (in the preprocessing pool when configured) and record metrics."""
+    with timed(FORM_TEMPLATE_SECONDS, "match_form_template"):
+        match = await run_cpu_bound(prepare_form_image, image_bytes, FORM_ROI_ENABLED, FORM_CHECKBOX_MODE != "off")
+    FORM_TEMPLATE_MATCHES.inc(template=match.document_name if match is not None else "none")
+    if match is not None:
+        for value in match.checkboxes.values():
+            CHECKBOX_READS.inc(result="uncertain" if value is None else "checked" if value else "empty")
+    if match is not None and match.composite is not None:
+        IMAGE_BYTES.observe(len(match.composite), endpoint=current_endpoint.get(), stage="roi_composite")
+    return match
+
+
+def load_templates(directory: str) -> tuple[FormTemplate, ...]:
+    """
+    Read every ``*.json`` COCO file in ``directory``. Each COCO image is one
+    blank form; its ``document_name`` (or, failing that, its file name
+    without extension) must be a DocumentName. Annotations keep their
+    order; a region's name comes from ``attributes.name`` or ``name``. A
+    checkbox's ``attributes.field`` is the dotted path of the boolean it
+    fills in the response (JSON names, see resolve_field_path).
+    """
+    document_names = get_args(DocumentName)
+    templates = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(directory, file_name)
+        with open(path, "rb") as f:
+            raw = f.read()
+        coco = json.loads(raw)
+        categories = {category["id"]: category["name"] for category in coco.get("categories", [])}
+        for image_info in coco["images"]:
+            document_name = image_info.get("document_name") or os.path.splitext(os.path.basename(image_info["file_name"]))[0]
+            if document_name not in document_names:
+                raise ValueError(f"{path}: template {image_info['file_name']!r} is not one of {', '.join(document_names)}")
+            image_path = os.path.join(directory, image_info["file_name"])
+            with open(image_path, "rb") as f:
+                image_bytes = f.read()
+            with Image.open(io.BytesIO(image_bytes)) as reference:
+                reference = ImageOps.exif_transpose(reference).convert("L")
+            # Annotations are in the pixels COCO recorded; rescale if the reference file differs
+            ratio_x = reference.width / image_info.get("width", reference.width)
+            ratio_y = reference.height / image_info.get("height", reference.height)
+            annotations = []
+            for annotation in coco.get("annotations", []):
+                if annotation["image_id"] != image_info["id"]:
+                    continue
+                x, y, w, h = annotation["bbox"]
+                attributes = annotation.get("attributes") or {}
+                category = categories.get(annotation.get("category_id"), REGION_CATEGORY)
+                name = attributes.get("name") or annotation.get("name") or f"{category}-{annotation.get('id', len(annotations))}"
+                if category == CHECKBOX_CATEGORY:
+                    field = attributes.get("field")
+                    try:
+                        if field is None or resolve_field_path(field) is not bool:
+                            raise KeyError(f"{field!r} is not a boolean field")
+                    except KeyError as e:
+                        raise ValueError(f"{path}: checkbox annotation {name!r} needs attributes.field naming a boolean field: {e}") from None
+                annotations.append(TemplateRegion(name, category, (x * ratio_x, y * ratio_y, w * ratio_x, h * ratio_y), attributes))
+            fingerprint = hashlib.sha256(raw + image_bytes).hexdigest()[:16]
+            templates.append(FormTemplate(document_name, reference, annotations, fingerprint))
+    return tuple(templates)
+
+
+@lru_cache(maxsize=1)
+def get_template_registry() -> tuple[FormTemplate, ...]:
+    """Templates from FORM_TEMPLATE_DIR, loaded once per process (empty when unset)."""
+    if not FORM_TEMPLATE_DIR:
+        return ()
+    return load_templates(FORM_TEMPLATE_DIR)
+
+
+def templates_fingerprint() -> str:
+    """Identifies the loaded templates, for cache keys: results change when a template does."""
+    return ",".join(f"{template.document_name}:{template.fingerprint}" for template in get_template_registry())
+
+
+def template_stats() -> dict:
+    return {
+        "directory": FORM_TEMPLATE_DIR,
+        "roi_enabled": FORM_ROI_ENABLED,
+        "min_score": FORM_ALIGN_MIN_SCORE,
+        "checkbox_mode": FORM_CHECKBOX_MODE,
+        "checkbox_drop_from_schema": FORM_CHECKBOX_DROP_FROM_SCHEMA,
+        "templates": {
+            template.document_name: {
+                "regions": len(template.regions),
+                "checkboxes": len(template.checkboxes),
+                "annotations": len(template.annotations),
+                "fingerprint": template.fingerprint,
+            }
+            for template in get_template_registry()
+        },
+    }
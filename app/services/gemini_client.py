@@ -0,0 +1,813 @@
+# app/services/gemini_client.py
+import os
+import re
+import time
+import random
+import asyncio
+from collections import defaultdict, deque
+import json
+import httpx
+from google import genai
+from google.genai import errors
+from services.metrics import (
+    GEMINI_BACKEND_CALLS, GEMINI_BACKEND_LATENCY, GEMINI_BREAKER_OPEN, GEMINI_HEDGE_CALLS,
+    GEMINI_HEDGES, GEMINI_HEDGE_WINS, GEMINI_IN_FLIGHT, GEMINI_LIMITER_WAIT_SECONDS, GEMINI_RETRIES, span,
+)
+
+# Upper bound on Gemini calls in flight from this process. Extra callers wait
+# on the semaphore instead of piling more sockets onto the API.
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '16'))
+# Per-call timeout (seconds) applied to every generate_content request.
+GEMINI_TIMEOUT_SECONDS = float(os.getenv('GEMINI_TIMEOUT_SECONDS', '60'))
+
+# Backends used when GEMINI_BACKENDS is not set: every key in GOOGLE_API_KEYS
+# (or the single GOOGLE_API_KEY) gets one backend per tier.
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+GEMINI_LIGHT_MODEL = os.getenv('GEMINI_LIGHT_MODEL', 'gemini-2.5-flash-lite')
+
+# Per-key, per-model quota; 0 disables that limit.
+GEMINI_RPM_LIMIT = int(os.getenv('GEMINI_RPM_LIMIT', '1000'))
+GEMINI_TPM_LIMIT = int(os.getenv('GEMINI_TPM_LIMIT', '1000000'))
+GEMINI_LIGHT_RPM_LIMIT = int(os.getenv('GEMINI_LIGHT_RPM_LIMIT', '4000'))
+GEMINI_LIGHT_TPM_LIMIT = int(os.getenv('GEMINI_LIGHT_TPM_LIMIT', '4000000'))
+# Server worker processes sharing these quotas (set by server.py); each process limits itself to its share.
+GEMINI_QUOTA_SHARES = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+# Tokens reserved per call before the real usage is known (then refined from usage_metadata).
+GEMINI_ESTIMATED_TOKENS_PER_CALL = int(os.getenv('GEMINI_ESTIMATED_TOKENS_PER_CALL', '3000'))
+
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv('GEMINI_RETRY_BASE_SECONDS', '1'))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv('GEMINI_RETRY_MAX_SECONDS', '20'))
+
+# Consecutive failed calls that open the breaker, and how long it stays open.
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', '5'))
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv('GEMINI_BREAKER_RESET_SECONDS', '30'))
+
+# Startup warm-up: one cheap model lookup per backend opens its connection (and checks key and model name)
+GEMINI_WARMUP_TIMEOUT_SECONDS = float(os.getenv('GEMINI_WARMUP_TIMEOUT_SECONDS', '10'))
+
+# Smoothing factor of the per-backend latency average
+GEMINI_LATENCY_EWMA_ALPHA = float(os.getenv('GEMINI_LATENCY_EWMA_ALPHA', '0.2'))
+
+# Hedging: when a call outlives this percentile of recent latency, send a
+# second identical call (to another backend if possible) and keep the first
+# valid answer. Extra calls are capped at BUDGET_RATIO of all hedgeable calls.
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', 'false').lower() == 'true'
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', '95'))
+GEMINI_HEDGE_MIN_DELAY_SECONDS = float(os.getenv('GEMINI_HEDGE_MIN_DELAY_SECONDS', '2'))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+GEMINI_HEDGE_WINDOW = int(os.getenv('GEMINI_HEDGE_WINDOW', '500'))
+GEMINI_HEDGE_BUDGET_RATIO = float(os.getenv('GEMINI_HEDGE_BUDGET_RATIO', '0.1'))
+GEMINI_HEDGE_BUDGET_BURST = float(os.getenv('GEMINI_HEDGE_BUDGET_BURST', '5'))
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Tiers a call may be served from, in order of preference. Light calls can
+# always be upgraded to the standard model; standard calls are never downgraded.
+TIER_FALLBACKS = {
+    "standard": ("standard",),
+    "light": ("light", "standard"),
+}
+
+_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+
+class GeminiUnavailableError(Exception):
+    """Gemini is overloaded or failing; callers should answer 503 with ``Retry-After``."""
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at ``limit`` tokens per minute with a burst of one
+    minute's worth. The effective rate is halved on every 429 and climbs
+    back by 5% of the limit per successful call (AIMD), so the bucket
+    settles just under the quota the API is actually granting.
+    """
+
+    def __init__(self, limit_per_minute: int):
+        self.limit = limit_per_minute
+        self.rate = float(limit_per_minute)
+        self.tokens = float(limit_per_minute)
+        self.throttled = 0
+        self._updated_at = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self._updated_at) * self.rate / 60)
+        self._updated_at = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        if not self.enabled:
+            return
+        amount = min(amount, self.rate)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) * 60 / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund, if negative) tokens after the fact."""
+        if self.enabled:
+            self._refill()
+            self.tokens -= amount
+
+    def throttle(self) -> None:
+        if self.enabled:
+            self.throttled += 1
+            self.rate = max(self.limit * 0.05, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def recover(self) -> None:
+        if self.enabled:
+            self.rate = min(float(self.limit), self.rate + self.limit * 0.05)
+
+    def headroom(self) -> float:
+        """Fraction of the burst currently available (1.0 when unlimited)."""
+        if not self.enabled:
+            return 1.0
+        self._refill()
+        return max(0.0, self.tokens) / self.rate
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        self._refill()
+        return {
+            "enabled": True,
+            "limit_per_minute": self.limit,
+            "effective_per_minute": round(self.rate, 1),
+            "available": round(self.tokens, 1),
+            "throttled": self.throttled,
+        }
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one API key."""
+
+    def __init__(self, rpm: int, tpm: int, estimated_tokens: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.estimated_tokens = float(estimated_tokens)
+
+    async def acquire(self) -> float:
+        """Wait for capacity; returns the number of tokens reserved for the call."""
+        reserved = self.estimated_tokens
+        await self.requests.acquire(1)
+        await self.tokens.acquire(reserved)
+        return reserved
+
+    def record_usage(self, reserved: float, response) -> None:
+        usage = getattr(response, "usage_metadata", None)
+        total = getattr(usage, "total_token_count", None)
+        if total:
+            self.tokens.adjust(total - reserved)
+            # Moving average so the next reservation tracks real usage
+            self.estimated_tokens = 0.8 * self.estimated_tokens + 0.2 * total
+        self.requests.recover()
+        self.tokens.recover()
+
+    def throttle(self) -> None:
+        self.requests.throttle()
+        self.tokens.throttle()
+
+    def headroom(self) -> float:
+        return min(self.requests.headroom(), self.tokens.headroom())
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests.stats(),
+            "tokens": self.tokens.stats(),
+            "estimated_tokens_per_call": round(self.estimated_tokens),
+        }
+
+
+class CircuitBreaker:
+    """
+    Closed until ``failure_threshold`` calls fail in a row, then open: calls
+    are rejected at once for ``reset_seconds``. After that one probe call is
+    let through (half-open); its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float, name: str = "gemini"):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_count = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(1.0, self._opened_at + self.reset_seconds - time.monotonic())
+
+    def available(self) -> bool:
+        """Whether before_call would let a call through right now."""
+        if self.state == "open":
+            return time.monotonic() - self._opened_at >= self.reset_seconds
+        return not (self.state == "half_open" and self._probe_in_flight)
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_seconds:
+                raise GeminiUnavailableError(f"Gemini circuit breaker for {self.name} is open.", self.retry_after())
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise GeminiUnavailableError(f"Gemini circuit breaker for {self.name} is half-open; a probe call is in flight.", 1.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            GEMINI_BREAKER_OPEN.set(0, backend=self.name)
+
+    def record_cancelled(self) -> None:
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opened_count += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            GEMINI_BREAKER_OPEN.set(1, backend=self.name)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_seconds": self.reset_seconds,
+            "opened_count": self.opened_count,
+            "retry_after_seconds": round(self.retry_after(), 1) if self.state == "open" else None,
+        }
+
+
+class GeminiBackend:
+    """
+    One API key serving one model, with its own quota limiter, circuit
+    breaker and latency average. ``tier`` says which calls it can serve
+    ("standard" extraction or "light" work such as classification).
+    """
+
+    def __init__(self, name: str, client: genai.Client, model: str, tier: str = "standard",
+                 rpm: int = GEMINI_RPM_LIMIT, tpm: int = GEMINI_TPM_LIMIT):
+        if tier not in TIER_FALLBACKS:
+            raise ValueError(f"Unknown Gemini tier {tier!r} for backend {name}")
+        self.name = name
+        self.client = client
+        self.model = model
+        self.tier = tier
+        self.rate_limiter = RateLimiter(rpm, tpm, GEMINI_ESTIMATED_TOKENS_PER_CALL)
+        self.circuit_breaker = CircuitBreaker(GEMINI_BREAKER_FAILURE_THRESHOLD, GEMINI_BREAKER_RESET_SECONDS, name)
+        self.latency_ewma: float | None = None
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+
+    def observe_latency(self, seconds: float) -> None:
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += GEMINI_LATENCY_EWMA_ALPHA * (seconds - self.latency_ewma)
+        GEMINI_BACKEND_LATENCY.set(self.latency_ewma, backend=self.name)
+
+    def penalize(self, seconds: float) -> None:
+        """Failed calls count as slow ones so the router drifts away from a failing backend."""
+        self.latency_ewma = max(seconds, 2 * (self.latency_ewma or seconds))
+        GEMINI_BACKEND_LATENCY.set(self.latency_ewma, backend=self.name)
+
+    def score(self, default_latency: float) -> float:
+        """Expected wait on this backend; lower is better."""
+        latency = self.latency_ewma if self.latency_ewma is not None else default_latency
+        return latency * (1 + self.in_flight) / max(self.rate_limiter.headroom(), 0.01)
+
+    async def call(self, contents, config, timeout: float | None):
+        limiter_start = time.monotonic()
+        reserved = await self.rate_limiter.acquire()
+        async with _semaphore:
+            GEMINI_LIMITER_WAIT_SECONDS.observe(time.monotonic() - limiter_start)
+            GEMINI_IN_FLIGHT.inc()
+            self.in_flight += 1
+            self.calls += 1
+            start_time = time.monotonic()
+            try:
+                with span("gemini.generate_content", model=self.model, backend=self.name):
+                    response = await asyncio.wait_for(
+                        self.client.aio.models.generate_content(
+                            model=self.model,
+                            contents=contents,
+                            config=config,
+                        ),
+                        timeout=timeout if timeout is not None else GEMINI_TIMEOUT_SECONDS,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # A failed or timed-out call still tells the router this backend is slow
+                self.penalize(time.monotonic() - start_time)
+                raise
+            finally:
+                self.in_flight -= 1
+                GEMINI_IN_FLIGHT.dec()
+        self.observe_latency(time.monotonic() - start_time)
+        self.rate_limiter.record_usage(reserved, response)
+        # Lets callers label metrics with the model that actually answered
+        response.model_version = self.model
+        return response
+
+    async def stream(self, contents, config, timeout: float | None):
+        """Like call, but yields the chunks of ``generate_content_stream``; ``timeout`` bounds the whole stream."""
+        limiter_start = time.monotonic()
+        reserved = await self.rate_limiter.acquire()
+        async with _semaphore:
+            GEMINI_LIMITER_WAIT_SECONDS.observe(time.monotonic() - limiter_start)
+            GEMINI_IN_FLIGHT.inc()
+            self.in_flight += 1
+            self.calls += 1
+            start_time = time.monotonic()
+            deadline = start_time + (timeout if timeout is not None else GEMINI_TIMEOUT_SECONDS)
+            last_chunk = None
+            try:
+                # The span only covers opening the stream: the consumer may resume
+                # this generator from another task, where the span's context is unknown
+                with span("gemini.generate_content_stream", model=self.model, backend=self.name):
+                    chunks = await asyncio.wait_for(
+                        self.client.aio.models.generate_content_stream(
+                            model=self.model,
+                            contents=contents,
+                            config=config,
+                        ),
+                        timeout=deadline - time.monotonic(),
+                    )
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(anext(chunks), timeout=deadline - time.monotonic())
+                        except StopAsyncIteration:
+                            break
+                        chunk.model_version = self.model
+                        last_chunk = chunk
+                        yield chunk
+                finally:
+                    await chunks.aclose()
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                self.penalize(time.monotonic() - start_time)
+                raise
+            finally:
+                self.in_flight -= 1
+                GEMINI_IN_FLIGHT.dec()
+        self.observe_latency(time.monotonic() - start_time)
+        # Usage is reported on the final chunk
+        self.rate_limiter.record_usage(reserved, last_chunk)
+
+    async def warm_up(self) -> None:
+        """Fetch the model's metadata: opens (and keeps alive) the connection without spending quota."""
+        await self.client.aio.models.get(model=self.model)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "tier": self.tier,
+            "calls": self.calls,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "latency_ewma_seconds": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "rate_limiter": self.rate_limiter.stats(),
+            "circuit_breaker": self.circuit_breaker.stats(),
+        }
+
+
+class BackendPool:
+    """
+    Routes each call to the backend with the lowest expected wait
+    (latency EWMA scaled by in-flight calls and remaining quota) among the
+    healthy backends of the requested tier and its fallbacks.
+    """
+
+    def __init__(self, backends: list[GeminiBackend]):
+        if not backends:
+            raise ValueError("No Gemini backends configured.")
+        self.backends = backends
+
+    @classmethod
+    def from_env(cls) -> "BackendPool":
+        """
+        Build the pool from GEMINI_BACKENDS, a JSON list of
+        ``{"name", "api_key_env" or "api_key", "model", "tier", "rpm", "tpm"}``
+        objects, or else from GOOGLE_API_KEYS / GOOGLE_API_KEY with one
+        GEMINI_MODEL and one GEMINI_LIGHT_MODEL backend per key.
+        RPM/TPM limits are divided between the server's worker processes.
+        """
+        clients: dict[str, genai.Client] = {}
+
+        def client_for(api_key: str) -> genai.Client:
+            if api_key not in clients:
+                clients[api_key] = genai.Client(api_key=api_key)
+            return clients[api_key]
+
+        backends = []
+        config = os.getenv('GEMINI_BACKENDS')
+        if config:
+            for index, entry in enumerate(json.loads(config)):
+                api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env", "GOOGLE_API_KEY"))
+                name = entry.get("name", f"backend-{index}")
+                if not api_key:
+                    raise ValueError(f"No API key found for Gemini backend {name}.")
+                tier = entry.get("tier", "standard")
+                light = tier == "light"
+                backends.append(GeminiBackend(
+                    name,
+                    client_for(api_key),
+                    entry.get("model", GEMINI_LIGHT_MODEL if light else GEMINI_MODEL),
+                    tier,
+                    rpm=_quota_share(int(entry.get("rpm", GEMINI_LIGHT_RPM_LIMIT if light else GEMINI_RPM_LIMIT))),
+                    tpm=_quota_share(int(entry.get("tpm", GEMINI_LIGHT_TPM_LIMIT if light else GEMINI_TPM_LIMIT))),
+                ))
+            return cls(backends)
+
+        api_keys = [key.strip() for key in os.getenv('GOOGLE_API_KEYS', '').split(',') if key.strip()]
+        if not api_keys and os.getenv('GOOGLE_API_KEY'):
+            api_keys = [os.getenv('GOOGLE_API_KEY')]
+        if not api_keys:
+            raise ValueError("GOOGLE_API_KEY not found in environment variables.")
+        for index, api_key in enumerate(api_keys):
+            client = client_for(api_key)
+            backends.append(GeminiBackend(
+                f"key{index}-standard", client, GEMINI_MODEL, "standard",
+                _quota_share(GEMINI_RPM_LIMIT), _quota_share(GEMINI_TPM_LIMIT),
+            ))
+            backends.append(GeminiBackend(
+                f"key{index}-light", client, GEMINI_LIGHT_MODEL, "light",
+                _quota_share(GEMINI_LIGHT_RPM_LIMIT), _quota_share(GEMINI_LIGHT_TPM_LIMIT),
+            ))
+        return cls(backends)
+
+    def candidates(self, tier: str) -> list[GeminiBackend]:
+        tiers = TIER_FALLBACKS.get(tier)
+        if tiers is None:
+            raise ValueError(f"Unknown Gemini tier {tier!r}")
+        return [backend for fallback in tiers for backend in self.backends if backend.tier == fallback]
+
+    def models_for(self, tier: str) -> str:
+        """Stable description of the models a tier can be served by (for cache keys)."""
+        return ",".join(sorted({backend.model for backend in self.candidates(tier)}))
+
+    def choose(self, tier: str, exclude: set[str]) -> GeminiBackend:
+        candidates = self.candidates(tier)
+        if not candidates:
+            raise GeminiUnavailableError(f"No Gemini backend serves the {tier} tier.", GEMINI_RETRY_MAX_SECONDS)
+        healthy = [backend for backend in candidates if backend.circuit_breaker.available() and backend.name not in exclude]
+        if not healthy:
+            retry_after = min(backend.circuit_breaker.retry_after() for backend in candidates)
+            raise GeminiUnavailableError(f"All Gemini backends for the {tier} tier are unavailable.", retry_after)
+        known = [backend.latency_ewma for backend in candidates if backend.latency_ewma is not None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        # Prefer the requested tier; fallbacks only when it has nothing healthy left
+        preferred = [backend for backend in healthy if backend.tier == tier] or healthy
+        scores = [(backend.score(default_latency), backend) for backend in preferred]
+        best = min(score for score, _ in scores)
+        return random.choice([backend for score, backend in scores if score == best])
+
+    async def warm_up(self, timeout: float = GEMINI_WARMUP_TIMEOUT_SECONDS) -> dict[str, str]:
+        """
+        Warm every backend concurrently, bounded by ``timeout``. Never raises:
+        returns "ok" or the error per backend, so a slow or misconfigured
+        backend delays startup by at most ``timeout`` and is left to the
+        circuit breaker.
+        """
+        async def warm(backend: GeminiBackend) -> str:
+            try:
+                await asyncio.wait_for(backend.warm_up(), timeout)
+                return "ok"
+            except Exception as e:
+                print(f"Warm-up of Gemini backend {backend.name} failed: {e!r}")
+                return f"{type(e).__name__}: {e}"
+
+        results = await asyncio.gather(*(warm(backend) for backend in self.backends))
+        return {backend.name: result for backend, result in zip(self.backends, results)}
+
+    def stats(self) -> list[dict]:
+        return [backend.stats() for backend in self.backends]
+
+
+def _quota_share(limit: int) -> int:
+    # 0 means unlimited and stays so; a real limit never rounds down to unlimited
+    return max(1, limit // GEMINI_QUOTA_SHARES) if limit else 0
+
+
+_pool: BackendPool | None = None
+
+
+def set_backend_pool(pool: BackendPool) -> None:
+    global _pool
+    _pool = pool
+
+
+def get_backend_pool() -> BackendPool:
+    global _pool
+    if _pool is None:
+        _pool = BackendPool.from_env()
+    return _pool
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+def _server_retry_delay(error: Exception) -> float | None:
+    """The ``RetryInfo.retryDelay`` Gemini attaches to 429s, e.g. ``"23s"``."""
+    details = getattr(error, "details", None)
+    if not isinstance(details, dict):
+        return None
+    for detail in details.get("error", {}).get("details", []) or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("RetryInfo"):
+            match = re.match(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+def _forget_tried_when_exhausted(pool: BackendPool, tier: str, tried: set[str]) -> None:
+    """Start a new round once every backend that could take the call has failed; open breakers are not waited for."""
+    available = {backend.name for backend in pool.candidates(tier) if backend.circuit_breaker.available()}
+    if available <= tried:
+        tried.clear()
+
+
+def _choose_backend(pool: BackendPool, tier: str, tried: set[str], avoid: set[str] | None) -> GeminiBackend:
+    _forget_tried_when_exhausted(pool, tier, tried)
+    if avoid:
+        try:
+            return pool.choose(tier, tried | avoid)
+        except GeminiUnavailableError:
+            pass
+    return pool.choose(tier, tried)
+
+
+async def _after_failure(pool: BackendPool, tier: str, backend: GeminiBackend, error: Exception,
+                         attempt: int, tried: set[str]) -> None:
+    """
+    Book-keeping for a failed attempt. Raises when the call should give up,
+    otherwise returns once the next attempt may start.
+    """
+    timed_out = isinstance(error, asyncio.TimeoutError)
+    if not timed_out and not _is_retryable(error):
+        # Caller-side problems say nothing about Gemini's health
+        backend.circuit_breaker.record_success()
+        GEMINI_BACKEND_CALLS.inc(backend=backend.name, outcome="client_error")
+        raise error
+    backend.failures += 1
+    backend.circuit_breaker.record_failure()
+    code = getattr(error, "code", None)
+    reason = "timeout" if timed_out else str(code or type(error).__name__)
+    GEMINI_BACKEND_CALLS.inc(backend=backend.name, outcome=reason)
+    if code == 429:
+        backend.rate_limiter.throttle()
+    tried.add(backend.name)
+    server_delay = _server_retry_delay(error)
+    if attempt == GEMINI_MAX_RETRIES:
+        if timed_out:
+            raise error
+        raise GeminiUnavailableError(
+            f"Gemini is unavailable after {attempt + 1} attempts: {error}",
+            server_delay or GEMINI_RETRY_MAX_SECONDS,
+        ) from error
+    untried = [other for other in pool.candidates(tier) if other.name not in tried and other.circuit_breaker.available()]
+    if timed_out and not untried:
+        # Waiting another full timeout on the same backend rarely helps
+        raise error
+    GEMINI_RETRIES.inc(model=backend.model, reason=reason)
+    if not untried:
+        await asyncio.sleep(server_delay if server_delay is not None else _backoff(attempt))
+
+
+async def generate_content(*, contents, config=None, tier: str = "standard", timeout: float | None = None,
+                           avoid: set[str] | None = None, used: set[str] | None = None):
+    """
+    Non-blocking wrapper around ``client.aio.models.generate_content``.
+
+    Uses the SDK's native async transport so the event loop stays free while
+    Gemini is working, bounds the number of concurrent calls per process and
+    enforces a per-call timeout (raises ``asyncio.TimeoutError``).
+
+    Each attempt goes to the best backend of ``tier`` (see BackendPool).
+    A backend that is throttled, failing or times out is skipped for the
+    next attempt, so the call fails over to another key or model at once;
+    once every backend has been tried, attempts back off with jitter.
+    Retryable errors that outlast the retries, and tiers whose breakers are
+    all open, raise ``GeminiUnavailableError``; client errors (4xx) are
+    raised as is. ``response.model_version`` names the model that answered.
+
+    Backends named in ``avoid`` are only used when nothing else is healthy;
+    the names of the backends actually tried are added to ``used``.
+    """
+    pool = get_backend_pool()
+    tried: set[str] = set()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        backend = _choose_backend(pool, tier, tried, avoid)
+        if used is not None:
+            used.add(backend.name)
+        backend.circuit_breaker.before_call()
+        try:
+            response = await backend.call(contents, config, timeout)
+        except asyncio.CancelledError:
+            backend.circuit_breaker.record_cancelled()
+            raise
+        except Exception as e:
+            await _after_failure(pool, tier, backend, e, attempt, tried)
+        else:
+            backend.circuit_breaker.record_success()
+            GEMINI_BACKEND_CALLS.inc(backend=backend.name, outcome="ok")
+            return response
+
+
+async def generate_content_stream(*, contents, config=None, tier: str = "standard", timeout: float | None = None):
+    """
+    Streaming variant of generate_content: an async generator of response
+    chunks as Gemini produces them. Routing, limits, retries and the circuit
+    breaker work the same way, except that a call is only retried (or failed
+    over) until its first chunk has been yielded; after that an error ends
+    the stream. ``timeout`` bounds the whole stream.
+    """
+    pool = get_backend_pool()
+    tried: set[str] = set()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        backend = _choose_backend(pool, tier, tried, None)
+        backend.circuit_breaker.before_call()
+        started = False
+        try:
+            async for chunk in backend.stream(contents, config, timeout):
+                started = True
+                yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            backend.circuit_breaker.record_cancelled()
+            raise
+        except Exception as e:
+            if started:
+                if isinstance(e, asyncio.TimeoutError) or _is_retryable(e):
+                    backend.failures += 1
+                    backend.circuit_breaker.record_failure()
+                raise
+            await _after_failure(pool, tier, backend, e, attempt, tried)
+        else:
+            backend.circuit_breaker.record_success()
+            GEMINI_BACKEND_CALLS.inc(backend=backend.name, outcome="ok")
+            return
+
+
+class LatencyWindow:
+    """Latencies of the last ``size`` successful calls, for percentile lookups."""
+
+    def __init__(self, size: int):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class HedgeBudget:
+    """Every hedgeable call earns ``ratio`` credits (up to ``burst``); a hedge spends one."""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.credits = burst
+
+    def earn(self) -> None:
+        self.credits = min(self.burst, self.credits + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.credits >= 1:
+            self.credits -= 1
+            return True
+        return False
+
+
+_hedge_latency: dict[str, LatencyWindow] = defaultdict(lambda: LatencyWindow(GEMINI_HEDGE_WINDOW))
+_hedge_budget = HedgeBudget(GEMINI_HEDGE_BUDGET_RATIO, GEMINI_HEDGE_BUDGET_BURST)
+
+
+def hedge_delay(call: str) -> float | None:
+    """Seconds to wait before hedging ``call``; None while there is too little history."""
+    window = _hedge_latency[call]
+    if len(window) < GEMINI_HEDGE_MIN_SAMPLES:
+        return None
+    return max(GEMINI_HEDGE_MIN_DELAY_SECONDS, window.percentile(GEMINI_HEDGE_PERCENTILE))
+
+
+async def generate_content_hedged(*, call: str, contents, config=None, tier: str = "standard", accept=None):
+    """
+    generate_content with tail-latency hedging (when GEMINI_HEDGE_ENABLED).
+
+    If the first call has not returned after ``hedge_delay(call)``, and the
+    hedge budget allows it, an identical call is sent, preferably to a
+    different backend. The first response ``accept`` approves (any response
+    when ``accept`` is None) wins and the other call is cancelled. When no
+    response is accepted, the last rejected response is returned so the
+    caller's own validation reports it, or else the last error is raised.
+    """
+    if not GEMINI_HEDGE_ENABLED:
+        return await generate_content(contents=contents, config=config, tier=tier)
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    primary_backends: set[str] = set()
+    primary = asyncio.create_task(generate_content(contents=contents, config=config, tier=tier, used=primary_backends))
+    hedge = None
+    pending = {primary}
+    _hedge_budget.earn()
+    GEMINI_HEDGE_CALLS.inc(call=call)
+
+    rejected = None
+    error: BaseException | None = None
+    try:
+        delay = hedge_delay(call)
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                if _hedge_budget.try_spend():
+                    GEMINI_HEDGES.inc(call=call, result="launched")
+                    hedge = asyncio.create_task(generate_content(contents=contents, config=config, tier=tier, avoid=primary_backends))
+                    pending.add(hedge)
+                else:
+                    GEMINI_HEDGES.inc(call=call, result="over_budget")
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Primary first, so a tie goes to the call that was not hedged
+            for task in sorted(done, key=lambda task: task is not primary):
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                response = task.result()
+                if accept is not None and not accept(response):
+                    rejected = response
+                    continue
+                _hedge_latency[call].observe(loop.time() - start_time)
+                if hedge is not None:
+                    GEMINI_HEDGE_WINS.inc(call=call, winner="hedge" if task is hedge else "primary")
+                return response
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    if rejected is not None:
+        return rejected
+    raise error
+
+
+def hedge_stats() -> dict:
+    return {
+        "enabled": GEMINI_HEDGE_ENABLED,
+        "percentile": GEMINI_HEDGE_PERCENTILE,
+        "budget_ratio": GEMINI_HEDGE_BUDGET_RATIO,
+        "budget_credits": round(_hedge_budget.credits, 2),
+        "delay_seconds": {call: round(delay, 3) for call in list(_hedge_latency) if (delay := hedge_delay(call)) is not None},
+    }
+
+
+def get_concurrency_stats() -> dict:
+    """Snapshot of the limiter and the backend pool, useful for health checks."""
+    return {
+        "max_concurrency": GEMINI_MAX_CONCURRENCY,
+        "available_slots": _semaphore._value,
+        "timeout_seconds": GEMINI_TIMEOUT_SECONDS,
+        "quota_shares": GEMINI_QUOTA_SHARES,
+        "backends": get_backend_pool().stats(),
+        "hedging": hedge_stats(),
+    }
@@ -0,0 +1,69 @@
+# app/services/image_downloader.py
+import os
+import importlib.util
+import httpx
+
+# Hard cap on a single download; bigger bodies are rejected before they are buffered.
+DOWNLOAD_MAX_BYTES = int(os.getenv('DOWNLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+DOWNLOAD_CONNECT_TIMEOUT_SECONDS = float(os.getenv('DOWNLOAD_CONNECT_TIMEOUT_SECONDS', '5'))
+DOWNLOAD_READ_TIMEOUT_SECONDS = float(os.getenv('DOWNLOAD_READ_TIMEOUT_SECONDS', '15'))
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv('DOWNLOAD_MAX_CONNECTIONS', '100'))
+DOWNLOAD_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('DOWNLOAD_MAX_KEEPALIVE_CONNECTIONS', '20'))
+
+# Object stores often label uploads as generic binary, so those are let through too.
+ALLOWED_CONTENT_TYPE_PREFIXES = ("image/", "application/pdf", "application/octet-stream", "binary/octet-stream")
+
+
+class DownloadError(Exception):
+    """Raised when a document cannot be fetched; carries the HTTP status to report."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Build the shared, pooled client used for every download. HTTP/2 is
+    enabled when the optional ``h2`` package is installed.
+    """
+    http2 = importlib.util.find_spec("h2") is not None
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(
+            DOWNLOAD_READ_TIMEOUT_SECONDS,
+            connect=DOWNLOAD_CONNECT_TIMEOUT_SECONDS,
+        ),
+        limits=httpx.Limits(
+            max_connections=DOWNLOAD_MAX_CONNECTIONS,
+            max_keepalive_connections=DOWNLOAD_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        follow_redirects=True,
+    )
+
+
+async def download_image(client: httpx.AsyncClient, url: str, max_bytes: int = DOWNLOAD_MAX_BYTES) -> bytes:
+    """
+    Stream ``url`` into memory, rejecting it as early as possible: on the
+    status code, then on the Content-Type/Content-Length headers, and finally
+    as soon as the received body exceeds ``max_bytes``.
+    """
+    async with client.stream("GET", url) as response:
+        if response.status_code != 200:
+            raise DownloadError(404, f"Failed to download image from URL. Status code: {response.status_code}")
+
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type and not content_type.startswith(ALLOWED_CONTENT_TYPE_PREFIXES):
+            raise DownloadError(415, f"Unsupported content type: {content_type}")
+
+        content_length = response.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise DownloadError(413, f"Image is too large: {content_length} bytes (limit {max_bytes}).")
+
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            buffer.extend(chunk)
+            if len(buffer) > max_bytes:
+                raise DownloadError(413, f"Image is too large: more than {max_bytes} bytes.")
+    return bytes(buffer)
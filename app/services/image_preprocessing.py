@@ -0,0 +1,274 @@
+# app/services/image_preprocessing.py
+import os
+import io
+import math
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageChops, ImageOps
+from fastapi.concurrency import run_in_threadpool
+from models import PreprocessOptions
+from services.metrics import IMAGE_BYTES, PREPROCESS_SECONDS, current_endpoint, timed
+
+# Size of the process pool used for preprocessing. 0 runs it in the thread pool instead.
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+EXIF_ORIENTATION_TAG = 0x0112
+# Orientations that swap width and height once applied
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+# Pixel difference from the background that counts as content when auto-cropping
+AUTOCROP_THRESHOLD = 40
+AUTOCROP_PADDING = 16
+# Encoder passes allowed while searching for a quality/size that fits the byte budget
+MAX_ENCODE_ATTEMPTS = 8
+
+
+def default_preprocess_options() -> PreprocessOptions:
+    """Service-wide defaults, configurable through environment variables."""
+    return PreprocessOptions(
+        enabled=os.getenv('PREPROCESS_ENABLED', 'true').lower() == 'true',
+        max_width=int(os.getenv('PREPROCESS_MAX_WIDTH', '1600')),
+        max_height=int(os.getenv('PREPROCESS_MAX_HEIGHT', '2200')),
+        max_pixels=int(os.getenv('PREPROCESS_MAX_PIXELS', str(1600 * 2200))),
+        target_bytes=int(os.getenv('PREPROCESS_TARGET_BYTES', '500000')),
+        min_quality=int(os.getenv('PREPROCESS_MIN_QUALITY', '50')),
+        max_quality=int(os.getenv('PREPROCESS_MAX_QUALITY', '85')),
+        grayscale=os.getenv('PREPROCESS_GRAYSCALE', 'true').lower() == 'true',
+        binarize=os.getenv('PREPROCESS_BINARIZE', 'false').lower() == 'true',
+        autocrop=os.getenv('PREPROCESS_AUTOCROP', 'true').lower() == 'true',
+    )
+
+
+def _fit_scale(width: int, height: int, options: PreprocessOptions) -> float:
+    """Largest scale <= 1 that fits the box and the pixel budget."""
+    return min(
+        1.0,
+        options.max_width / width,
+        options.max_height / height,
+        math.sqrt(options.max_pixels / (width * height)),
+    )
+
+
+def _autocrop(img: Image.Image) -> Image.Image:
+    """Trim uniform margins, using the top-left pixel as the background colour."""
+    gray = img if img.mode == 'L' else img.convert('L')
+    background = Image.new('L', gray.size, gray.getpixel((0, 0)))
+    mask = ImageChops.difference(gray, background).point(lambda p: 255 if p > AUTOCROP_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return img
+    left, top, right, bottom = bbox
+    bbox = (
+        max(0, left - AUTOCROP_PADDING),
+        max(0, top - AUTOCROP_PADDING),
+        min(img.width, right + AUTOCROP_PADDING),
+        min(img.height, bottom + AUTOCROP_PADDING),
+    )
+    # Skip crops that would barely change anything
+    if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) > 0.95 * img.width * img.height:
+        return img
+    return img.crop(bbox)
+
+
+def _otsu_threshold(gray: Image.Image) -> int:
+    histogram = gray.histogram()
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_background = 0.0
+    weight_background = 0
+    best_threshold, best_variance = 127, 0.0
+    for threshold, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += threshold * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = threshold, variance
+    return best_threshold
+
+
+def _encode(img: Image.Image, options: PreprocessOptions) -> tuple[bytes, str]:
+    """
+    Encode within options.target_bytes: binary images go to PNG, everything
+    else to JPEG. The JPEG quality is binary-searched first, and the image is
+    only downscaled further if the lowest quality is still too large.
+    """
+    if img.mode == '1':
+        buffer = io.BytesIO()
+        img.save(buffer, format='PNG', optimize=True)
+        return buffer.getvalue(), 'image/png'
+
+    def save(image: Image.Image, quality: int) -> bytes:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        return buffer.getvalue()
+
+    attempts = 1
+    best = save(img, options.max_quality)
+    low, high = options.min_quality, options.max_quality - 1
+    while len(best) > options.target_bytes and low <= high and attempts < MAX_ENCODE_ATTEMPTS:
+        quality = (low + high) // 2
+        candidate = save(img, quality)
+        attempts += 1
+        if len(candidate) <= options.target_bytes:
+            best, low = candidate, quality + 1
+        else:
+            best = candidate if len(candidate) < len(best) else best
+            high = quality - 1
+
+    while len(best) > options.target_bytes and attempts < MAX_ENCODE_ATTEMPTS and min(img.size) > 256:
+        shrink = max(0.5, math.sqrt(options.target_bytes / len(best)) * 0.95)
+        img = img.resize((int(img.width * shrink), int(img.height * shrink)), Image.Resampling.LANCZOS)
+        best = save(img, options.min_quality)
+        attempts += 1
+    return best, 'image/jpeg'
+
+
+def preprocess_image(image_bytes: bytes, options: PreprocessOptions) -> tuple[bytes, str | None]:
+    """
+    Shrink a document photo before it is sent to Gemini.
+    - Decode JPEGs at reduced size with draft() when the target is much smaller
+    - Apply the EXIF orientation
+    - Auto-crop uniform margins, optionally grayscale/binarize
+    - Resize to the pixel budget and encode to the byte budget
+
+    Returns (bytes, mime_type). On any failure the original bytes are
+    returned with mime_type None so the caller keeps its own guess.
+    """
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        original_size = img.size
+
+        width, height = img.size
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        if orientation in TRANSPOSING_ORIENTATIONS:
+            width, height = height, width
+        scale = _fit_scale(width, height, options)
+        if img.format == 'JPEG' and scale < 1.0:
+            # DCT scaling during decode; draft() never goes below the requested size
+            img.draft('L' if options.grayscale or options.binarize else 'RGB',
+                      (int(img.width * scale), int(img.height * scale)))
+
+        img = ImageOps.exif_transpose(img)
+        if options.grayscale or options.binarize:
+            img = img.convert('L')
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        if options.autocrop:
+            img = _autocrop(img)
+
+        scale = _fit_scale(img.width, img.height, options)
+        if scale < 1.0:
+            img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.Resampling.LANCZOS)
+
+        if options.binarize:
+            threshold = _otsu_threshold(img)
+            img = img.point(lambda p: 255 if p > threshold else 0).convert('1', dither=Image.Dither.NONE)
+
+        encoded, mime_type = _encode(img, options)
+        if img.size == original_size and len(encoded) >= len(image_bytes):
+            # Already small enough; re-encoding would only cost quality
+            return image_bytes, None
+        return encoded, mime_type
+    except Exception as e:
+        print(f"Warning: Image preprocessing failed: {e}")
+        # Return original image if preprocessing fails
+        return image_bytes, None
+
+
+def make_thumbnail(image_bytes: bytes, max_side: int = 512) -> bytes:
+    """Small grayscale JPEG of the page, enough to tell the form types apart."""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if img.format == 'JPEG':
+            img.draft('L', (max_side, max_side))
+        img = ImageOps.exif_transpose(img).convert('L')
+        img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=70)
+        return buffer.getvalue()
+    except Exception as e:
+        print(f"Warning: Thumbnail creation failed: {e}")
+        return image_bytes
+
+
+class PreprocessStats:
+    def __init__(self):
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds_total = 0.0
+
+    def observe(self, bytes_in: int, bytes_out: int, seconds: float) -> None:
+        self.images += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds_total += seconds
+
+    def snapshot(self) -> dict:
+        return {
+            "workers": PREPROCESS_WORKERS,
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "compression_ratio": round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0.0,
+            "avg_seconds": round(self.seconds_total / self.images, 4) if self.images else 0.0,
+        }
+
+
+preprocess_stats = PreprocessStats()
+_executor: ProcessPoolExecutor | None = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that already runs the event loop and thread pool is unsafe
+        _executor = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def _worker_ready() -> int:
+    return os.getpid()
+
+
+async def warm_up_preprocess_executor() -> None:
+    """Spawn the preprocessing processes (and their imports) at startup instead of on the first request."""
+    if PREPROCESS_WORKERS <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _worker_ready) for _ in range(PREPROCESS_WORKERS)))
+
+
+def shutdown_preprocess_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_cpu_bound(fn, *args):
+    """Run a picklable module-level function off the event loop: in the process pool when configured, else the thread pool."""
+    if PREPROCESS_WORKERS > 0:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), fn, *args)
+    return await run_in_threadpool(fn, *args)
+
+
+async def preprocess_image_async(image_bytes: bytes, options: PreprocessOptions) -> tuple[bytes, str | None]:
+    """Run preprocess_image off the event loop (in the process pool when configured) and record metrics."""
+    start_time = time.time()
+    with timed(PREPROCESS_SECONDS, "preprocess_image"):
+        result = await run_cpu_bound(preprocess_image, image_bytes, options)
+    preprocess_stats.observe(len(image_bytes), len(result[0]), time.time() - start_time)
+    IMAGE_BYTES.observe(len(result[0]), endpoint=current_endpoint.get(), stage="preprocessed")
+    return result
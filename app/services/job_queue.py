@@ -0,0 +1,304 @@
+# app/services/job_queue.py
+import os
+import time
+import json
+import uuid
+import random
+import sqlite3
+import asyncio
+import threading
+from fastapi.concurrency import run_in_threadpool
+from services.metrics import JOB_QUEUE_DEPTH, JOB_RUN_SECONDS, JOB_WAIT_SECONDS
+
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_BASE_SECONDS = float(os.getenv('JOB_RETRY_BASE_SECONDS', '2'))
+JOB_RETRY_MAX_SECONDS = float(os.getenv('JOB_RETRY_MAX_SECONDS', '60'))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv('JOB_POLL_INTERVAL_SECONDS', '1'))
+# A running job whose worker has not finished it within the lease is handed out again
+# (covers crashed processes when several workers share one queue file).
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '600'))
+JOB_WEBHOOK_TIMEOUT_SECONDS = float(os.getenv('JOB_WEBHOOK_TIMEOUT_SECONDS', '10'))
+
+JOB_COLUMNS = (
+    "id", "url", "use_cache", "callback_url", "status", "attempts", "result", "error",
+    "created_at", "run_after", "started_at", "finished_at", "options",
+)
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler for failures that retrying cannot fix (bad URL, unparsable document...)."""
+
+
+class JobStore:
+    """SQLite-backed persistent queue. Safe to share between threads and between processes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " url TEXT NOT NULL,"
+            " use_cache INTEGER NOT NULL,"
+            " callback_url TEXT,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " result TEXT,"
+            " error TEXT,"
+            " created_at REAL NOT NULL,"
+            " run_after REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " options TEXT)"
+        )
+        # Queue files created before per-job pipeline options existed
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "options" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_run_after ON jobs (status, run_after)")
+
+    def _row_to_job(self, row) -> dict | None:
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        job["use_cache"] = bool(job["use_cache"])
+        job["options"] = json.loads(job["options"]) if job["options"] else {}
+        return job
+
+    def enqueue(self, url: str, use_cache: bool = True, callback_url: str | None = None, options: dict | None = None) -> dict:
+        """Queue a job; ``options`` are the pipeline settings handed back to the handler (JSON-serializable)."""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, url, use_cache, callback_url, status, created_at, run_after, options)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, url, int(use_cache), callback_url, now, now, json.dumps(options) if options else None),
+            )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._row_to_job(row)
+
+    def claim_next(self) -> dict | None:
+        """Atomically move the oldest runnable job to 'running' and return it."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?"
+                    " WHERE id = ("
+                    "  SELECT id FROM jobs"
+                    "  WHERE (status = 'queued' AND run_after <= ?)"
+                    "     OR (status = 'running' AND started_at < ?)"
+                    "  ORDER BY run_after LIMIT 1)"
+                    f" RETURNING {', '.join(JOB_COLUMNS)}",
+                    (now, now, now - JOB_LEASE_SECONDS),
+                ).fetchone()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self._row_to_job(row)
+
+    def complete(self, job_id: str, result: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, finished_at = ? WHERE id = ?",
+                (result, time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str, retry_at: float | None) -> None:
+        """Record a failed attempt; requeue it for ``retry_at`` or mark it failed for good."""
+        with self._lock:
+            if retry_at is None:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (error, time.time(), job_id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, run_after = ? WHERE id = ?",
+                    (error, retry_at, job_id),
+                )
+
+    def release(self, job_id: str) -> None:
+        """Hand a job back to the queue without counting the interrupted attempt (used on shutdown)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, run_after = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def depth(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JobMetrics:
+    """Running aggregates for sizing the worker pool."""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.run_seconds_total = 0.0
+        self.run_seconds_max = 0.0
+        self.started = 0
+        self.finished = 0
+
+    def observe_start(self, wait_seconds: float) -> None:
+        JOB_WAIT_SECONDS.observe(wait_seconds)
+        self.started += 1
+        self.wait_seconds_total += wait_seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def observe_run(self, run_seconds: float, outcome: str) -> None:
+        JOB_RUN_SECONDS.observe(run_seconds, outcome=outcome)
+        self.finished += 1
+        self.run_seconds_total += run_seconds
+        self.run_seconds_max = max(self.run_seconds_max, run_seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "avg_wait_seconds": round(self.wait_seconds_total / self.started, 3) if self.started else 0.0,
+            "max_wait_seconds": round(self.wait_seconds_max, 3),
+            "avg_run_seconds": round(self.run_seconds_total / self.finished, 3) if self.finished else 0.0,
+            "max_run_seconds": round(self.run_seconds_max, 3),
+        }
+
+
+class JobWorkerPool:
+    """
+    Drains the JobStore with ``workers`` asyncio tasks. ``handler(job)`` must
+    return the JSON string to store as the job result. Failures are retried
+    with jittered exponential backoff unless the handler raises
+    PermanentJobError. If the job has a callback URL, a webhook is POSTed
+    once it finishes.
+    """
+
+    def __init__(self, store: JobStore, handler, http_client, workers: int = JOB_WORKERS):
+        self.store = store
+        self.handler = handler
+        self.http_client = http_client
+        self.workers = workers
+        self.metrics = JobMetrics()
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def start(self) -> None:
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker_loop()) for _ in range(self.workers)]
+
+    async def stop(self, drain_seconds: float = 0.0) -> None:
+        """
+        Stop claiming jobs and give running ones up to ``drain_seconds`` to
+        finish. Whatever is still running after that is cancelled and goes
+        back to the queue for the next process to pick up.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if drain_seconds > 0 and self._tasks:
+            await asyncio.wait(self._tasks, timeout=drain_seconds)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        """Wake idle workers right away instead of waiting for the next poll."""
+        self._wakeup.set()
+
+    async def _worker_loop(self) -> None:
+        while not self._stopping:
+            job = await run_in_threadpool(self.store.claim_next)
+            if job is None:
+                if self._stopping:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    async def _run_job(self, job: dict) -> None:
+        started_at = job["started_at"]
+        self.metrics.observe_start(max(0.0, started_at - job["run_after"]))
+        try:
+            result = await self.handler(job)
+        except asyncio.CancelledError:
+            await run_in_threadpool(self.store.release, job["id"])
+            raise
+        except Exception as e:
+            retryable = not isinstance(e, PermanentJobError) and job["attempts"] < JOB_MAX_ATTEMPTS
+            self.metrics.observe_run(time.time() - started_at, "retry" if retryable else "failed")
+            if retryable:
+                delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1))
+                delay *= random.uniform(0.5, 1.5)
+                self.metrics.retried += 1
+                print(f"[job {job['id']}] Attempt {job['attempts']} failed, retrying in {delay:.1f}s: {e}")
+                await run_in_threadpool(self.store.fail, job["id"], str(e), time.time() + delay)
+                return
+            self.metrics.failed += 1
+            print(f"[job {job['id']}] Failed after {job['attempts']} attempt(s): {e}")
+            await run_in_threadpool(self.store.fail, job["id"], str(e), None)
+        else:
+            self.metrics.observe_run(time.time() - started_at, "succeeded")
+            self.metrics.succeeded += 1
+            await run_in_threadpool(self.store.complete, job["id"], result)
+
+        if job["callback_url"]:
+            await self._send_webhook(job["id"], job["callback_url"])
+
+    async def _send_webhook(self, job_id: str, callback_url: str) -> None:
+        job = await run_in_threadpool(self.store.get, job_id)
+        payload = {key: job[key] for key in ("id", "status", "attempts", "error", "created_at", "started_at", "finished_at")}
+        try:
+            response = await self.http_client.post(
+                callback_url,
+                content=_webhook_body(payload, job["result"]),
+                headers={"Content-Type": "application/json"},
+                timeout=JOB_WEBHOOK_TIMEOUT_SECONDS,
+            )
+            if response.status_code >= 400:
+                print(f"[job {job_id}] Webhook returned status {response.status_code}")
+        except Exception as e:
+            print(f"[job {job_id}] Webhook delivery failed: {e}")
+
+    def stats(self) -> dict:
+        depth = self.store.depth()
+        for status in ("queued", "running", "succeeded", "failed"):
+            JOB_QUEUE_DEPTH.set(depth.get(status, 0), status=status)
+        return {
+            "workers": self.workers,
+            "depth": depth,
+            **self.metrics.snapshot(),
+        }
+
+
+def _webhook_body(payload: dict, result: str | None) -> str:
+    # The stored result is already serialized JSON; splice it in rather than re-encoding it.
+    body = json.dumps(payload)
+    return body[:-1] + f', "result": {result if result is not None else "null"}}}'
@@ -0,0 +1,259 @@
+# app/services/metrics.py
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    # Optional: spans are exported when an OpenTelemetry SDK is installed and configured
+    from opentelemetry import trace as _otel_trace
+    _tracer = _otel_trace.get_tracer("ocr-service")
+except ImportError:
+    _tracer = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+BYTES_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000, 20_000_000)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+# Route template of the request being served ("/process_document", "/jobs/{job_id}", ...).
+# Background work such as job workers sets its own value.
+current_endpoint: contextvars.ContextVar[str] = contextvars.ContextVar("current_endpoint", default="none")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def _render_series(self, key, series) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series["counts"]):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "HTTP requests served.", ("endpoint", "method", "status")))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "End-to-end HTTP request latency.", ("endpoint", "method")))
+DOWNLOAD_SECONDS = REGISTRY.register(Histogram(
+    "ocr_download_seconds", "Time spent downloading documents.", ("endpoint",)))
+PREPROCESS_SECONDS = REGISTRY.register(Histogram(
+    "ocr_preprocess_seconds", "Time spent preprocessing images.", ("endpoint",)))
+IMAGE_BYTES = REGISTRY.register(Histogram(
+    "ocr_image_bytes", "Document/image size at each stage (downloaded, roi_composite, preprocessed).", ("endpoint", "stage"), BYTES_BUCKETS))
+MODEL_SECONDS = REGISTRY.register(Histogram(
+    "gemini_call_seconds", "Latency of Gemini calls.", ("endpoint", "model", "call", "document_type")))
+PARSE_SECONDS = REGISTRY.register(Histogram(
+    "ocr_parse_seconds", "Time spent parsing and validating model output.", ("endpoint", "model", "document_type")))
+TOKENS = REGISTRY.register(Counter(
+    "gemini_tokens_total", "Tokens reported by usage_metadata.", ("endpoint", "model", "call", "document_type", "kind")))
+TOKENS_PER_CALL = REGISTRY.register(Histogram(
+    "gemini_tokens_per_call", "Tokens per Gemini call.", ("endpoint", "model", "call", "kind"), TOKEN_BUCKETS))
+PIPELINE_SECONDS = REGISTRY.register(Histogram(
+    "ocr_pipeline_seconds", "Time to produce ProcessedDocumentData for one image.", ("endpoint", "document_type", "cache")))
+FIRST_FIELD_SECONDS = REGISTRY.register(Histogram(
+    "ocr_stream_first_field_seconds", "Time from the start of a streamed Gemini call to its first complete field.", ("endpoint",)))
+GEMINI_IN_FLIGHT = REGISTRY.register(Gauge(
+    "gemini_calls_in_flight", "Gemini calls currently running in this process."))
+GEMINI_RETRIES = REGISTRY.register(Counter(
+    "gemini_retries_total", "Gemini calls retried, by status code or error type.", ("model", "reason")))
+GEMINI_LIMITER_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "gemini_limiter_wait_seconds", "Time a call waited for the rate limiter and the concurrency limit."))
+GEMINI_BREAKER_OPEN = REGISTRY.register(Gauge(
+    "gemini_circuit_open", "1 while a backend's circuit breaker is open or half-open.", ("backend",)))
+GEMINI_BACKEND_CALLS = REGISTRY.register(Counter(
+    "gemini_backend_calls_total", "Gemini call attempts per backend and outcome.", ("backend", "outcome")))
+GEMINI_BACKEND_LATENCY = REGISTRY.register(Gauge(
+    "gemini_backend_latency_ewma_seconds", "Latency average the router uses for each backend.", ("backend",)))
+GEMINI_HEDGE_CALLS = REGISTRY.register(Counter(
+    "gemini_hedgeable_calls_total", "Calls made with hedging enabled.", ("call",)))
+GEMINI_HEDGES = REGISTRY.register(Counter(
+    "gemini_hedges_total", "Hedge decisions for calls that outlived the hedge delay.", ("call", "result")))
+GEMINI_HEDGE_WINS = REGISTRY.register(Counter(
+    "gemini_hedge_wins_total", "Which call of a hedged pair answered first.", ("call", "winner")))
+VERIFICATION_OUTCOMES = REGISTRY.register(Counter(
+    "ocr_verification_total", "Outcome of verified-quality extractions.", ("outcome",)))
+VERIFICATION_MISMATCHES = REGISTRY.register(Counter(
+    "ocr_verification_mismatches_total", "Key fields the raw OCR text did not back up.", ("field",)))
+COALESCED_REQUESTS = REGISTRY.register(Counter(
+    "ocr_coalesced_requests_total", "Requests that joined an identical in-flight pipeline call instead of starting one.", ("endpoint",)))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "ocr_startup_seconds", "Cold start of this worker process by phase (import, warmup, total).", ("phase",)))
+NEAR_DUPLICATE_LOOKUPS = REGISTRY.register(Counter(
+    "ocr_near_duplicate_lookups_total", "Perceptual-hash lookups for rescans of an already processed page.", ("result",)))
+FORM_TEMPLATE_MATCHES = REGISTRY.register(Counter(
+    "ocr_form_template_matches_total", "Pages aligned to a form template (template=\"none\" when none matched).", ("template",)))
+FORM_TEMPLATE_SECONDS = REGISTRY.register(Histogram(
+    "ocr_form_template_seconds", "Time to align a page to the form templates and build its region composite.", ("endpoint",)))
+CHECKBOX_READS = REGISTRY.register(Counter(
+    "ocr_checkbox_reads_total", "Template checkboxes read locally, by result (checked, empty, uncertain).", ("result",)))
+CHECKBOX_COMPARISONS = REGISTRY.register(Counter(
+    "ocr_checkbox_comparisons_total", "Confident local checkbox reads compared with the model's value (agree, disagree).", ("result",)))
+CHECKBOX_DISAGREEMENTS = REGISTRY.register(Counter(
+    "ocr_checkbox_disagreements_total", "Confident local checkbox reads the model's value contradicted, by field.", ("field",)))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "ocr_cache_lookups_total", "Result cache lookups.", ("result",)))
+JOB_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "ocr_job_queue_depth", "Jobs in the queue by status (sampled at scrape time).", ("status",)))
+JOB_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "ocr_job_wait_seconds", "Time a job waited in the queue before a worker picked it up."))
+JOB_RUN_SECONDS = REGISTRY.register(Histogram(
+    "ocr_job_run_seconds", "Time a worker spent on one job attempt.", ("outcome",)))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """OpenTelemetry span when the SDK is available, otherwise a no-op."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes={key: str(value) for key, value in attributes.items()}) as current:
+        yield current
+
+
+@contextmanager
+def timed(histogram: Histogram, span_name: str | None = None, **labels):
+    """Observe the duration of the block in ``histogram`` (and wrap it in a span)."""
+    labels.setdefault("endpoint", current_endpoint.get())
+    start_time = time.perf_counter()
+    with span(span_name or histogram.name, **labels):
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start_time, **labels)
+
+
+def observe_usage(response, model: str, call: str, document_type: str = "unknown") -> None:
+    """Record prompt/output/thinking tokens from a genai response's usage_metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    endpoint = current_endpoint.get()
+    for kind, count in (
+        ("prompt", usage.prompt_token_count),
+        ("output", usage.candidates_token_count),
+        ("thoughts", getattr(usage, "thoughts_token_count", None)),
+    ):
+        if count:
+            TOKENS.inc(count, endpoint=endpoint, model=model, call=call, document_type=document_type, kind=kind)
+            TOKENS_PER_CALL.observe(count, endpoint=endpoint, model=model, call=call, kind=kind)
+
+
+def observe_model_call(response, model: str, call: str, seconds: float, document_type: str = "unknown") -> None:
+    """Record latency and token usage of one Gemini call."""
+    MODEL_SECONDS.observe(seconds, endpoint=current_endpoint.get(), model=model, call=call, document_type=document_type)
+    observe_usage(response, model, call, document_type)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
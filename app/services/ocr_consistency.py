@@ -0,0 +1,95 @@
+# app/services/ocr_consistency.py
+import os
+import re
+import unicodedata
+import editdistance
+from models import ProcessedDocumentData
+
+# Key fields of the one-shot extraction that must also appear in the raw OCR text.
+# Phone numbers are compared as digits only, so spacing and separators do not count.
+CONSISTENCY_TEXT_FIELDS = ("full_name", "test_code")
+CONSISTENCY_DIGIT_FIELDS = ("phone", "doctor_phone")
+# Largest edit distance, as a fraction of the field's length, that still counts as a match.
+# Names tolerate small differences (diacritics, spacing); identifiers are wrong if one digit is.
+CONSISTENCY_MAX_DISTANCE = float(os.getenv('CONSISTENCY_MAX_DISTANCE', '0.2'))
+CONSISTENCY_MAX_ID_DISTANCE = float(os.getenv('CONSISTENCY_MAX_ID_DISTANCE', '0.0'))
+CONSISTENCY_ID_FIELDS = ("test_code",) + CONSISTENCY_DIGIT_FIELDS
+
+_NON_WORD = re.compile(r"[^\w]+")
+_NON_DIGIT = re.compile(r"\D+")
+# A run of digits with the separators people write phone numbers with
+_DIGIT_RUN = re.compile(r"\+?\d[\d\s.\-()]*\d")
+
+
+def _words(text: str) -> list[str]:
+    text = unicodedata.normalize("NFC", text).casefold()
+    return _NON_WORD.sub(" ", text).split()
+
+
+def _digits(text: str) -> str:
+    return _NON_DIGIT.sub("", text)
+
+
+def _text_distance(value: str, ocr_words: list[str], ocr_joined: str) -> float:
+    """Smallest normalized edit distance between ``value`` and any run of as many OCR words."""
+    words = _words(value)
+    target = " ".join(words)
+    if not target:
+        return 0.0
+    if f" {target} " in f" {ocr_joined} ":
+        return 0.0
+    best = len(target)
+    span = len(words)
+    for start in range(max(1, len(ocr_words) - span + 1)):
+        best = min(best, editdistance.eval(target, " ".join(ocr_words[start:start + span])))
+        if best == 0:
+            break
+    return best / len(target)
+
+
+def _digit_distance(value: str, ocr_digit_runs: list[str]) -> float:
+    """Smallest normalized edit distance between the digits of ``value`` and any digit run of the OCR text."""
+    target = _digits(value)
+    if not target:
+        return 0.0
+    best = len(target)
+    for run in ocr_digit_runs:
+        if target in run:
+            return 0.0
+        best = min(best, editdistance.eval(target, run))
+    return best / len(target)
+
+
+def field_distances(structured_data: ProcessedDocumentData, ocr_text: str) -> dict[str, float]:
+    """
+    Normalized edit distance (0 is an exact match, 1 nothing alike) between
+    each non-empty key field of ``structured_data`` and its closest match
+    in ``ocr_text``. Fields the extraction left empty are not reported.
+    """
+    ocr_words = _words(ocr_text)
+    ocr_joined = " ".join(ocr_words)
+    ocr_digit_runs = [_digits(run) for run in _DIGIT_RUN.findall(ocr_text)]
+
+    distances = {}
+    for field in CONSISTENCY_TEXT_FIELDS:
+        value = getattr(structured_data, field, "") or ""
+        if value.strip():
+            distances[field] = _text_distance(value, ocr_words, ocr_joined)
+    for field in CONSISTENCY_DIGIT_FIELDS:
+        value = getattr(structured_data, field, "") or ""
+        if _digits(value):
+            distances[field] = _digit_distance(value, ocr_digit_runs)
+    return distances
+
+
+def inconsistent_fields(
+    structured_data: ProcessedDocumentData,
+    ocr_text: str,
+    max_distance: float = CONSISTENCY_MAX_DISTANCE,
+    max_id_distance: float = CONSISTENCY_MAX_ID_DISTANCE,
+) -> list[str]:
+    """Key fields whose extracted value the raw OCR text does not back up."""
+    return [
+        field for field, distance in field_distances(structured_data, ocr_text).items()
+        if distance > (max_id_distance if field in CONSISTENCY_ID_FIELDS else max_distance)
+    ]
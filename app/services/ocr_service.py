@@ -3,76 +3,42 @@ import os
 import io
 import time
 import asyncio
-from dotenv import load_dotenv
-from google import genai
 from google.genai import types
-from fastapi.concurrency import run_in_threadpool # To handle blocking API calls
 import json
 from PIL import Image
+from pydantic import BaseModel
 from models import Data,ProcessedDocumentData # Import the Pydantic model
+from services.gemini_client import (
+    generate_content, generate_content_hedged, generate_content_stream, get_backend_pool,
+)
+from services.result_cache import RESULT_CACHE_ENABLED, result_cache, make_cache_key, schema_version
+from services.image_preprocessing import default_preprocess_options, make_thumbnail, preprocess_image_async
+from services.document_schemas import (
+    PROCESSED_DOCUMENT_ADAPTER, DocumentClassification, expand_to_full, get_model_field_path, model_without, path_crosses_list, response_json_schema, set_model_field_path, slim_model_for,
+)
+from services.document_pages import (
+    DOCUMENT_MAX_PAGES, MULTIPAGE_MIME_TYPES, PAGE_MAX_CONCURRENCY,
+    DocumentError, iter_pages, merge_page_results, page_count, sniff_mime_type,
+)
+from models import PreprocessOptions
+from fastapi.concurrency import run_in_threadpool
+from services.metrics import (
+    CHECKBOX_COMPARISONS, CHECKBOX_DISAGREEMENTS, FIRST_FIELD_SECONDS, PARSE_SECONDS, PIPELINE_SECONDS, VERIFICATION_MISMATCHES, VERIFICATION_OUTCOMES,
+    current_endpoint, observe_model_call,
+)
+from services.partial_json import IncrementalJSONParser
+from services.ocr_consistency import inconsistent_fields
+from services.single_flight import REQUEST_COALESCING_ENABLED, pipeline_flights
+from services.perceptual_index import PERCEPTUAL_DEDUP_MODE, DuplicatePage, lookup_near_duplicate, perceptual_index
+from services.form_templates import (
+    FORM_CHECKBOX_DROP_FROM_SCHEMA, FORM_CHECKBOX_EMPTY, FORM_CHECKBOX_FILLED, FORM_CHECKBOX_MODE, FORM_ROI_ENABLED,
+    FormMatch, get_template_registry, match_form_template, templates_fingerprint,
+)
 
-load_dotenv()
-api_key = os.getenv('GOOGLE_API_KEY')
-
-if not api_key:
-    raise ValueError("GOOGLE_API_KEY not found in environment variables.")
-
-# Initialize Gemini Client once
-# It's generally safe to initialize the client globally in FastAPI
-# as long as it doesn't hold user-specific state.
-try:
-    client = genai.Client(api_key=api_key)
-    # Optional: Test connection
-    # print("Gemini client initialized successfully.")
-except Exception as e:
-    print(f"Error initializing Gemini client: {e}")
-    # Depending on severity, you might want to raise the exception
-    # or have a health check endpoint.
-
-def preprocess_image(image_bytes: bytes, max_width: int = 1200, max_height: int = 1600) -> bytes:
-    """
-    Preprocess image to reduce size and improve OCR performance.
-    - Resize to reasonable dimensions
-    - Convert to grayscale (optional, but can speed up processing)
-    - Compress to reduce file size
-    """
-    try:
-        # Open image from bytes
-        img = Image.open(io.BytesIO(image_bytes))
-        
-        # Convert to RGB if necessary (handles RGBA, P mode, etc.)
-        if img.mode not in ('RGB', 'L'):
-            img = img.convert('RGB')
-        
-        # Calculate new size maintaining aspect ratio
-        width, height = img.size
-        if width > max_width or height > max_height:
-            # Calculate scaling factor
-            scale_factor = min(max_width / width, max_height / height)
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Convert to grayscale to potentially speed up processing
-        # Comment this line if you need color information
-        # img = img.convert('L')
-        
-        # Save to bytes with optimized compression
-        output_buffer = io.BytesIO()
-        img.save(output_buffer, format='JPEG', quality=85, optimize=True)
-        return output_buffer.getvalue()
-        
-    except Exception as e:
-        print(f"Warning: Image preprocessing failed: {e}")
-        # Return original image if preprocessing fails
-        return image_bytes
+PROCESSED_DOCUMENT_SCHEMA_VERSION = schema_version(ProcessedDocumentData)
 
-async def perform_ocr_and_structure(image_bytes: bytes) -> ProcessedDocumentData:
-    start_time = time.time()
-    """Process image with Gemini Flash for OCR and direct structuring into ProcessedDocumentData model."""
-    
-    # Combined prompt for OCR and structuring in one API call
-    prompt = """Analyze this document image and extract all information, then structure it into a JSON object.
+# Combined prompt for OCR and structuring in one API call
+OCR_AND_STRUCTURE_PROMPT = """Analyze this document image and extract all information, then structure it into a JSON object.
 
     First, extract all text from the document:
     - For tables: keep structure in markdown, include headers and data accurately
@@ -90,47 +56,256 @@ async def perform_ocr_and_structure(image_bytes: bytes) -> ProcessedDocumentData
     
     Return only the structured JSON object."""
 
+# Two-phase mode: classify the form on a thumbnail, then extract with that form's slim schema
+DOCUMENT_ROUTING_ENABLED = os.getenv('DOCUMENT_ROUTING_ENABLED', 'false').lower() == 'true'
+# Form types simple enough to extract with the light model tier
+DOCUMENT_LIGHT_TIER_TYPES = {name.strip() for name in os.getenv('DOCUMENT_LIGHT_TIER_TYPES', '').split(',') if name.strip()}
+DOCUMENT_CLASSIFIER_THUMBNAIL_SIZE = int(os.getenv('DOCUMENT_CLASSIFIER_THUMBNAIL_SIZE', '512'))
+
+CLASSIFY_DOCUMENT_PROMPT = """Classify this medical test requisition form as exactly one of:
+    - hereditary_cancer: hereditary cancer screening (BCARE, 15 or 20 hereditary cancer types)
+    - gene_mutation: tumor gene mutation testing (specimen type, cancer type and test panel such as ONCO 81 / ONCO 500+)
+    - prenatal_screening: non-invasive prenatal testing (pregnancy details, NIPT test options)
+    
+    Return only the JSON object."""
+
+# "fast" runs the one-shot extraction only; "verified" cross-checks it against a raw-text OCR run alongside it
+QUALITY_MODES = ("fast", "verified")
+OCR_QUALITY_MODE = os.getenv('OCR_QUALITY_MODE', 'fast').lower()
+if OCR_QUALITY_MODE not in QUALITY_MODES:
+    raise ValueError(f"OCR_QUALITY_MODE must be one of {', '.join(QUALITY_MODES)}, got {OCR_QUALITY_MODE!r}")
+# Model tier of the raw-text OCR in verified mode; plain transcription is light work
+VERIFY_OCR_TIER = os.getenv('VERIFY_OCR_TIER', 'light')
+
+ROUTED_OCR_AND_STRUCTURE_PROMPT = OCR_AND_STRUCTURE_PROMPT + """
+    
+    This document is a {document_name} form. The schema only contains the fields that apply to this form type."""
+
+# Appended when the page matched a form template and only its annotated regions are sent
+TEMPLATE_COMPOSITE_PROMPT = """
+
+    This image is not the whole page: it shows the regions of a {document_name} form that hold its fields,
+    cropped from the scanned page and packed together in reading order. Treat them as parts of one form."""
+
+
+def _extraction_prompt(prompt: str, form_match: FormMatch | None) -> str:
+    if form_match is None or form_match.composite is None:
+        return prompt
+    return prompt + TEMPLATE_COMPOSITE_PROMPT.format(document_name=form_match.document_name)
+
+
+def _dropped_checkbox_fields(form_match: FormMatch | None) -> frozenset[str]:
+    """Checkbox fields read confidently enough to leave out of the response schema (override mode only)."""
+    if form_match is None or FORM_CHECKBOX_MODE != "override" or not FORM_CHECKBOX_DROP_FROM_SCHEMA:
+        return frozenset()
+    return frozenset(field for field in form_match.confident_checkboxes() if not path_crosses_list(field))
+
+
+def _response_schema(model: type[BaseModel], form_match: FormMatch | None) -> type[BaseModel]:
+    dropped = _dropped_checkbox_fields(form_match)
+    return model_without(model, dropped) if dropped else model
+
+
+def reconcile_checkboxes(structured_data: ProcessedDocumentData, form_match: FormMatch | None) -> ProcessedDocumentData:
+    """
+    Compare the model's checkbox values with the confident local reads of
+    the template's checkboxes (FORM_CHECKBOX_MODE), counting agreements
+    and disagreements per field; in override mode the local read is kept.
+    Fields left out of the response schema are not compared.
+    """
+    readings = form_match.confident_checkboxes() if form_match is not None else {}
+    if FORM_CHECKBOX_MODE == "off" or not readings:
+        return structured_data
+    dropped = _dropped_checkbox_fields(form_match)
+    for field, value in readings.items():
+        current = get_model_field_path(structured_data, field)
+        if field not in dropped:
+            agree = bool(current) == value
+            CHECKBOX_COMPARISONS.inc(result="agree" if agree else "disagree")
+            if not agree:
+                CHECKBOX_DISAGREEMENTS.inc(field=field)
+        if FORM_CHECKBOX_MODE == "override" and current != value:
+            # In place: the values are plain bools, so the model needs no second validation
+            set_model_field_path(structured_data, field, value)
+    return structured_data
+
+async def perform_ocr_and_structure(image_bytes: bytes, mime_type: str = 'image/jpeg', form_match: FormMatch | None = None) -> ProcessedDocumentData:
+    start_time = time.time()
+    """
+    Process image with Gemini Flash for OCR and direct structuring into
+    ProcessedDocumentData model. form_match is set when the page matched a
+    form template: the image may be its region composite, and checkboxes
+    already read locally may be left out of the schema (see form_templates).
+    """
+    response_schema = _response_schema(ProcessedDocumentData, form_match)
+    reduced = response_schema is not ProcessedDocumentData
+
     try:
-        # Use response_schema and response_mime_type to guide Gemini's output
-        response = client.models.generate_content(
-                model="gemini-2.5-flash",
+        # Use response_schema and response_mime_type to guide Gemini's output.
+        # Hedged (when enabled) against stalled calls; a response counts once it parsed.
+        response = await generate_content_hedged(
+                call="ocr_and_structure",
+                tier="standard",
+                accept=lambda response: response.parsed is not None,
                 contents=[
                     types.Part.from_bytes(
                         data=image_bytes,
-                        mime_type='image/jpeg', # Or 'image/png', etc.
+                        mime_type=mime_type,
                     ),
-                    prompt
+                    _extraction_prompt(OCR_AND_STRUCTURE_PROMPT, form_match)
                 ],
                 config={
                     "response_mime_type": "application/json",
-                    "response_schema": ProcessedDocumentData, 
+                    "response_schema": response_json_schema(response_schema) if reduced else response_schema,
                 }
             )
-        
-        # Log số token nếu API hỗ trợ
-        if hasattr(response, 'usage'):
-            print(f"Tokens used: {response.usage.total_tokens}")
-        
+        model_seconds = time.time() - start_time
+
+        parse_start_time = time.time()
         # Pydantic will automatically parse the JSON response into the ProcessedDocumentData model
+        # (a reduced schema leaves it as JSON, validated once when expanded)
         structured_data: ProcessedDocumentData = response.parsed
+        if structured_data is not None and reduced:
+            structured_data = expand_to_full(structured_data)
+        document_type = structured_data.document_name if structured_data is not None else "unknown"
+        observe_model_call(response, response.model_version, "ocr_and_structure", model_seconds, document_type)
 
         if structured_data is None:
             raise ValueError("Gemini returned no parsable structured data.")
 
-        end_time = time.time()
-        print(f"[perform_ocr_and_structure] Time taken: {end_time - start_time:.2f} seconds")
+        PARSE_SECONDS.observe(
+            time.time() - parse_start_time,
+            endpoint=current_endpoint.get(), model=response.model_version, document_type=document_type,
+        )
         return structured_data
     except Exception as e:
         print(f"Error during OCR and structuring: {e}")
         raise
 
-async def perform_initial_ocr(image_bytes: bytes) -> str:
+async def stream_ocr_and_structure(image_bytes: bytes, mime_type: str = 'image/jpeg'):
+    """
+    Streaming variant of perform_ocr_and_structure. Yields ``("field", {"path",
+    "value"})`` for every field as soon as the model has written it (paths
+    use the JSON aliases), then ``("result", ProcessedDocumentData)`` once the
+    whole response has been validated.
+    """
+    start_time = time.time()
+    parser = IncrementalJSONParser()
+    text_parts = []
+    last_chunk = None
+    first_field_seen = False
+    async for chunk in generate_content_stream(
+            tier="standard",
+            contents=[
+                types.Part.from_bytes(
+                    data=image_bytes,
+                    mime_type=mime_type,
+                ),
+                OCR_AND_STRUCTURE_PROMPT
+            ],
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": ProcessedDocumentData,
+            }
+        ):
+        last_chunk = chunk
+        text = chunk.text
+        if not text:
+            continue
+        text_parts.append(text)
+        for path, value in parser.feed(text):
+            if not first_field_seen:
+                first_field_seen = True
+                FIRST_FIELD_SECONDS.observe(time.time() - start_time, endpoint=current_endpoint.get())
+            yield "field", {"path": list(path), "value": value}
+    if last_chunk is None:
+        raise ValueError("Gemini returned an empty stream.")
+    model_seconds = time.time() - start_time
+
+    parse_start_time = time.time()
+    structured_data = PROCESSED_DOCUMENT_ADAPTER.validate_json("".join(text_parts))
+    observe_model_call(last_chunk, last_chunk.model_version, "stream_ocr_and_structure", model_seconds, structured_data.document_name)
+    PARSE_SECONDS.observe(
+        time.time() - parse_start_time,
+        endpoint=current_endpoint.get(), model=last_chunk.model_version, document_type=structured_data.document_name,
+    )
+    yield "result", structured_data
+
+async def classify_document_type(image_bytes: bytes) -> str:
+    """Cheap first phase of routing: ask a small model which form type a thumbnail of the page shows."""
+    thumbnail = await run_in_threadpool(make_thumbnail, image_bytes, DOCUMENT_CLASSIFIER_THUMBNAIL_SIZE)
+    model_start_time = time.time()
+    response = await generate_content(
+            tier="light",
+            contents=[
+                types.Part.from_bytes(
+                    data=thumbnail,
+                    mime_type=sniff_mime_type(thumbnail) or 'image/jpeg',
+                ),
+                CLASSIFY_DOCUMENT_PROMPT
+            ],
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": DocumentClassification,
+            }
+        )
+    classification: DocumentClassification = response.parsed
+    document_type = classification.document_name if classification is not None else "unknown"
+    observe_model_call(response, response.model_version, "classify", time.time() - model_start_time, document_type)
+    if classification is None:
+        raise ValueError("Gemini returned no document classification.")
+    return classification.document_name
+
+async def perform_routed_ocr_and_structure(image_bytes: bytes, mime_type: str = 'image/jpeg', form_match: FormMatch | None = None) -> ProcessedDocumentData:
+    """
+    Two-phase variant of perform_ocr_and_structure: classify first, then
+    extract against a schema holding only that form type's sections, so the
+    model reads and writes far fewer fields. The result is expanded back to
+    the full ProcessedDocumentData shape. A page that matched a form
+    template is already classified, so the classification call is skipped.
+    """
+    document_name = form_match.document_name if form_match is not None else await classify_document_type(image_bytes)
+    slim_model = _response_schema(slim_model_for(document_name), form_match)
+    tier = "light" if document_name in DOCUMENT_LIGHT_TIER_TYPES else "standard"
+
+    try:
+        model_start_time = time.time()
+        response = await generate_content(
+                tier=tier,
+                contents=[
+                    types.Part.from_bytes(
+                        data=image_bytes,
+                        mime_type=mime_type,
+                    ),
+                    _extraction_prompt(ROUTED_OCR_AND_STRUCTURE_PROMPT.format(document_name=document_name), form_match)
+                ],
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": response_json_schema(slim_model),
+                }
+            )
+        observe_model_call(response, response.model_version, "routed_ocr_and_structure", time.time() - model_start_time, document_name)
+
+        parse_start_time = time.time()
+        slim_data = response.parsed
+
+        if slim_data is None:
+            raise ValueError("Gemini returned no parsable structured data.")
+
+        structured_data = expand_to_full(slim_data, document_name)
+        PARSE_SECONDS.observe(
+            time.time() - parse_start_time,
+            endpoint=current_endpoint.get(), model=response.model_version, document_type=document_name,
+        )
+        return structured_data
+    except Exception as e:
+        print(f"Error during routed OCR and structuring: {e}")
+        raise
+
+async def perform_initial_ocr(image_bytes: bytes, mime_type: str = 'image/jpeg', tier: str = "standard") -> str:
     start_time = time.time()
     """Process image with Gemini Flash for initial text extraction (OCR)."""
     
-    # Preprocess image to reduce size and improve speed
-    # processed_image = preprocess_image(image_bytes)
-    
     # Simplified prompt for faster processing
     prompt = """Extract all text from this document page. 
     - For tables: keep structure in markdown, include headers and data accurately
@@ -138,35 +313,47 @@ async def perform_initial_ocr(image_bytes: bytes) -> str:
     - Keep headers, footers, page numbers, and paragraph breaks
     Be accurate and complete."""
 
-    # Gemini's sync client methods need to be run in a thread pool
-    # to avoid blocking the FastAPI async event loop.
+    # generate_content goes through the SDK's async client so the
+    # FastAPI event loop is never blocked while Gemini is working.
     try:
-        response = client.models.generate_content(
-                model="gemini-2.5-flash",
+        response = await generate_content(
+                tier=tier,
                 contents=[
                     types.Part.from_bytes(
                         data=image_bytes,
-                        mime_type='image/jpeg', # Or 'image/png', etc.
+                        mime_type=mime_type,
                     ),
                     prompt
                 ]
             )
-        # Log số token nếu API hỗ trợ
-        if hasattr(response, 'usage'):
-            print(f"Tokens used: {response.usage.total_tokens}")
-        
+        observe_model_call(response, response.model_version, "initial_ocr", time.time() - start_time)
+
         result = response.text
-        end_time = time.time()
-        print(f"[perform_initial_ocr] Time taken: {end_time - start_time:.2f} seconds")
+        if not result:
+            raise ValueError("Gemini returned no OCR text.")
         return result
     except Exception as e:
         print(f"Error during initial OCR: {e}")
         # Re-raise or handle appropriately
         raise
 
-async def verify_ocr_text(image_bytes: bytes, extracted_text: str) -> str:
+async def verify_ocr_text(
+    image_bytes: bytes,
+    extracted_text: str,
+    mime_type: str = 'image/jpeg',
+    suspect_fields: dict[str, str] | None = None,
+) -> str:
     start_time = time.time()
-    """Verify the quality of OCR results against the original image."""
+    """
+    Verify the quality of OCR results against the original image. Returns
+    the full corrected text; suspect_fields (field name -> value read by
+    another pass) are pointed out to the model as likely trouble spots.
+    """
+    suspects = ""
+    if suspect_fields:
+        suspects = "\n    Another reading of this page disagrees with the text on these fields; check them carefully:\n" + "".join(
+            f"    - {field}: {value!r}\n" for field, value in suspect_fields.items()
+        )
     prompt = f"""
     I have a document page and text that was extracted from it using OCR.
 
@@ -175,27 +362,26 @@ async def verify_ocr_text(image_bytes: bytes, extracted_text: str) -> str:
     - Missing text sections or paragraphs.
     - Major incorrect words or numbers.
     - Obvious table or list structure issues if present.
-
-    Report back the *verified* or *corrected* text if significant errors were found, or confirm if it looks accurate.
+    {suspects}
+    Report back the complete *verified* or *corrected* text, and nothing else, even if it needed no changes.
 
     Extracted text:
     {extracted_text}
     """
 
     try:
-        response = client.models.generate_content(
-                model="gemini-2.5-flash",
+        response = await generate_content(
+                tier="standard",
                 contents=[
                     types.Part.from_bytes(
                         data=image_bytes,
-                        mime_type='image/jpeg',
+                        mime_type=mime_type,
                     ),
                     prompt
                 ]
             )
+        observe_model_call(response, response.model_version, "verify_ocr_text", time.time() - start_time)
         result = response.text # This text is the verification feedback/corrected text
-        end_time = time.time()
-        print(f"[verify_ocr_text] Time taken: {end_time - start_time:.2f} seconds")
         return result
     except Exception as e:
         print(f"Error during OCR verification: {e}")
@@ -219,10 +405,13 @@ async def structure_data_from_text(processed_text: str):
     """
 
     try:
-        # Use response_schema and response_mime_type to guide Gemini's output
-        response = client.models.generate_content(
+        # Use response_schema and response_mime_type to guide Gemini's output.
+        # Hedged (when enabled) against stalled calls; a response counts once it parsed.
+        response = await generate_content_hedged(
+                call="structure_data_from_text",
+                tier="standard",
+                accept=lambda response: response.parsed is not None,
                 contents=[prompt],
-                model="gemini-2.5-flash",
                 config={
                     "response_mime_type": "application/json",
                     "response_schema": ProcessedDocumentData, 
@@ -232,13 +421,13 @@ async def structure_data_from_text(processed_text: str):
         # Pydantic will automatically parse the JSON response into the Data model
         # when using response_schema with the client.
         structured_data: ProcessedDocumentData = response.parsed # Access the parsed model
+        document_type = structured_data.document_name if structured_data is not None else "unknown"
+        observe_model_call(response, response.model_version, "structure_data_from_text", time.time() - start_time, document_type)
 
         if structured_data is None:
              # This can happen if Gemini returns non-parsable JSON or an empty response
              raise ValueError("Gemini returned no parsable structured data.")
 
-        end_time = time.time()
-        print(f"[structure_data_from_text] Time taken: {end_time - start_time:.2f} seconds")
         return structured_data
     except Exception as e:
         print(f"Error structuring data from text: {e}")
@@ -246,14 +435,331 @@ async def structure_data_from_text(processed_text: str):
         raise
 
 
+async def perform_verified_ocr_and_structure(
+    image_bytes: bytes, mime_type: str = 'image/jpeg', routing: bool = False, form_match: FormMatch | None = None,
+) -> ProcessedDocumentData:
+    """
+    "verified" quality mode. The one-shot extraction and a raw-text OCR of
+    the same image run concurrently; once both are in, the key fields of the
+    extraction are checked against the OCR text locally (edit distance, no
+    model call). Only when they disagree does the costly correction pass run:
+    the OCR text is checked against the image and structured again. A clean
+    document therefore costs one extra parallel call but hardly any latency.
+    If one of the two concurrent calls fails, the other one's result is used.
+
+    The extraction is deliberately not returned before the OCR text is in:
+    a response that went out unchecked could not be corrected afterwards,
+    so "verified" would not mean anything. On the light tier the OCR call
+    usually finishes before the extraction, so the wait is rarely visible.
+    """
+    if routing:
+        extraction = perform_routed_ocr_and_structure(image_bytes, mime_type, form_match)
+    else:
+        extraction = perform_ocr_and_structure(image_bytes, mime_type, form_match)
+    tasks = [
+        asyncio.create_task(extraction),
+        asyncio.create_task(perform_initial_ocr(image_bytes, mime_type, tier=VERIFY_OCR_TIER)),
+    ]
+    try:
+        structured_data, ocr_text = await asyncio.gather(*tasks, return_exceptions=True)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if isinstance(structured_data, BaseException):
+        if isinstance(ocr_text, BaseException):
+            raise structured_data
+        VERIFICATION_OUTCOMES.inc(outcome="recovered")
+        return await structure_data_from_text(ocr_text)
+    if isinstance(ocr_text, BaseException):
+        VERIFICATION_OUTCOMES.inc(outcome="unverified")
+        return structured_data
+
+    mismatches = inconsistent_fields(structured_data, ocr_text)
+    if not mismatches:
+        VERIFICATION_OUTCOMES.inc(outcome="consistent")
+        return structured_data
+
+    for field in mismatches:
+        VERIFICATION_MISMATCHES.inc(field=field)
+    corrected_text = await verify_ocr_text(
+        image_bytes, ocr_text, mime_type,
+        suspect_fields={field: getattr(structured_data, field) for field in mismatches},
+    )
+    VERIFICATION_OUTCOMES.inc(outcome="corrected")
+    return await structure_data_from_text(corrected_text)
+
+
+def _pipeline_config_parts(preprocess_options: PreprocessOptions, routing: bool, quality: str = "fast", templates: bool = True) -> list[str]:
+    """Every pipeline input besides the image that affects the result."""
+    parts = [
+        ROUTED_OCR_AND_STRUCTURE_PROMPT if routing else OCR_AND_STRUCTURE_PROMPT,
+        get_backend_pool().models_for("standard"),
+        get_backend_pool().models_for("light") + ";" + ",".join(sorted(DOCUMENT_LIGHT_TIER_TYPES)) if routing else "",
+        PROCESSED_DOCUMENT_SCHEMA_VERSION,
+        preprocess_options.model_dump_json(),
+    ]
+    if quality != "fast":
+        # Appended only for non-default modes so existing fast-mode entries stay valid
+        parts.append(f"quality={quality};ocr={get_backend_pool().models_for(VERIFY_OCR_TIER)}")
+    if templates and get_template_registry():
+        # Likewise only with templates configured; editing a template invalidates its pages' results
+        templates_part = f"templates={templates_fingerprint()};roi={FORM_ROI_ENABLED}"
+        if FORM_CHECKBOX_MODE == "override":
+            # Crosscheck mode leaves results as the model gave them; override replaces checkbox values
+            templates_part += (
+                f";checkboxes=override;drop={FORM_CHECKBOX_DROP_FROM_SCHEMA}"
+                f";filled={FORM_CHECKBOX_FILLED};empty={FORM_CHECKBOX_EMPTY}"
+            )
+        parts.append(templates_part)
+    return parts
+
+
+def _pipeline_cache_key(image_bytes: bytes, preprocess_options: PreprocessOptions, routing: bool, quality: str = "fast", templates: bool = True) -> str:
+    return make_cache_key(image_bytes, *_pipeline_config_parts(preprocess_options, routing, quality, templates))
+
 # Example combined function (called from FastAPI endpoint)
-async def process_image_to_structured_data(image_bytes: bytes) -> ProcessedDocumentData:
+async def process_image_to_structured_data(
+    image_bytes: bytes,
+    use_cache: bool = True,
+    preprocess_options: PreprocessOptions | None = None,
+    mime_type: str | None = None,
+    routing: bool | None = None,
+    quality: str | None = None,
+) -> tuple[ProcessedDocumentData, tuple[str, int] | None]:
     start_time = time.time()
-    """Runs the optimized OCR and structuring pipeline in one API call."""
-    
-    # Use the new combined function that does OCR and structuring in one step
-    structured_data = await perform_ocr_and_structure(image_bytes)
+    """
+    Runs the optimized OCR and structuring pipeline in one API call (or two
+    with document-type routing enabled). quality="verified" cross-checks the
+    result against a concurrent raw-text OCR (see perform_verified_ocr_and_structure).
+    Results are cached by image content, prompt, model, schema version,
+    preprocessing options and quality mode; pass use_cache=False to force a
+    fresh Gemini call.
+    With form templates configured (FORM_TEMPLATE_DIR), a page that aligns
+    to one is classified locally and, with FORM_ROI_ENABLED, only its
+    annotated regions are sent, packed into one smaller composite image;
+    its checkboxes are read locally and cross-checked against, or override,
+    the model's values (FORM_CHECKBOX_MODE).
+    With PERCEPTUAL_DEDUP_MODE enabled, an exact miss is looked up by
+    perceptual hash, so a rescan of an already processed page is flagged
+    or answered from that page's cached result. Returns the result and, in
+    flag mode, the (result cache key, distance) of the probable duplicate.
+    On a cache miss, concurrent cached calls for the same cache key share one
+    in-flight pipeline run (REQUEST_COALESCING_ENABLED), so a client retrying
+    while its first request is still running does not pay for Gemini twice.
+    use_cache=False calls always run on their own.
+    The image is preprocessed (off the event loop) only on a cache miss.
+    """
+    preprocess_options = preprocess_options or default_preprocess_options()
+    routing = DOCUMENT_ROUTING_ENABLED if routing is None else routing
+    quality = quality or OCR_QUALITY_MODE
+    if quality not in QUALITY_MODES:
+        raise ValueError(f"Unknown quality mode: {quality}")
+    use_cache = use_cache and RESULT_CACHE_ENABLED
+    config_parts = _pipeline_config_parts(preprocess_options, routing, quality)
+    cache_key = make_cache_key(image_bytes, *config_parts)
+    if use_cache:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            structured_data = PROCESSED_DOCUMENT_ADAPTER.validate_json(cached)
+            PIPELINE_SECONDS.observe(
+                time.time() - start_time,
+                endpoint=current_endpoint.get(), document_type=structured_data.document_name, cache="hit",
+            )
+            return structured_data, None
 
-    end_time = time.time()
-    print(f"[process_image_to_structured_data] Total pipeline time: {end_time - start_time:.2f} seconds")
-    return structured_data
\ No newline at end of file
+    # Near-duplicates can only be answered from (and recorded for) the result cache
+    page_hashes = None
+    duplicate = None
+    if use_cache and PERCEPTUAL_DEDUP_MODE != "off":
+        config = make_cache_key(b"", *config_parts)
+        lookup = await lookup_near_duplicate(image_bytes, config)
+        if lookup is not None:
+            phash, dhash, match = lookup
+            page_hashes = (phash, dhash, config)
+        if lookup is not None and match is not None:
+            match_key, _ = match
+            if PERCEPTUAL_DEDUP_MODE == "flag":
+                duplicate = match
+            else:
+                cached = await result_cache.get(match_key)
+                if cached is not None:
+                    await run_in_threadpool(perceptual_index.touch, match_key)
+                    structured_data = PROCESSED_DOCUMENT_ADAPTER.validate_json(cached)
+                    PIPELINE_SECONDS.observe(
+                        time.time() - start_time,
+                        endpoint=current_endpoint.get(), document_type=structured_data.document_name, cache="near_duplicate",
+                    )
+                    return structured_data, None
+                await run_in_threadpool(perceptual_index.discard, match_key)
+
+    async def run_pipeline() -> ProcessedDocumentData:
+        nonlocal image_bytes, mime_type
+        mime_type = mime_type or sniff_mime_type(image_bytes) or 'image/jpeg'
+        form_match = None
+        if get_template_registry():
+            form_match = await match_form_template(image_bytes)
+            if form_match is not None and form_match.composite is not None:
+                image_bytes, mime_type = form_match.composite, form_match.mime_type
+        if preprocess_options.enabled:
+            image_bytes, processed_mime_type = await preprocess_image_async(image_bytes, preprocess_options)
+            mime_type = processed_mime_type or mime_type
+
+        if quality == "verified":
+            structured_data = await perform_verified_ocr_and_structure(image_bytes, mime_type, routing, form_match)
+        elif routing:
+            structured_data = await perform_routed_ocr_and_structure(image_bytes, mime_type, form_match)
+        else:
+            # Use the new combined function that does OCR and structuring in one step
+            structured_data = await perform_ocr_and_structure(image_bytes, mime_type, form_match)
+        structured_data = reconcile_checkboxes(structured_data, form_match)
+
+        if use_cache:
+            await result_cache.set(cache_key, structured_data.model_dump_json(by_alias=True))
+            if page_hashes is not None:
+                await run_in_threadpool(perceptual_index.add, *page_hashes, cache_key)
+        return structured_data
+
+    cache_outcome = "miss"
+    # A use_cache=False caller asked for a fresh call, and the shared run would cache with its caller's settings
+    if REQUEST_COALESCING_ENABLED and use_cache:
+        if pipeline_flights.is_in_flight(cache_key):
+            cache_outcome = "coalesced"
+        structured_data = await pipeline_flights.do(cache_key, run_pipeline)
+    else:
+        structured_data = await run_pipeline()
+
+    PIPELINE_SECONDS.observe(
+        time.time() - start_time,
+        endpoint=current_endpoint.get(), document_type=structured_data.document_name, cache=cache_outcome,
+    )
+    return structured_data, duplicate
+
+def _close_pages(pages, render: asyncio.Future) -> None:
+    if not render.cancelled():
+        render.exception()  # retrieved, so an unreadable page is not reported as unhandled
+    pages.close()
+
+async def process_document_to_structured_data(
+    document_bytes: bytes,
+    use_cache: bool = True,
+    preprocess_options: PreprocessOptions | None = None,
+    routing: bool | None = None,
+    quality: str | None = None,
+) -> tuple[ProcessedDocumentData, list[DuplicatePage]]:
+    """
+    Entry point for any downloaded document. Single images go straight to
+    process_image_to_structured_data; PDFs and multi-frame TIFFs are split
+    into pages that are rendered lazily and processed concurrently (at most
+    PAGE_MAX_CONCURRENCY pages in flight), then merged into one result.
+    Returns the result and the pages flagged as probable duplicates.
+    """
+    mime_type = sniff_mime_type(document_bytes)
+    if mime_type is None:
+        raise DocumentError(415, "Unsupported document format.")
+    if mime_type not in MULTIPAGE_MIME_TYPES:
+        structured_data, duplicate = await process_image_to_structured_data(
+            document_bytes, use_cache, preprocess_options, mime_type, routing, quality
+        )
+        return structured_data, [] if duplicate is None else [(1, *duplicate)]
+
+    total_pages = await run_in_threadpool(page_count, document_bytes, mime_type)
+    if total_pages > DOCUMENT_MAX_PAGES:
+        raise DocumentError(413, f"Document has {total_pages} pages (limit {DOCUMENT_MAX_PAGES}).")
+
+    semaphore = asyncio.Semaphore(PAGE_MAX_CONCURRENCY)
+
+    async def run_page(page_bytes: bytes, page_mime_type: str) -> tuple[ProcessedDocumentData, tuple[str, int] | None]:
+        try:
+            return await process_image_to_structured_data(page_bytes, use_cache, preprocess_options, page_mime_type, routing, quality)
+        finally:
+            semaphore.release()
+
+    pages = iter_pages(document_bytes, mime_type)
+    tasks = []
+    render = None
+    try:
+        while True:
+            # Render the next page only once a slot is free
+            await semaphore.acquire()
+            render = asyncio.ensure_future(run_in_threadpool(next, pages, None))
+            page = await asyncio.shield(render)
+            if page is None:
+                semaphore.release()
+                break
+            tasks.append(asyncio.create_task(run_page(*page)))
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        if render is not None and not render.done():
+            # Cancelled mid-render: the generator cannot be closed while its thread is still inside it
+            render.add_done_callback(lambda done: _close_pages(pages, done))
+        else:
+            pages.close()
+
+    duplicates = [(number, *duplicate) for number, (_, duplicate) in enumerate(results, 1) if duplicate is not None]
+    return merge_page_results([structured_data for structured_data, _ in results]), duplicates
+
+def _replay_fields(structured_data: ProcessedDocumentData):
+    """Field events for a result that is already complete (cache hits, multi-page documents)."""
+    for path, value in IncrementalJSONParser().feed(structured_data.model_dump_json(by_alias=True)):
+        yield "field", {"path": list(path), "value": value}
+    yield "result", structured_data
+
+async def stream_document_to_structured_data(
+    document_bytes: bytes,
+    use_cache: bool = True,
+    preprocess_options: PreprocessOptions | None = None,
+):
+    """
+    Event stream for /process_document/stream: the same pipeline as
+    process_document_to_structured_data with a single streamed Gemini call,
+    yielding the events of stream_ocr_and_structure. Cache hits and
+    multi-page documents, whose result only exists as a whole, are replayed
+    as field events followed by the result.
+    """
+    start_time = time.time()
+    mime_type = sniff_mime_type(document_bytes)
+    if mime_type is None:
+        raise DocumentError(415, "Unsupported document format.")
+    if mime_type in MULTIPAGE_MIME_TYPES:
+        structured_data, _ = await process_document_to_structured_data(
+            document_bytes, use_cache, preprocess_options, routing=False, quality="fast"
+        )
+        for event in _replay_fields(structured_data):
+            yield event
+        return
+
+    preprocess_options = preprocess_options or default_preprocess_options()
+    use_cache = use_cache and RESULT_CACHE_ENABLED
+    cache_key = _pipeline_cache_key(document_bytes, preprocess_options, routing=False, templates=False)
+    if use_cache:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            structured_data = PROCESSED_DOCUMENT_ADAPTER.validate_json(cached)
+            PIPELINE_SECONDS.observe(
+                time.time() - start_time,
+                endpoint=current_endpoint.get(), document_type=structured_data.document_name, cache="hit",
+            )
+            for event in _replay_fields(structured_data):
+                yield event
+            return
+
+    image_bytes = document_bytes
+    if preprocess_options.enabled:
+        image_bytes, processed_mime_type = await preprocess_image_async(image_bytes, preprocess_options)
+        mime_type = processed_mime_type or mime_type
+
+    async for event, data in stream_ocr_and_structure(image_bytes, mime_type):
+        if event == "result":
+            if use_cache:
+                await result_cache.set(cache_key, data.model_dump_json(by_alias=True))
+            PIPELINE_SECONDS.observe(
+                time.time() - start_time,
+                endpoint=current_endpoint.get(), document_type=data.document_name, cache="miss",
+            )
+        yield event, data
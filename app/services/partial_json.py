@@ -0,0 +1,111 @@
+# app/services/partial_json.py
+import json
+
+_WHITESPACE = " \t\r\n"
+
+
+class IncrementalJSONParser:
+    """
+    Push parser for a JSON document that arrives in pieces.
+
+    ``feed`` takes the next chunk of text and returns the scalar values that
+    were completed by it as ``(path, value)`` pairs, where ``path`` is the
+    tuple of object keys and array indexes leading to the value. Values are
+    reported once, as soon as their last character arrives, so a consumer
+    sees each field the moment the model has finished writing it.
+    """
+
+    def __init__(self):
+        # Each frame: [container type, current key or index, state]
+        # state is "key", "colon", "value" or "comma"
+        self._stack: list[list] = []
+        self._token: list[str] | None = None
+        self._in_string = False
+        self._escape = False
+        self._string_is_key = False
+        self._done = False
+
+    @property
+    def done(self) -> bool:
+        """True once the top-level value has been closed."""
+        return self._done
+
+    def _path(self) -> tuple:
+        return tuple(frame[1] for frame in self._stack)
+
+    def _value_completed(self) -> None:
+        if self._stack:
+            self._stack[-1][2] = "comma"
+        else:
+            self._done = True
+
+    def _emit(self, value, events: list) -> None:
+        events.append((self._path(), value))
+        self._value_completed()
+
+    def _finish_literal(self, events: list) -> None:
+        literal = "".join(self._token)
+        self._token = None
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            raise ValueError(f"Invalid JSON literal: {literal!r}")
+        self._emit(value, events)
+
+    def feed(self, text: str) -> list[tuple[tuple, object]]:
+        events: list[tuple[tuple, object]] = []
+        for char in text:
+            if self._in_string:
+                self._token.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    value = json.loads("".join(self._token))
+                    self._token = None
+                    if self._string_is_key:
+                        self._stack[-1][1] = value
+                        self._stack[-1][2] = "colon"
+                    else:
+                        self._emit(value, events)
+                continue
+
+            if self._token is not None:
+                if char not in _WHITESPACE and char not in ",]}":
+                    self._token.append(char)
+                    continue
+                self._finish_literal(events)
+
+            if char in _WHITESPACE:
+                continue
+            frame = self._stack[-1] if self._stack else None
+            state = frame[2] if frame else "value"
+
+            if char == '"':
+                self._in_string = True
+                self._string_is_key = state == "key"
+                self._token = ['"']
+            elif char == "{":
+                self._stack.append(["object", None, "key"])
+            elif char == "[":
+                self._stack.append(["array", 0, "value"])
+            elif char == ":" and state == "colon":
+                frame[2] = "value"
+            elif char == ",":
+                if frame[0] == "array":
+                    frame[1] += 1
+                    frame[2] = "value"
+                else:
+                    frame[2] = "key"
+            elif char in "}]":
+                # Empty containers have no scalars to report, so report the container itself
+                empty = frame[1] is None if frame[0] == "object" else (frame[1] == 0 and state == "value")
+                self._stack.pop()
+                if empty:
+                    events.append((self._path(), {} if char == "}" else []))
+                self._value_completed()
+            else:
+                self._token = [char]
+        return events
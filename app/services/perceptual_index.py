@@ -0,0 +1,338 @@
+# app/services/perceptual_index.py
+import io
+import os
+import time
+import sqlite3
+import threading
+from itertools import combinations
+import numpy as np
+from PIL import Image, ImageOps
+from fastapi.concurrency import run_in_threadpool
+from services.metrics import NEAR_DUPLICATE_LOOKUPS
+
+# "off", "flag" (report the probable duplicate but still call the model) or "reuse"
+# (answer with the stored result). Same-type forms filled in by different patients
+# can look alike at hash resolution, so "reuse" should only be enabled after the
+# distance has been tuned on real rescans.
+PERCEPTUAL_DEDUP_MODE = os.getenv('PERCEPTUAL_DEDUP_MODE', 'off').lower()
+if PERCEPTUAL_DEDUP_MODE not in ("off", "flag", "reuse"):
+    raise ValueError(f"PERCEPTUAL_DEDUP_MODE must be off, flag or reuse, got {PERCEPTUAL_DEDUP_MODE!r}")
+# Largest pHash Hamming distance (of 64 bits) that counts as the same page; the dHash must be within twice that
+PERCEPTUAL_MAX_DISTANCE = int(os.getenv('PERCEPTUAL_MAX_DISTANCE', '6'))
+PERCEPTUAL_INDEX_MAX_ENTRIES = int(os.getenv('PERCEPTUAL_INDEX_MAX_ENTRIES', '200000'))
+PERCEPTUAL_INDEX_TTL_SECONDS = float(os.getenv('PERCEPTUAL_INDEX_TTL_SECONDS', os.getenv('RESULT_CACHE_TTL_SECONDS', '86400')))
+# Optional SQLite file that keeps the index across restarts; unset keeps it in memory only
+PERCEPTUAL_INDEX_PATH = os.getenv('PERCEPTUAL_INDEX_PATH')
+
+HASH_BITS = 64
+# Multi-index hashing: the 64-bit pHash is split into CHUNKS substrings, each with its own table
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+CHUNK_COLUMNS = [f"chunk{index}" for index in range(CHUNKS)]
+# The shared SQLite file is trimmed to max_entries (and the TTL) once per this many adds
+PRUNE_EVERY_ADDS = 1000
+
+PHASH_SIZE = 32
+PHASH_LOW = 8
+# Orthonormal DCT-II basis, so the 2-D transform is two matrix products
+_n = np.arange(PHASH_SIZE)
+_DCT = np.sqrt(2 / PHASH_SIZE) * np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * PHASH_SIZE))
+_DCT[0] /= np.sqrt(2)
+_BIT_WEIGHTS = 1 << np.arange(HASH_BITS - 1, -1, -1, dtype=np.uint64)
+
+# A page flagged as a probable duplicate: (1-based page number, result cache key of the match, distance)
+DuplicatePage = tuple[int, str, int]
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int((bits.ravel().astype(np.uint64) * _BIT_WEIGHTS).sum())
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def perceptual_hashes(image_bytes: bytes) -> tuple[int, int]:
+    """
+    64-bit pHash and dHash of a page. The image is decoded at reduced size
+    (JPEG draft mode), EXIF-rotated and reduced to grayscale; the pHash keeps
+    the signs of the lowest 8x8 DCT frequencies of a 32x32 thumbnail
+    relative to their median, the dHash the horizontal gradient signs of a
+    9x8 thumbnail. Both survive recompression, rescaling and small shifts.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (PHASH_SIZE * 4, PHASH_SIZE * 4))
+        gray = ImageOps.exif_transpose(image).convert("L")
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BOX), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:PHASH_LOW, :PHASH_LOW]
+    phash = _bits_to_int(low > np.median(low.ravel()[1:]))
+
+    small = np.asarray(gray.resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+    return phash, dhash
+
+
+class IndexEntry:
+    __slots__ = ("phash", "dhash", "config", "cache_key", "accessed_at")
+
+    def __init__(self, phash: int, dhash: int, config: str, cache_key: str, accessed_at: float):
+        self.phash = phash
+        self.dhash = dhash
+        self.config = config
+        self.cache_key = cache_key
+        self.accessed_at = accessed_at
+
+
+class PerceptualIndex:
+    """
+    Near-duplicate lookup over page hashes, pointing at entries of the result
+    cache. Search is multi-index hashing: any hash within distance ``d`` of
+    the query matches it exactly in at least one of the CHUNKS substrings
+    up to ``d // CHUNKS`` bits, so only those few table buckets are scanned
+    instead of every entry. Entries expire after ``ttl_seconds`` and the
+    least recently used are evicted past ``max_entries``.
+
+    With a ``path`` the index is shared through SQLite by every worker
+    using the file: entries are written through, the chunk tables are
+    indexed columns there, and a lookup that finds nothing in memory
+    searches the file, so a page first seen by another worker is still
+    found. Evicting from memory leaves the file alone; the file is trimmed
+    on its own by TTL and least recent use across all workers.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, path: str | None = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self._entries: dict[str, IndexEntry] = {}
+        self._tables: list[dict[int, set[str]]] = [{} for _ in range(CHUNKS)]
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._loaded = False
+        self._adds = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _chunks(phash: int) -> list[int]:
+        return [(phash >> (CHUNK_BITS * index)) & CHUNK_MASK for index in range(CHUNKS)]
+
+    def _insert(self, entry: IndexEntry) -> None:
+        self._entries[entry.cache_key] = entry
+        for table, chunk in zip(self._tables, self._chunks(entry.phash)):
+            table.setdefault(chunk, set()).add(entry.cache_key)
+
+    def _remove(self, cache_key: str) -> None:
+        entry = self._entries.pop(cache_key, None)
+        if entry is None:
+            return
+        for table, chunk in zip(self._tables, self._chunks(entry.phash)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(cache_key)
+                if not bucket:
+                    del table[chunk]
+
+    @staticmethod
+    def _probes(chunk: int, radius: int):
+        """Every chunk value within ``radius`` bit flips of ``chunk``."""
+        for flips in range(radius + 1):
+            for positions in combinations(range(CHUNK_BITS), flips):
+                probe = chunk
+                for position in positions:
+                    probe ^= 1 << position
+                yield probe
+
+    def _prune(self) -> None:
+        """Drop expired rows from the SQLite file and trim it to max_entries, least recently used first."""
+        self._conn.execute("DELETE FROM page_hashes WHERE accessed_at < ?", (time.time() - self.ttl_seconds,))
+        self._conn.execute(
+            "DELETE FROM page_hashes WHERE accessed_at <="
+            " (SELECT accessed_at FROM page_hashes ORDER BY accessed_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self._conn.commit()
+
+    def load(self) -> None:
+        """Open the SQLite file (when configured) and load the unexpired entries, most recent last."""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.path:
+                return
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_hashes ("
+                " cache_key TEXT PRIMARY KEY,"
+                " phash INTEGER NOT NULL,"
+                " dhash INTEGER NOT NULL,"
+                " config TEXT NOT NULL,"
+                " accessed_at REAL NOT NULL,"
+                + ",".join(f" {column} INTEGER" for column in CHUNK_COLUMNS) + ")"
+            )
+            # Files written before the chunk columns existed
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(page_hashes)")}
+            if CHUNK_COLUMNS[0] not in columns:
+                for column in CHUNK_COLUMNS:
+                    self._conn.execute(f"ALTER TABLE page_hashes ADD COLUMN {column} INTEGER")
+                self._conn.executemany(
+                    f"UPDATE page_hashes SET {', '.join(f'{column} = ?' for column in CHUNK_COLUMNS)} WHERE cache_key = ?",
+                    [(*self._chunks(_to_unsigned(phash)), cache_key)
+                     for cache_key, phash in self._conn.execute("SELECT cache_key, phash FROM page_hashes").fetchall()],
+                )
+            for column in CHUNK_COLUMNS:
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS page_hashes_{column} ON page_hashes ({column})")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS page_hashes_accessed_at ON page_hashes (accessed_at)")
+            self._prune()
+            rows = self._conn.execute(
+                "SELECT cache_key, phash, dhash, config, accessed_at FROM page_hashes"
+                " ORDER BY accessed_at DESC LIMIT ?", (self.max_entries,)
+            ).fetchall()
+            for cache_key, phash, dhash, config, accessed_at in reversed(rows):
+                self._insert(IndexEntry(_to_unsigned(phash), _to_unsigned(dhash), config, cache_key, accessed_at))
+
+    def _candidates(self, phash: int, max_distance: int) -> set[str]:
+        radius = max_distance // CHUNKS
+        found: set[str] = set()
+        for table, chunk in zip(self._tables, self._chunks(phash)):
+            for probe in self._probes(chunk, radius):
+                bucket = table.get(probe)
+                if bucket:
+                    found |= bucket
+        return found
+
+    def _shared_candidates(self, phash: int, config: str, max_distance: int, expired_before: float) -> list[IndexEntry]:
+        """Live SQLite rows for ``config`` sharing a probed chunk with ``phash``, e.g. pages another worker added."""
+        radius = max_distance // CHUNKS
+        probes = [list(self._probes(chunk, radius)) for chunk in self._chunks(phash)]
+        where = " OR ".join(f"{column} IN ({', '.join('?' * len(values))})" for column, values in zip(CHUNK_COLUMNS, probes))
+        rows = self._conn.execute(
+            "SELECT cache_key, phash, dhash, config, accessed_at FROM page_hashes"
+            f" WHERE config = ? AND accessed_at >= ? AND ({where})",
+            (config, expired_before, *(value for values in probes for value in values)),
+        ).fetchall()
+        return [IndexEntry(_to_unsigned(phash), _to_unsigned(dhash), config, cache_key, accessed_at)
+                for cache_key, phash, dhash, config, accessed_at in rows]
+
+    def _closest(self, entries, phash: int, dhash: int, max_distance: int) -> tuple[str, int] | None:
+        best = None
+        for entry in entries:
+            distance = (entry.phash ^ phash).bit_count()
+            if distance > max_distance or (entry.dhash ^ dhash).bit_count() > 2 * max_distance:
+                continue
+            if best is None or distance < best[1]:
+                best = (entry.cache_key, distance)
+        return best
+
+    def find(self, phash: int, dhash: int, config: str, max_distance: int = PERCEPTUAL_MAX_DISTANCE) -> tuple[str, int] | None:
+        """Closest live entry for the same pipeline ``config`` within ``max_distance``, as (cache key, distance)."""
+        expired_before = time.time() - self.ttl_seconds
+        with self._lock:
+            entries = []
+            for cache_key in self._candidates(phash, max_distance):
+                entry = self._entries[cache_key]
+                # Another worker may have used it since; the file has the current time
+                if entry.accessed_at < expired_before:
+                    self._remove(cache_key)
+                elif entry.config == config:
+                    entries.append(entry)
+            best = self._closest(entries, phash, dhash, max_distance)
+            if best is None and self._conn is not None:
+                shared = self._shared_candidates(phash, config, max_distance, expired_before)
+                best = self._closest(shared, phash, dhash, max_distance)
+                if best is not None:
+                    entry = next(entry for entry in shared if entry.cache_key == best[0])
+                    self._remove(entry.cache_key)
+                    self._insert(entry)
+                    self._evict()
+        if best is None:
+            self.misses += 1
+            NEAR_DUPLICATE_LOOKUPS.inc(result="miss")
+        else:
+            self.hits += 1
+            NEAR_DUPLICATE_LOOKUPS.inc(result="hit")
+        return best
+
+    def _evict(self) -> None:
+        # Dicts keep insertion order and re-adds go to the end, so the front is least recently used
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def add(self, phash: int, dhash: int, config: str, cache_key: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remove(cache_key)
+            self._insert(IndexEntry(phash, dhash, config, cache_key, now))
+            self._evict()
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO page_hashes (cache_key, phash, dhash, config, accessed_at, "
+                    f"{', '.join(CHUNK_COLUMNS)}) VALUES ({', '.join('?' * (5 + CHUNKS))})",
+                    (cache_key, _to_signed(phash), _to_signed(dhash), config, now, *self._chunks(phash)),
+                )
+                self._conn.commit()
+                self._adds += 1
+                if self._adds % PRUNE_EVERY_ADDS == 0:
+                    self._prune()
+
+    def touch(self, cache_key: str) -> None:
+        """Mark an entry as just used (a hit), moving it to the back of the eviction order."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is None:
+                return
+            entry.accessed_at = now
+            self._entries[cache_key] = entry
+            if self._conn is not None:
+                self._conn.execute("UPDATE page_hashes SET accessed_at = ? WHERE cache_key = ?", (now, cache_key))
+                self._conn.commit()
+
+    def discard(self, cache_key: str) -> None:
+        """Drop an entry whose result is no longer in the result cache."""
+        with self._lock:
+            self._remove(cache_key)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM page_hashes WHERE cache_key = ?", (cache_key,))
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "mode": PERCEPTUAL_DEDUP_MODE,
+            "max_distance": PERCEPTUAL_MAX_DISTANCE,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "path": self.path,
+        }
+
+
+perceptual_index = PerceptualIndex(PERCEPTUAL_INDEX_MAX_ENTRIES, PERCEPTUAL_INDEX_TTL_SECONDS, PERCEPTUAL_INDEX_PATH)
+
+
+async def lookup_near_duplicate(image_bytes: bytes, config: str) -> tuple[int, int, tuple[str, int] | None] | None:
+    """
+    Hash the page and look it up, off the event loop; returns (phash, dhash,
+    match), or None when the page cannot be decoded here (the pipeline then
+    runs without near-duplicate detection and reports its own decode errors).
+    """
+    def run():
+        perceptual_index.load()
+        try:
+            phash, dhash = perceptual_hashes(image_bytes)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"Warning: Perceptual hashing skipped: {e}")
+            return None
+        return phash, dhash, perceptual_index.find(phash, dhash, config)
+    return await run_in_threadpool(run)
@@ -0,0 +1,200 @@
+# app/services/result_cache.py
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from fastapi.concurrency import run_in_threadpool
+from services.metrics import CACHE_LOOKUPS
+
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1024'))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv('RESULT_CACHE_TTL_SECONDS', '86400'))
+# Optional on-disk tier; leave unset to keep the cache in memory only.
+RESULT_CACHE_SQLITE_PATH = os.getenv('RESULT_CACHE_SQLITE_PATH')
+RESULT_CACHE_SQLITE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_SQLITE_MAX_ENTRIES', '100000'))
+
+
+def make_cache_key(image_bytes: bytes, *parts: str) -> str:
+    """Content-addressed key: sha256 over the image bytes and every pipeline input that affects the output."""
+    digest = hashlib.sha256(image_bytes)
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(part.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def schema_version(model) -> str:
+    """Short fingerprint of a Pydantic model's JSON schema, so schema changes invalidate old entries."""
+    schema = json.dumps(model.model_json_schema(by_alias=True), sort_keys=True)
+    return hashlib.sha256(schema.encode('utf-8')).hexdigest()[:16]
+
+
+class CacheBackend(ABC):
+    """Interface for a cache tier. Values are serialized JSON strings."""
+
+    name = "backend"
+
+    @abstractmethod
+    def get(self, key: str) -> str | None:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryLRUBackend(CacheBackend):
+    """In-process LRU tier with a size limit and a TTL."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "max_entries": self.max_entries}
+
+
+class SQLiteBackend(CacheBackend):
+    """On-disk tier that survives restarts. Evicts expired rows, then the least recently used ones."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl_seconds, now),
+            )
+            self._conn.execute("DELETE FROM results WHERE expires_at < ?", (now,))
+            self._conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                " SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()
+        return {"entries": count, "max_entries": self.max_entries, "path": self.path}
+
+
+class ResultCache:
+    """
+    Tiered cache. Lookups go through the tiers in order and a hit in a
+    slower tier is promoted into the faster ones. Blocking tiers run in the
+    thread pool so disk I/O never stalls the event loop.
+    """
+
+    def __init__(self, backends: list[CacheBackend]):
+        self.backends = backends
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> str | None:
+        for index, backend in enumerate(self.backends):
+            value = await self._call(backend, backend.get, key)
+            if value is not None:
+                self.hits += 1
+                CACHE_LOOKUPS.inc(result="hit")
+                for faster in self.backends[:index]:
+                    await self._call(faster, faster.set, key, value)
+                return value
+        self.misses += 1
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        for backend in self.backends:
+            await self._call(backend, backend.set, key, value)
+
+    @staticmethod
+    async def _call(backend: CacheBackend, fn, *args):
+        if isinstance(backend, MemoryLRUBackend):
+            return fn(*args)
+        return await run_in_threadpool(fn, *args)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": RESULT_CACHE_ENABLED,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "tiers": {backend.name: backend.stats() for backend in self.backends},
+        }
+
+
+def _build_result_cache() -> ResultCache:
+    backends: list[CacheBackend] = [MemoryLRUBackend(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS)]
+    if RESULT_CACHE_SQLITE_PATH:
+        backends.append(SQLiteBackend(RESULT_CACHE_SQLITE_PATH, RESULT_CACHE_SQLITE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS))
+    return ResultCache(backends)
+
+
+result_cache = _build_result_cache()
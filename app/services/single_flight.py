@@ -0,0 +1,59 @@
+# app/services/single_flight.py
+import os
+import asyncio
+from typing import Awaitable, Callable, TypeVar
+from services.metrics import COALESCED_REQUESTS, current_endpoint
+
+REQUEST_COALESCING_ENABLED = os.getenv('REQUEST_COALESCING_ENABLED', 'true').lower() == 'true'
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls by key: the first caller starts the work as
+    a task, callers arriving with the same key while it runs await that same
+    task instead of starting their own. Each caller awaits it through
+    ``asyncio.shield``, so a caller that is cancelled (client disconnected)
+    only stops waiting; the shared call runs on for the others, and to
+    completion even if every caller has left, so its result still reaches
+    the cache for the retry that is usually on its way.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the outcome as retrieved so an abandoned failure is not logged as never retrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            COALESCED_REQUESTS.inc(endpoint=current_endpoint.get())
+        return await asyncio.shield(task)
+
+    def is_in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    def stats(self) -> dict:
+        return {
+            "enabled": REQUEST_COALESCING_ENABLED,
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
+
+
+pipeline_flights = SingleFlight()
@@ -0,0 +1,109 @@
+# benchmarks/cold_start.py
+"""
+Cold start of the production server: launches ``app/server.py`` as a fresh
+process, polls /health until it answers, then sends SIGTERM and waits for
+the exit. Reported per run: time to healthy, the worker's own startup
+breakdown (import / warm-up, from /health) and time to shut down.
+
+    python benchmarks/cold_start.py --runs 5 --workers 2
+
+Warm-up is off by default because it talks to the real Gemini API; pass
+--warmup (with real keys in the environment) to include it.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "app")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_once(workers: int, warmup: bool, timeout: float) -> dict:
+    port = _free_port()
+    env = {
+        **os.environ,
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "WEB_CONCURRENCY": str(workers),
+        "STARTUP_WARMUP_ENABLED": str(warmup).lower(),
+        "LOG_LEVEL": "warning",
+        "JOB_QUEUE_PATH": os.path.join(tempfile.mkdtemp(prefix="ocr-cold-start-"), "jobs.sqlite3"),
+    }
+    env.setdefault("GOOGLE_API_KEY", "benchmark")
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "server.py"], cwd=APP_DIR, env=env)
+    health = None
+    try:
+        deadline = start + timeout
+        while health is None:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with status {process.returncode} during startup")
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"Server not healthy after {timeout}s")
+            try:
+                response = httpx.get(f"http://127.0.0.1:{port}/health", timeout=1.0)
+                if response.status_code == 200:
+                    health = response.json()
+            except httpx.HTTPError:
+                time.sleep(0.02)
+        healthy_seconds = time.perf_counter() - start
+
+        stop_start = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=timeout)
+        shutdown_seconds = time.perf_counter() - stop_start
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    return {
+        "healthy_seconds": round(healthy_seconds, 3),
+        "shutdown_seconds": round(shutdown_seconds, 3),
+        "worker_startup": health.get("startup"),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="WEB_CONCURRENCY for the server")
+    parser.add_argument("--warmup", action="store_true", help="Include the Gemini and preprocessing warm-up")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Give up on a run after this many seconds")
+    parser.add_argument("--output", help="Write the JSON report here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    runs = [measure_once(args.workers, args.warmup, args.timeout) for _ in range(args.runs)]
+    healthy = sorted(run["healthy_seconds"] for run in runs)
+    report = {
+        "config": {"runs": args.runs, "workers": args.workers, "warmup": args.warmup, "python": sys.version.split()[0]},
+        "healthy_seconds": {"min": healthy[0], "median": healthy[len(healthy) // 2], "max": healthy[-1]},
+        "runs": runs,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# benchmarks/fake_gemini.py
+import json
+import random
+import asyncio
+from google.genai import errors, types
+from pydantic import BaseModel
+from models import ProcessedDocumentData
+from services.document_schemas import empty_dict
+
+
+def default_canned_document(document_name: str = "gene_mutation") -> dict:
+    """Aliased ProcessedDocumentData dict with a few plausible values filled in."""
+    data = empty_dict(ProcessedDocumentData)
+    data.update({
+        "document_name": document_name,
+        "full_name": "Nguyen Van A",
+        "gender": "Nam",
+        "date_of_birth": "1980-01-01",
+        "doctor": "Tran Thi B",
+        "phone": "0901234567",
+        "Test code": "BENCH-0001",
+    })
+    return data
+
+
+def _project(value, schema: dict, defs: dict):
+    """``value`` reduced to the properties a JSON schema asks for, following its $refs and arrays."""
+    if "$ref" in schema:
+        schema = defs[schema["$ref"].rsplit("/", 1)[-1]]
+    for option in schema.get("anyOf", ()):
+        if option.get("type") != "null":
+            schema = option
+            break
+    if "$ref" in schema:
+        schema = defs[schema["$ref"].rsplit("/", 1)[-1]]
+    if isinstance(value, dict) and "properties" in schema:
+        return {key: _project(value[key], sub, defs) for key, sub in schema["properties"].items() if key in value}
+    if isinstance(value, list) and "items" in schema:
+        return [_project(item, schema["items"], defs) for item in value]
+    return value
+
+
+class LatencyModel:
+    """
+    Latency distribution of the fake backend, in seconds.
+
+    ``constant`` always returns ``median``; ``uniform`` spreads evenly over
+    [``low``, ``high``]; ``lognormal`` has the long right tail real model
+    calls show, with ``sigma`` controlling how heavy it is.
+    """
+
+    def __init__(self, kind: str = "lognormal", median: float = 1.5, sigma: float = 0.5,
+                 low: float = 0.5, high: float = 3.0, seed: int | None = None):
+        if kind not in ("constant", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {kind}")
+        self.kind = kind
+        self.median = median
+        self.sigma = sigma
+        self.low = low
+        self.high = high
+        self._random = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.kind == "constant":
+            return self.median
+        if self.kind == "uniform":
+            return self._random.uniform(self.low, self.high)
+        return self.median * self._random.lognormvariate(0.0, self.sigma)
+
+
+class _FakeModels:
+    def __init__(self, backend: "FakeGenaiClient"):
+        self._backend = backend
+
+    async def get(self, *, model: str, config=None):
+        return types.Model(name=f"models/{model}")
+
+    async def generate_content(self, *, model: str, contents, config=None):
+        return await self._backend._respond(model, config)
+
+    async def generate_content_stream(self, *, model: str, contents, config=None):
+        # The sampled latency is spread over the chunks, like a model writing its answer
+        latency = self._backend.latency.sample()
+        response = await self._backend._respond(model, config, latency=0.0)
+
+        async def chunks():
+            text = response.text
+            step = max(1, len(text) // self._backend.stream_chunks)
+            for start in range(0, len(text), step):
+                await asyncio.sleep(latency * step / len(text))
+                yield types.GenerateContentResponse(
+                    candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text[start:start + step])]))],
+                    usage_metadata=response.usage_metadata if start + step >= len(text) else None,
+                )
+        return chunks()
+
+
+class _FakeAio:
+    def __init__(self, backend: "FakeGenaiClient"):
+        self.models = _FakeModels(backend)
+
+
+class FakeGenaiClient:
+    """
+    Drop-in stand-in for ``genai.Client`` that never leaves the process;
+    wrap it in a GeminiBackend to put it in the backend pool.
+
+    Only the surface this service uses is implemented
+    (``client.aio.models.generate_content``, ``generate_content_stream``
+    and the ``get`` used for warm-up).
+    Each call sleeps for a sample of ``latency``, fails with a 503
+    ``ServerError`` with probability ``error_rate`` and otherwise answers
+    with ``canned`` validated against the request's ``response_schema``, the
+    same way the SDK fills ``response.parsed``.
+    """
+
+    def __init__(self, latency: LatencyModel | None = None, error_rate: float = 0.0,
+                 canned: dict | None = None, prompt_tokens: int = 1800, output_tokens: int = 900,
+                 stream_chunks: int = 8, seed: int | None = None):
+        self.latency = latency or LatencyModel(seed=seed)
+        self.error_rate = error_rate
+        self.canned = canned or default_canned_document()
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self.aio = _FakeAio(self)
+
+    async def _respond(self, model: str, config, latency: float | None = None) -> types.GenerateContentResponse:
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample() if latency is None else latency)
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            raise errors.ServerError(503, {"error": {"code": 503, "message": "fake backend overloaded", "status": "UNAVAILABLE"}})
+
+        schema = (config or {}).get("response_schema") if isinstance(config, dict) else getattr(config, "response_schema", None)
+        parsed = None
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            parsed = schema.model_validate(self.canned)
+            text = parsed.model_dump_json(by_alias=True)
+        elif isinstance(schema, dict):
+            # A JSON schema: the model answers its fields only and the SDK just json-loads the text
+            parsed = _project(self.canned, schema, schema.get("$defs", {}))
+            text = json.dumps(parsed, ensure_ascii=False)
+        else:
+            text = json.dumps(self.canned, ensure_ascii=False)
+
+        response = types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=self.prompt_tokens,
+                candidates_token_count=self.output_tokens,
+                total_token_count=self.prompt_tokens + self.output_tokens,
+            ),
+            model_version=model,
+        )
+        response.parsed = parsed
+        return response
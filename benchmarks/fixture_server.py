@@ -0,0 +1,89 @@
+# benchmarks/fixture_server.py
+import io
+import os
+import mimetypes
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw
+
+
+def synthetic_form(width: int = 2480, height: int = 3508, seed: int = 0) -> bytes:
+    """
+    A scanned-form lookalike (A4 at 300 dpi by default): ruled lines, text
+    blocks and checkboxes on off-white paper, saved as JPEG. ``seed`` shifts
+    the layout so fixtures do not all hash to the same cache key.
+    """
+    image = Image.new("RGB", (width, height), (246, 244, 238))
+    draw = ImageDraw.Draw(image)
+    margin = width // 12
+    row_height = height // 40
+    for row in range(4, 36):
+        y = row * row_height + seed % row_height
+        draw.line([(margin, y), (width - margin, y)], fill=(150, 150, 150), width=2)
+        for column in range(3):
+            x = margin + column * (width - 2 * margin) // 3
+            draw.rectangle([x + 10, y - row_height + 12, x + 10 + row_height // 2, y - 12], outline=(40, 40, 40), width=3)
+            draw.text((x + row_height, y - row_height + 10), f"Field {row}.{column} {seed}", fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class FixtureServer:
+    """
+    Serves fixture documents on ``http://127.0.0.1:<port>/<name>`` from a
+    background thread. Fixtures come from ``directory`` when given,
+    otherwise ``count`` synthetic forms are generated in memory.
+    """
+
+    def __init__(self, directory: str | None = None, count: int = 8):
+        self.fixtures: dict[str, tuple[bytes, str]] = {}
+        if directory:
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                        self.fixtures[name] = (f.read(), content_type)
+        else:
+            for index in range(count):
+                self.fixtures[f"form-{index}.jpg"] = (synthetic_form(seed=index), "image/jpeg")
+        if not self.fixtures:
+            raise ValueError(f"No fixtures found in {directory}")
+
+        fixtures = self.fixtures
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                entry = fixtures.get(self.path.lstrip("/"))
+                if entry is None:
+                    self.send_error(404)
+                    return
+                body, content_type = entry
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def urls(self) -> list[str]:
+        host, port = self._server.server_address[:2]
+        return [f"http://{host}:{port}/{name}" for name in self.fixtures]
+
+    def __enter__(self) -> "FixtureServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
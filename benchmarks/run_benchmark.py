@@ -0,0 +1,297 @@
+# benchmarks/run_benchmark.py
+"""
+Offline load test for the OCR service.
+
+Runs the real FastAPI app under uvicorn with a FakeGenaiClient in place of
+the Gemini client, serves fixture documents from a local HTTP server and
+drives /process_document at a fixed concurrency. No API quota is used.
+
+    python benchmarks/run_benchmark.py --requests 500 --concurrency 32 --save-baseline
+    python benchmarks/run_benchmark.py --requests 500 --concurrency 32 --compare --max-regression 10
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import asyncio
+import platform
+import resource
+import tempfile
+import threading
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "app")
+sys.path.insert(0, APP_DIR)
+
+# The app reads these at import time
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("JOB_QUEUE_PATH", os.path.join(tempfile.mkdtemp(prefix="ocr-bench-"), "jobs.sqlite3"))
+
+import httpx
+import uvicorn
+from fake_gemini import FakeGenaiClient, LatencyModel
+from fixture_server import FixtureServer
+
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, "results", "baseline.json")
+
+# (report path, higher is better) for every metric compared against the baseline
+COMPARED_METRICS = (
+    (("latency_seconds", "p50"), False),
+    (("latency_seconds", "p95"), False),
+    (("latency_seconds", "p99"), False),
+    (("requests_per_second",), True),
+    (("event_loop_lag_seconds", "p99"), False),
+    (("peak_rss_mb", "total"), False),
+)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile; ``q`` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb() -> dict:
+    """Peak resident set size of this process and of its (preprocessing) children."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if platform.system() == "Darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return {"self": round(own, 1), "children": round(children, 1), "total": round(own + children, 1)}
+
+
+class LoopLagMonitor:
+    """Measures how late the server's event loop wakes up from a short sleep."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: list[float] = []
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def reset(self) -> None:
+        self.samples = []
+
+    def summary(self) -> dict:
+        samples = list(self.samples)
+        return {
+            "p50": round(percentile(samples, 50), 6),
+            "p99": round(percentile(samples, 99), 6),
+            "max": round(max(samples, default=0.0), 6),
+        }
+
+
+class AppServer:
+    """Runs the app under uvicorn on its own thread and event loop, with a lag monitor on that loop."""
+
+    def __init__(self, app, lag_monitor: LoopLagMonitor):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.lag_monitor = lag_monitor
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        async def serve():
+            monitor = asyncio.create_task(self.lag_monitor.run())
+            try:
+                await self.server.serve()
+            finally:
+                monitor.cancel()
+        asyncio.run(serve())
+
+    def __enter__(self) -> "AppServer":
+        self._thread.start()
+        deadline = time.monotonic() + 30
+        while not self.server.started:
+            if not self._thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("Benchmark server failed to start")
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.should_exit = True
+        self._thread.join()
+
+
+async def drive_load(base_url: str, urls: list[str], total: int, concurrency: int, params: dict) -> tuple[list[float], dict, float]:
+    """Send ``total`` requests with ``concurrency`` in flight; returns latencies of 200s, status counts and wall time."""
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    next_index = 0
+
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        timeout=httpx.Timeout(600.0),
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+    ) as client:
+
+        async def worker():
+            nonlocal next_index
+            while next_index < total:
+                index = next_index
+                next_index += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.post("/process_document", params={**params, "url": urls[index % len(urls)]})
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == "200":
+                    latencies.append(elapsed)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+    return latencies, statuses, wall
+
+
+def run(args) -> dict:
+    # Identical concurrent requests would otherwise share one fake call and flatter the numbers
+    os.environ["REQUEST_COALESCING_ENABLED"] = str(args.coalesce).lower()
+    import main as app_module
+    from services.gemini_client import GEMINI_LIGHT_MODEL, GEMINI_MODEL, BackendPool, GeminiBackend, set_backend_pool
+
+    canned = json.load(open(args.canned)) if args.canned else None
+    fakes = []
+    backends = []
+    for index in range(args.backends):
+        seed = args.seed + index
+        fake = FakeGenaiClient(
+            latency=LatencyModel(args.latency, args.latency_median, args.latency_sigma, args.latency_low, args.latency_high, seed=seed),
+            error_rate=args.error_rate,
+            canned=canned,
+            seed=seed,
+        )
+        fakes.append(fake)
+        backends.append(GeminiBackend(f"fake{index}-standard", fake, GEMINI_MODEL, "standard"))
+        backends.append(GeminiBackend(f"fake{index}-light", fake, GEMINI_LIGHT_MODEL, "light"))
+    set_backend_pool(BackendPool(backends))
+
+    params = {"use_cache": str(args.use_cache).lower()}
+    for item in args.param:
+        key, _, value = item.partition("=")
+        params[key] = value
+
+    lag_monitor = LoopLagMonitor()
+    with FixtureServer(args.fixtures_dir, args.fixtures) as fixtures, AppServer(app_module.app, lag_monitor) as server:
+        if args.warmup:
+            asyncio.run(drive_load(server.url, fixtures.urls, args.warmup, min(args.warmup, args.concurrency), params))
+        lag_monitor.reset()
+        latencies, statuses, wall = asyncio.run(drive_load(server.url, fixtures.urls, args.requests, args.concurrency, params))
+        lag = lag_monitor.summary()
+
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "params": params,
+            "coalescing": args.coalesce,
+            "latency_model": {"kind": args.latency, "median": args.latency_median, "sigma": args.latency_sigma,
+                              "low": args.latency_low, "high": args.latency_high},
+            "error_rate": args.error_rate,
+            "backends": args.backends,
+            "fixtures": len(fixtures.fixtures),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "statuses": statuses,
+        "duration_seconds": round(wall, 3),
+        "requests_per_second": round(args.requests / wall, 3) if wall else 0.0,
+        "latency_seconds": {
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+            "max": round(max(latencies, default=0.0), 4),
+            "mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        },
+        "event_loop_lag_seconds": lag,
+        "peak_rss_mb": peak_rss_mb(),
+        "gemini": {"calls": sum(fake.calls for fake in fakes), "errors": sum(fake.errors for fake in fakes)},
+    }
+
+
+def _lookup(report: dict, path: tuple[str, ...]) -> float:
+    value = report
+    for key in path:
+        value = value[key]
+    return value
+
+
+def compare(report: dict, baseline: dict, max_regression: float | None) -> bool:
+    """Print a baseline comparison table; returns False when a metric regressed beyond ``max_regression`` percent."""
+    ok = True
+    print(f"\n{'metric':<30}{'baseline':>12}{'current':>12}{'change':>10}")
+    for path, higher_is_better in COMPARED_METRICS:
+        old, new = _lookup(baseline, path), _lookup(report, path)
+        change = (new - old) / old * 100 if old else 0.0
+        regression = -change if higher_is_better else change
+        flag = ""
+        if max_regression is not None and regression > max_regression:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{'.'.join(path):<30}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests sent first")
+    parser.add_argument("--use-cache", action="store_true", help="Leave the result cache on (off by default so every request reaches the fake model)")
+    parser.add_argument("--coalesce", action="store_true", help="Leave request coalescing on (off by default, like the cache)")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE", help="Extra query parameter for /process_document (repeatable)")
+    parser.add_argument("--fixtures-dir", help="Serve the documents in this directory instead of synthetic forms")
+    parser.add_argument("--fixtures", type=int, default=8, help="Number of synthetic forms")
+    parser.add_argument("--latency", choices=("constant", "uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--latency-median", type=float, default=1.5, help="Median (or constant) fake model latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Shape of the lognormal tail")
+    parser.add_argument("--latency-low", type=float, default=0.5)
+    parser.add_argument("--latency-high", type=float, default=3.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake model calls that fail with 503")
+    parser.add_argument("--backends", type=int, default=1, help="Fake API keys in the backend pool (each gets a standard and a light backend)")
+    parser.add_argument("--canned", help="JSON file with the ProcessedDocumentData the fake model returns")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE_PATH, help="Store the report as the baseline")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE_PATH, help="Compare against a stored baseline")
+    parser.add_argument("--max-regression", type=float, help="Exit non-zero if any compared metric is this many percent worse")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    report = run(args)
+    print(json.dumps(report, indent=2))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())